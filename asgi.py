@@ -0,0 +1,153 @@
+import asyncio
+import hmac
+import json
+import os
+
+from telegram_bot import TelegramBot
+from telegram_bot_base import WEBHOOK_SECRET_TOKEN, configure_logging
+from worker_pool import KeyedWorkerPool
+
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8080))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/')
+# Updates are a few KiB; anything much bigger is not from Telegram.
+WEBHOOK_MAX_BODY_SIZE = int(os.environ.get('WEBHOOK_MAX_BODY_SIZE', 1024 * 1024))
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 8))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 256))
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get('WEBHOOK_DRAIN_TIMEOUT', 30))
+
+SECRET_TOKEN_HEADER = b'x-telegram-bot-api-secret-token'
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+class WebhookApp:
+    # A self-hosted webhook endpoint for one warm process. Deliveries are
+    # claimed by `process_webhook_request` and queued on a worker pool keyed
+    # like in polling mode: updates of one post in order, different posts
+    # on up to `workers` threads, channels taking turns. Telegram gets its
+    # response before the update is processed. On shutdown new deliveries
+    # get 503 (Telegram retries them) while queued updates, log messages and
+    # storage batches are flushed.
+    def __init__(
+            self,
+            bot_class: type[TelegramBot] = TelegramBot,
+            path: str = WEBHOOK_PATH,
+            secret_token: str = WEBHOOK_SECRET_TOKEN,
+            max_body_size: int = WEBHOOK_MAX_BODY_SIZE,
+            workers: int = WEBHOOK_WORKERS,
+            queue_size: int = WEBHOOK_QUEUE_SIZE,
+            drain_timeout: float = WEBHOOK_DRAIN_TIMEOUT,
+    ):
+        self.bot_class = bot_class
+        self.path = path
+        self.secret_token = secret_token
+        self.max_body_size = max_body_size
+        self.drain_timeout = drain_timeout
+        self.pool = KeyedWorkerPool(workers=workers, queue_size=queue_size)
+        self.draining = False
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        status, text = await self.handle(scope, receive)
+        body = text.encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'text/plain; charset=utf-8'),
+                (b'content-length', str(len(body)).encode()),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def run(self, func, *args):
+        # Claiming and queueing block on the update store and a full pool.
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def start(self):
+        telegram_bot = self.bot_class.get_instance(long_lived=True)
+        telegram_bot.pool = self.pool
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Build the bot and process updates left over by the last run
+                # before the first delivery.
+                await self.run(self.start)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.draining = True
+                await self.run(self.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def shutdown(self):
+        self.bot_class.get_instance().shutdown(timeout=self.drain_timeout)
+        self.pool.shutdown(wait=False)
+
+    def is_authorized(self, headers: dict[bytes, bytes]):
+        if not self.secret_token:
+            return True
+        return hmac.compare_digest(
+            headers.get(SECRET_TOKEN_HEADER, b''),
+            self.secret_token.encode('utf-8'),
+        )
+
+    async def read_body(self, headers: dict[bytes, bytes], receive):
+        if int(headers.get(b'content-length') or 0) > self.max_body_size:
+            raise RequestTooLarge
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            body += message.get('body', b'')
+            # Chunked requests have no length to check up front.
+            if len(body) > self.max_body_size:
+                raise RequestTooLarge
+            if not message.get('more_body'):
+                return bytes(body)
+
+    async def handle(self, scope, receive):
+        if scope['path'] != self.path:
+            return 404, 'Not Found'
+        if scope['method'] != 'POST':
+            return 405, 'Method Not Allowed'
+        headers = dict(scope['headers'])
+        if not self.is_authorized(headers):
+            return 403, 'Forbidden'
+        if self.draining:
+            return 503, 'Shutting down'
+        try:
+            if (body := await self.read_body(headers, receive)) is None:
+                return 400, 'Disconnected'
+            data = json.loads(body)
+        except RequestTooLarge:
+            return 413, 'Request Entity Too Large'
+        except ValueError:
+            return 400, 'Bad Request'
+        if not isinstance(data, dict) or 'update_id' not in data:
+            return 400, 'Bad Request'
+        return 200, await self.run(self.bot_class.process_webhook_request, data)
+
+
+app = WebhookApp()
+
+
+def serve():
+    # uvicorn is only needed to self-host, so it is not in requirements.txt.
+    import uvicorn
+    configure_logging()
+    uvicorn.run(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT, lifespan='on',
+                timeout_graceful_shutdown=WEBHOOK_DRAIN_TIMEOUT)
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextvars import copy_context
+from functools import partial
+from threading import Lock, Thread, current_thread
+from typing import Callable
+
+ASYNC_UPDATES = os.environ.get('ASYNC_UPDATES') == '1'
+ASYNC_MAX_IN_FLIGHT = int(os.environ.get('ASYNC_MAX_IN_FLIGHT', 8))
+GATHER_CONCURRENCY = int(os.environ.get('GATHER_CONCURRENCY', 4))
+GATHER_THREAD_PREFIX = 'gather'
+
+logger = logging.getLogger(__name__)
+
+_pipeline: 'AsyncPipeline' = None
+_pipeline_lock = Lock()
+_gather_executor: ThreadPoolExecutor = None
+
+
+class AsyncPipeline:
+    # An event loop in a background thread. Handlers are blocking, so each
+    # submitted job runs in `executor`, and the blocking calls it fans out
+    # with `gather` run in a separate `io_executor` so that jobs waiting on
+    # their own I/O can never starve it.
+    def __init__(self, max_in_flight: int = ASYNC_MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_in_flight,
+            thread_name_prefix='update',
+        )
+        self.io_executor = ThreadPoolExecutor(
+            max_workers=max_in_flight * 4,
+            thread_name_prefix='update-io',
+        )
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._in_flight: set[Future] = set()
+        self._thread = Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    async def _run(self, func: Callable, *args):
+        async with self._semaphore:
+            return await self.loop.run_in_executor(self.executor, func, *args)
+
+    def _done(self, future: Future):
+        self._in_flight.discard(future)
+        if not future.cancelled() and (error := future.exception()):
+            logger.error('Background update failed', exc_info=error)
+
+    def submit(self, func: Callable, *args) -> Future:
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(func, *args), self.loop,
+        )
+        self._in_flight.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    async def _gather(self, funcs: tuple[Callable, ...]):
+        return await asyncio.gather(*(
+            self.loop.run_in_executor(self.io_executor, func) for func in funcs
+        ))
+
+    def gather(self, *funcs: Callable) -> list:
+        # Run each call in a copy of the caller's context so that it is
+        # timed as part of the caller's trace.
+        funcs = tuple(partial(copy_context().run, func) for func in funcs)
+        return asyncio.run_coroutine_threadsafe(
+            self._gather(funcs), self.loop,
+        ).result()
+
+    def drain(self, timeout: float = None):
+        return wait(set(self._in_flight), timeout=timeout)
+
+
+def get_pipeline():
+    global _pipeline
+    if _pipeline is None:
+        with _pipeline_lock:
+            if _pipeline is None:
+                _pipeline = AsyncPipeline()
+    return _pipeline
+
+
+def get_gather_executor():
+    global _gather_executor
+    if _gather_executor is None:
+        with _pipeline_lock:
+            if _gather_executor is None:
+                _gather_executor = ThreadPoolExecutor(
+                    max_workers=GATHER_CONCURRENCY,
+                    thread_name_prefix=GATHER_THREAD_PREFIX,
+                )
+    return _gather_executor
+
+
+def gather(*funcs: Callable) -> list:
+    if ASYNC_UPDATES:
+        return get_pipeline().gather(*funcs)
+    # The first call runs in the caller's thread, the others on a small
+    # shared pool; inline if that is where the caller runs, as waiting on
+    # the pool from it could exhaust it.
+    if len(funcs) < 2 or current_thread().name.startswith(GATHER_THREAD_PREFIX):
+        return [func() for func in funcs]
+    executor = get_gather_executor()
+    futures = [executor.submit(copy_context().run, func) for func in funcs[1:]]
+    return [funcs[0](), *(future.result() for future in futures)]
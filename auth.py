@@ -0,0 +1,27 @@
+import hmac
+import os
+
+# Kept free of heavy imports: main checks calls with it before the bot is
+# imported.
+APP_TOKEN = os.environ.get('APP_TOKEN')
+# Telegram sends it back in X-Telegram-Bot-Api-Secret-Token with every update.
+WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN')
+
+
+def get_request_data(request):
+    data = request.args if request.method == 'GET' else request.get_json(
+        force=True, silent=True,
+    )
+    return data if isinstance(data, dict) else {}
+
+
+def is_authorized(request, data: dict):
+    # Updates carry the webhook secret token, app requests APP_TOKEN.
+    if 'update_id' in data:
+        return not WEBHOOK_SECRET_TOKEN or hmac.compare_digest(
+            request.headers.get('X-Telegram-Bot-Api-Secret-Token', '').encode(),
+            WEBHOOK_SECRET_TOKEN.encode(),
+        )
+    return bool(APP_TOKEN) and hmac.compare_digest(
+        str(data.get('token', '')).encode(), APP_TOKEN.encode(),
+    )
@@ -0,0 +1,178 @@
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import Optional
+
+from telegram import Bot, Message
+from telegram.error import BadRequest, RetryAfter
+
+from gitlab_post import GitlabPost
+from manifest import get_manifest
+from media_mirror import MEDIA_MIRROR, MediaMirror
+from post import Post
+from routing import Route
+from storage import Storage
+from telegram_bot import TelegramBot
+from telegram_bot_base import LOG_CHAT_ID
+
+BACKFILL_CHAT_ID = int(os.environ.get('BACKFILL_CHAT_ID', LOG_CHAT_ID))
+BACKFILL_CONCURRENCY = int(os.environ.get('BACKFILL_CONCURRENCY', 4))
+BACKFILL_PAGE_SIZE = int(os.environ.get('BACKFILL_PAGE_SIZE', 50))
+BACKFILL_CHECKPOINT_PATH = os.environ.get('BACKFILL_CHECKPOINT_PATH',
+                                          'backfill.checkpoint.json')
+# BadRequest messages for message ids with nothing to forward. Any other error
+# (a wrong chat, a channel that restricts saving content) must not read as a
+# deleted post.
+MESSAGE_NOT_FOUND_ERRORS = ('message to forward not found', 'message_id_invalid')
+# The post file and its manifest entry, more with mirrored media: storage
+# batches count actions, pages count messages.
+ACTIONS_PER_POST = 2
+
+logger = logging.getLogger(__name__)
+
+
+def forward_channel_message(bot: Bot, message_id: int,
+                            channel_id: int) -> Optional[Message]:
+    # The Bot API cannot read channel history, so a channel message is read
+    # by forwarding it to BACKFILL_CHAT_ID and deleting the copy right away.
+    while True:
+        try:
+            message = bot.forward_message(
+                chat_id=BACKFILL_CHAT_ID,
+                from_chat_id=channel_id,
+                message_id=message_id,
+                disable_notification=True,
+            )
+        except RetryAfter as e:
+            time.sleep(e.retry_after)
+            continue
+        except BadRequest as e:
+            if any(error in e.message.lower() for error in MESSAGE_NOT_FOUND_ERRORS):
+                return None
+            raise
+        bot.delete_message(
+            chat_id=BACKFILL_CHAT_ID,
+            message_id=message.message_id,
+        )
+        return message
+
+
+@dataclass
+class Backfill:
+    # Every channel message id is forwarded; the forward carries the full
+    # message and is rendered the same way as posts forwarded to the bot by
+    # hand.
+    telegram_bot: TelegramBot
+    route: Route
+    storage: Storage
+    first_id: int
+    last_id: int
+    concurrency: int = BACKFILL_CONCURRENCY
+    page_size: int = BACKFILL_PAGE_SIZE
+    checkpoint_path: Path = Path(BACKFILL_CHECKPOINT_PATH)
+    mirror: Optional[MediaMirror] = None
+
+    @property
+    def bot(self):
+        return self.telegram_bot.bot
+
+    def load_checkpoint(self):
+        if not self.checkpoint_path.exists():
+            return self.first_id
+        checkpoint = json.loads(self.checkpoint_path.read_text())
+        return max(checkpoint['next_id'], self.first_id)
+
+    def save_checkpoint(self, next_id: int):
+        tmp_path = self.checkpoint_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps({'next_id': next_id}))
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def forward(self, message_id: int) -> Optional[Message]:
+        return forward_channel_message(self.bot, message_id, self.route.channel_id)
+
+    def list_posts(self) -> set[str]:
+        return set(self.storage.list_files(self.route.post_file_path.partition('{}')[0]))
+
+    def write(self, post: Post, post_paths: set[str]):
+        # Against one listing of the posts, so that new posts are not read.
+        gitlab_post = GitlabPost.from_post(post, storage=self.storage,
+                                           mirror=self.mirror,
+                                           path_template=self.route.post_file_path)
+        gitlab_post.create_or_update(is_update=gitlab_post.file_path in post_paths)
+
+    def get_posts(self, messages: list[Message]):
+        # Grouped the way the webhook path does before anything is left out:
+        # posts without any text, which Reconcile would delete again.
+        media_groups: dict[str, list[Message]] = {}
+        for message in messages:
+            if message.media_group_id:
+                media_groups.setdefault(message.media_group_id, []).append(message)
+            elif message.text or message.caption:
+                yield Post.from_message(message)
+        for media_group in media_groups.values():
+            if any(m.text or m.caption for m in media_group):
+                yield Post.from_media_group(media_group)
+
+    def run(self):
+        next_id = self.load_checkpoint()
+        # Read once instead of an entry per post.
+        get_manifest(self.storage).load()
+        post_paths = self.list_posts()
+        # An album at the end of a page, which may go on in the next one.
+        open_album: list[Message] = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while next_id <= self.last_id:
+                page_end = min(next_id + self.page_size, self.last_id + 1)
+                messages = open_album + [
+                    m for m in executor.map(self.forward, range(next_id, page_end)) if m
+                ]
+                open_album = []
+                last = messages[-1] if messages else None
+                if last and last.media_group_id and page_end <= self.last_id:
+                    open_album = [m for m in messages if m.media_group_id == last.media_group_id]
+                    messages = [m for m in messages if m.media_group_id != last.media_group_id]
+                posts = list(self.get_posts(messages))
+                list(executor.map(partial(self.write, post_paths=post_paths), posts))
+                self.storage.flush()
+                # A restart forwards the open album again.
+                self.save_checkpoint(
+                    open_album[0].forward_from_message_id if open_album else page_end
+                )
+                logger.info('Imported %s posts from #%s-#%s',
+                            len(posts), next_id, page_end - 1)
+                next_id = page_end
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('first_id', type=int)
+    parser.add_argument('last_id', type=int)
+    parser.add_argument('--channel-id', type=int)
+    parser.add_argument('--concurrency', type=int, default=BACKFILL_CONCURRENCY)
+    parser.add_argument('--page-size', type=int, default=BACKFILL_PAGE_SIZE)
+    parser.add_argument('--checkpoint', type=Path,
+                        default=Path(BACKFILL_CHECKPOINT_PATH))
+    args = parser.parse_args()
+    telegram_bot = TelegramBot.get_instance()
+    routing = telegram_bot.routing
+    route = routing.get(args.channel_id) if args.channel_id else routing.default
+    if not route:
+        parser.error(f'no route for channel {args.channel_id}')
+    storage = route.create_storage(batch_size=args.page_size * ACTIONS_PER_POST)
+    Backfill(
+        telegram_bot=telegram_bot,
+        route=route,
+        storage=storage,
+        first_id=args.first_id,
+        last_id=args.last_id,
+        concurrency=args.concurrency,
+        page_size=args.page_size,
+        checkpoint_path=args.checkpoint,
+        mirror=MediaMirror(bot=telegram_bot.bot, storage=storage) if MEDIA_MIRROR else None,
+    ).run()
@@ -0,0 +1,404 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from itertools import count
+from pathlib import Path
+from queue import Queue
+from statistics import median
+from tempfile import TemporaryDirectory
+from typing import TYPE_CHECKING, Iterable
+from unittest.mock import patch
+
+# The chats the recorded updates come from. Offline runs use them and a fake
+# token whatever the environment says; the defaults are only there so that
+# the bot modules can be imported.
+FIXTURE_CHANNEL_ID = -1001
+FIXTURE_LOG_CHAT_ID = -1002
+OFFLINE_BOT_TOKEN = '123456:benchmark'
+
+os.environ.setdefault('BOT_TOKEN', OFFLINE_BOT_TOKEN)
+os.environ.setdefault('CHANNEL_ID', str(FIXTURE_CHANNEL_ID))
+os.environ.setdefault('LOG_CHAT_ID', str(FIXTURE_LOG_CHAT_ID))
+
+if TYPE_CHECKING:
+    from fakes import FakeGitlab, FakeTelegram
+    from routing import Route
+    from storage import Storage
+    from telegram_bot import TelegramBot
+
+FIXTURES_DIR = Path(__file__).parent / 'fixtures'
+
+BENCHMARKS = {}
+
+# Import time budgets (ms) for what a cold instance loads on the way to its
+# response: a call the GCF entry point rejects, which must not get as far as
+# the bot, and the update path, which needs telegram.ext but nothing else
+# heavy.
+IMPORT_TIME_PATHS = {
+    'main': 'import main; main.main(SimpleNamespace('
+            'method="POST", headers={}, get_json=lambda **kwargs: {"token": "x"}))',
+    'telegram_bot': 'import telegram_bot',
+}
+IMPORT_TIME_BUDGETS_MS = {
+    'main': float(os.environ.get('IMPORT_TIME_BUDGET_MAIN_MS', 25)),
+    'telegram_bot': float(os.environ.get('IMPORT_TIME_BUDGET_BOT_MS', 1500)),
+}
+LAZY_MODULES = ('lxml', 'yaml', 'requests', 'sqlite3')
+# Only loaded once a call is let through.
+BOT_MODULES = ('telegram', 'telegram_bot')
+IMPORT_TIME_MARKER = '# path'
+IMPORT_TIME_RE = re.compile(r'^import time:\s+\d+ \|\s+(?P<cumulative>\d+) \| (?P<module>\S+)$')
+
+LEGACY_XPATHS = {
+    'text': '//div[contains(@class, "js-message_text")]',
+    'default_media': '//div[contains(@class, "js-message_text")]'
+                     '/preceding-sibling::div[contains(@class, "js-message")]',
+    'photo_media': '//div[contains(@class, "js-message_text")]'
+                   '/preceding-sibling::a[contains(@class, "photo")]',
+}
+
+# Stale content of a post that exists before an edit or a delete is replayed.
+STALE_CONTENT = '---\ncontent_hash: stale\n---\n'
+UNLIMITED_RATE = (1e9, 1e9)
+# Albums are replayed as concurrent deliveries, so the coalescing window only
+# has to cover thread start-up.
+E2E_MEDIA_GROUP_WINDOW = float(os.environ.get('E2E_MEDIA_GROUP_WINDOW', 0.05))
+E2E_STORAGE_BACKENDS = os.environ.get(
+    'E2E_STORAGE_BACKENDS',
+    'gitlab,filesystem,git' if shutil.which('git') else 'gitlab,filesystem',
+).split(',')
+
+UNHANDLED_UPDATE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': 1, 'type': 'private'},
+        'text': 'ping',
+    },
+}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def report(name: str, timings: list[float]):
+    timings_ms = sorted(t * 1000 for t in timings)
+    print(f'{name:<32} '
+          f'n={len(timings_ms):<5} '
+          f'min={timings_ms[0]:.3f}ms '
+          f'median={median(timings_ms):.3f}ms '
+          f'max={timings_ms[-1]:.3f}ms')
+
+
+def percentile(timings: list[float], q: float):
+    # Nearest rank on sorted timings.
+    return timings[min(len(timings) - 1, int(len(timings) * q))]
+
+
+def report_percentiles(name: str, timings: list[float], peaks: list[int]):
+    timings_ms = sorted(t * 1000 for t in timings)
+    print(f'{name:<32} '
+          f'n={len(timings_ms):<5} '
+          f'p50={percentile(timings_ms, 0.5):.3f}ms '
+          f'p95={percentile(timings_ms, 0.95):.3f}ms '
+          f'p99={percentile(timings_ms, 0.99):.3f}ms '
+          f'throughput={len(timings) / sum(timings):.1f}/s '
+          f'peak={max(peaks) / 1024:.1f}KiB')
+
+
+def measure(func, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+@benchmark
+def cold_vs_warm(repeat: int = 200):
+    import telegram_bot_base
+    from telegram import Update
+    from telegram_bot import TelegramBot
+
+    def cold():
+        telegram_bot = TelegramBot()
+        update = Update.de_json(UNHANDLED_UPDATE, telegram_bot.bot)
+        telegram_bot.dispatcher.process_update(update)
+
+    update_ids = iter(range(1, sys.maxsize))
+
+    def warm():
+        TelegramBot.process_webhook_request({
+            **UNHANDLED_UPDATE,
+            'update_id': next(update_ids),
+        })
+
+    telegram_bot_base._instances.clear()
+    report('cold (new bot per call)', measure(cold, repeat))
+    TelegramBot.get_instance()
+    report('warm (shared instance)', measure(warm, repeat))
+
+
+def legacy_embed_parts(element):
+    from lxml import etree
+    return {
+        name: [etree.tostring(o).decode('utf-8') for o in element.xpath(xpath)]
+        for name, xpath in LEGACY_XPATHS.items()
+    }
+
+
+@benchmark
+def xpath_extraction(repeat: int = 500):
+    from lxml.html import document_fromstring
+    from post import extract_embed_parts
+
+    for page in sorted((FIXTURES_DIR / 'embed').glob('*.html')):
+        element = document_fromstring(page.read_text())
+        report(f'{page.stem}: string xpath',
+               measure(lambda: legacy_embed_parts(element), repeat))
+        report(f'{page.stem}: precompiled',
+               measure(lambda: extract_embed_parts(element), repeat))
+
+
+@dataclass
+class Scenario:
+    # Recorded updates delivered together, the post they touch and whether
+    # its file exists in the repository before and after the replay.
+    updates: list[dict]
+    post_id: int
+    exists_before: bool = False
+    exists_after: bool = True
+
+
+def load_scenarios():
+    scenarios = {
+        'text': (101, False, True),
+        'photo': (102, False, True),
+        'album': (103, False, True),
+        'edit': (101, True, True),
+        'delete': (101, True, False),
+    }
+    return {
+        name: Scenario(
+            updates=json.loads((FIXTURES_DIR / 'updates' / f'{name}.json').read_text()),
+            post_id=post_id,
+            exists_before=exists_before,
+            exists_after=exists_after,
+        )
+        for name, (post_id, exists_before, exists_after) in scenarios.items()
+    }
+
+
+@dataclass
+class OfflineRun:
+    telegram_bot: 'TelegramBot'
+    gitlab: 'FakeGitlab'
+    telegram: 'FakeTelegram'
+    storage: 'Storage'
+    executor: ThreadPoolExecutor
+
+    def __post_init__(self):
+        self._update_ids = count(1)
+        self._replay_ids = count(1)
+
+    def get_file_path(self, scenario: Scenario):
+        from gitlab_post import GitlabPost
+        return GitlabPost.from_id(scenario.post_id, self.storage).file_path
+
+    def prepare(self, scenario: Scenario):
+        from gitlab_batch import PendingAction
+        from manifest import ManifestEntry, get_manifest
+        manifest = get_manifest(self.storage)
+        file_path = self.get_file_path(scenario)
+        exists = manifest.get(scenario.post_id) is not None
+        if scenario.exists_before:
+            manifest.write(
+                scenario.post_id,
+                ManifestEntry(title='Stale', date='', path=file_path,
+                              content_hash='stale'),
+                PendingAction('update' if exists else 'create', file_path,
+                              STALE_CONTENT, 'Prepare'),
+            )
+        elif exists:
+            manifest.write(scenario.post_id, None,
+                           PendingAction('delete', file_path, None, 'Prepare'))
+
+    def replay(self, scenario: Scenario):
+        # Every delivery gets a fresh update_id and media_group_id, or it
+        # would be dropped as a duplicate of the previous replay.
+        replay_id = next(self._replay_ids)
+        updates = []
+        for update in scenario.updates:
+            update = {**update, 'update_id': next(self._update_ids)}
+            if media_group_id := update.get('channel_post', {}).get('media_group_id'):
+                update['channel_post'] = {
+                    **update['channel_post'],
+                    'media_group_id': f'{media_group_id}{replay_id}',
+                }
+            updates.append(update)
+        process = self.telegram_bot.process_webhook_request
+        list(self.executor.map(process, updates))
+
+    def check(self, scenario: Scenario):
+        # Handler errors are only logged by the dispatcher.
+        content = self.storage.read(self.get_file_path(scenario))
+        if scenario.exists_after != (content not in (None, STALE_CONTENT)):
+            raise AssertionError(f'post {scenario.post_id} not synced: {content!r}')
+
+    def run(self, scenario: Scenario):
+        self.prepare(scenario)
+        start = time.perf_counter()
+        self.replay(scenario)
+        elapsed = time.perf_counter() - start
+        self.check(scenario)
+        return elapsed
+
+    def run_traced(self, scenario: Scenario):
+        # Peak of memory allocated during the replay, fakes included, since
+        # they share the process.
+        self.prepare(scenario)
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        self.replay(scenario)
+        _, peak = tracemalloc.get_traced_memory()
+        self.check(scenario)
+        return peak - current
+
+
+def create_offline_storage(backend: str, gitlab: 'FakeGitlab', path: str):
+    from storage import FileSystemStorage, GitStorage, GitlabStorage
+    if backend == 'gitlab':
+        return GitlabStorage(base_url=gitlab.files_url, commits_url=gitlab.commits_url,
+                             tree_url=gitlab.tree_url, archive_url=gitlab.archive_url)
+    if backend == 'filesystem':
+        return FileSystemStorage(path)
+    subprocess.run(['git', 'init', '--quiet', path], check=True)
+    for key, value in (('user.name', 'benchmark'), ('user.email', 'benchmark@localhost')):
+        subprocess.run(['git', '-C', path, 'config', key, value], check=True)
+    return GitStorage(path, remote=None)
+
+
+@contextmanager
+def offline_run(backend: str = 'gitlab', routes: Iterable['Route'] = ()):
+    # The webhook path against local stand-ins for the Bot API, GitLab and
+    # t.me, with rate limits lifted and updates processed synchronously.
+    # Non-GitLab storage backends write to a temporary directory. The
+    # recorded channel is routed there, `routes` are added.
+    import http_client
+    import telegram_bot_base
+    from coalescer import Coalescer
+    from fakes import FakeEmbedAdapter, FakeGitlab, FakeTelegram
+    from log_sink import LogSink
+    from rate_limit import RateLimiter
+    from routing import Route, RoutingTable
+    from telegram.ext import Dispatcher
+    from telegram_bot import TelegramBot
+    from update_store import MemoryUpdateStore
+
+    session = http_client.create_session()
+    session.mount('https://t.me/', FakeEmbedAdapter.from_dir(FIXTURES_DIR / 'embed'))
+    limiter = RateLimiter(limits={'telegram': UNLIMITED_RATE, 'http': UNLIMITED_RATE})
+    with FakeGitlab() as gitlab, FakeTelegram() as telegram, \
+            TemporaryDirectory() as path, \
+            ThreadPoolExecutor(max_workers=8) as executor, \
+            patch('http_client._session', session), \
+            patch('rate_limit._limiter', limiter), \
+            patch('update_store._store', MemoryUpdateStore()), \
+            patch('async_pipeline.ASYNC_UPDATES', False), \
+            patch.dict(telegram_bot_base._instances, clear=True):
+        storage = create_offline_storage(backend, gitlab, path)
+        bot = telegram_bot_base.RateLimitedBot(
+            token=OFFLINE_BOT_TOKEN,
+            base_url=telegram.bot_api_url,
+        )
+        telegram_bot = TelegramBot(
+            dispatcher=Dispatcher(bot=bot, update_queue=Queue()),
+            log_sink=LogSink(bot=bot, rate=UNLIMITED_RATE[0], burst=UNLIMITED_RATE[1]),
+            media_groups=Coalescer(window=E2E_MEDIA_GROUP_WINDOW),
+            edits=Coalescer(window=0),
+            routing=RoutingTable([
+                Route(channel_id=FIXTURE_CHANNEL_ID, log_chat_id=FIXTURE_LOG_CHAT_ID,
+                      storage=storage),
+                *routes,
+            ]),
+        )
+        telegram_bot_base._instances[TelegramBot] = telegram_bot
+        yield OfflineRun(
+            telegram_bot=telegram_bot,
+            gitlab=gitlab,
+            telegram=telegram,
+            storage=storage,
+            executor=executor,
+        )
+
+
+@benchmark
+def end_to_end(repeat: int = 200, traced_repeat: int = 20):
+    scenarios = load_scenarios()
+    for backend in E2E_STORAGE_BACKENDS:
+        with offline_run(backend) as run:
+            for name, scenario in scenarios.items():
+                timings = [run.run(scenario) for _ in range(repeat)]
+                tracemalloc.start()
+                try:
+                    peaks = [run.run_traced(scenario) for _ in range(traced_repeat)]
+                finally:
+                    tracemalloc.stop()
+                report_percentiles(f'{backend}: {name}', timings, peaks)
+            run.storage.flush()
+
+
+def measure_import(path: str):
+    # A fresh interpreter per measurement: -X importtime reports the
+    # cumulative time of every import, in microseconds; the top-level ones
+    # after the marker add up to the time the path spent importing.
+    lazy_modules = LAZY_MODULES + (BOT_MODULES if path == 'main' else ())
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c',
+         f'import json, sys; from types import SimpleNamespace; '
+         f'print({IMPORT_TIME_MARKER!r}, file=sys.stderr, flush=True); '
+         f'{IMPORT_TIME_PATHS[path]}; '
+         f'print(json.dumps([m for m in {lazy_modules!r} if m in sys.modules]))'],
+        cwd=Path(__file__).parent,
+        env={**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    _, _, path_imports = result.stderr.partition(f'{IMPORT_TIME_MARKER}\n')
+    cumulative_ms = sum(
+        int(match['cumulative']) / 1000
+        for line in path_imports.splitlines()
+        if (match := IMPORT_TIME_RE.match(line))
+    )
+    return cumulative_ms, json.loads(result.stdout)
+
+
+@benchmark
+def import_time(repeat: int = 5):
+    for path, budget_ms in IMPORT_TIME_BUDGETS_MS.items():
+        timings, loaded = [], []
+        for _ in range(repeat):
+            cumulative_ms, loaded = measure_import(path)
+            timings.append(cumulative_ms / 1000)
+        report(f'import {path}', timings)
+        print(f'{"":<32} budget={budget_ms:.0f}ms eagerly loaded={loaded}')
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f'# {name}')
+        BENCHMARKS[name]()
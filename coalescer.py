@@ -0,0 +1,104 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from threading import Lock, Timer
+from typing import Any, Callable, Hashable, Optional
+
+CLOSED_KEYS_LIMIT = 1024
+
+
+@dataclass
+class Batch:
+    deadline: float
+    items: list = field(default_factory=list)
+    callback: Optional[Callable[[list], Any]] = None
+
+
+class Coalescer:
+    # The first caller for a key becomes the batch leader: it waits until the
+    # window is over and gets every item collected meanwhile. Other callers
+    # only append their item and get None back. A sliding window restarts on
+    # every new item, i.e. the leader waits for a quiet period (debounce).
+    # `schedule` is the same without a leader that waits: the batch is handed
+    # to a callback from a timer thread.
+    def __init__(self, window: float, sliding: bool = False,
+                 remember_closed: bool = True):
+        self.window = window
+        self.sliding = sliding
+        self.remember_closed = remember_closed
+        self._batches: dict[Hashable, Batch] = {}
+        self._closed: OrderedDict[Hashable, None] = OrderedDict()
+        self._lock = Lock()
+
+    def open(self, key: Hashable, item: Any,
+             callback: Callable[[list], Any] = None) -> Optional[Batch]:
+        # Returns the batch if the item started it.
+        with self._lock:
+            if key in self._closed:
+                return None
+            if batch := self._batches.get(key):
+                batch.items.append(item)
+                if self.sliding:
+                    batch.deadline = time.monotonic() + self.window
+                return None
+            batch = self._batches[key] = Batch(
+                deadline=time.monotonic() + self.window,
+                items=[item],
+                callback=callback,
+            )
+            return batch
+
+    def close(self, key: Hashable, batch: Batch) -> bool:
+        # Called with the lock held.
+        if self._batches.get(key) is not batch:
+            return False
+        del self._batches[key]
+        if self.remember_closed:
+            self._closed[key] = None
+            if len(self._closed) > CLOSED_KEYS_LIMIT:
+                self._closed.popitem(last=False)
+        return True
+
+    def add(self, key: Hashable, item: Any) -> Optional[list]:
+        if self.window <= 0:
+            return [item]
+        if not (batch := self.open(key, item)):
+            return None
+        while True:
+            time.sleep(max(batch.deadline - time.monotonic(), 0))
+            with self._lock:
+                if batch.deadline > time.monotonic():
+                    continue
+                self.close(key, batch)
+                return batch.items
+
+    def schedule(self, key: Hashable, item: Any, callback: Callable[[list], Any]):
+        if self.window <= 0:
+            callback([item])
+        elif batch := self.open(key, item, callback):
+            self.start_timer(key, batch)
+
+    def start_timer(self, key: Hashable, batch: Batch):
+        timer = Timer(max(batch.deadline - time.monotonic(), 0),
+                      self.on_timer, (key, batch))
+        timer.daemon = True
+        timer.start()
+
+    def on_timer(self, key: Hashable, batch: Batch):
+        with self._lock:
+            is_due = batch.deadline <= time.monotonic()
+            is_closed = is_due and self.close(key, batch)
+        if not is_due:
+            self.start_timer(key, batch)
+        elif is_closed:
+            batch.callback(batch.items)
+
+    def flush(self):
+        # Hands the scheduled batches over now, e.g. before shutting down.
+        with self._lock:
+            batches = [
+                batch for key, batch in list(self._batches.items())
+                if batch.callback and self.close(key, batch)
+            ]
+        for batch in batches:
+            batch.callback(batch.items)
@@ -0,0 +1,310 @@
+import io
+import json
+import re
+import tarfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from pathlib import Path
+from threading import Thread
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from requests import Response
+from requests.adapters import BaseAdapter
+
+GITLAB_PROJECT_PATH = '/api/v4/projects/1/repository'
+DATA_POST_RE = re.compile(r'data-post="(?P<post>[^"]+)"')
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler_class):
+        super().__init__(('127.0.0.1', 0), handler_class)
+        self.requests: list[tuple[str, str, object]] = []
+        self._thread = Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class JsonRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        body = b''
+        while size := int(self.rfile.readline(), 16):
+            body += self.rfile.read(size)
+            self.rfile.readline()
+        self.rfile.readline()
+        return body
+
+    def read_json(self):
+        return json.loads(self.read_body() or b'null')
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, text, status=200):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        raise NotImplementedError
+
+    def do_HEAD(self):
+        self.handle_request('HEAD')
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+class FakeGitlabHandler(JsonRequestHandler):
+    server: 'FakeGitlab'
+
+    def handle_request(self, method):
+        url = urlsplit(self.path)
+        path = url.path.removeprefix(GITLAB_PROJECT_PATH)
+        data = self.read_json() if method not in ('GET', 'HEAD') else None
+        self.server.requests.append((method, path, data))
+        files = self.server.files
+
+        if method == 'POST' and path == '/commits':
+            for action in data['actions']:
+                file_path = action['file_path']
+                if (action['action'] == 'create') == (file_path in files):
+                    return self.send_json(
+                        {'message': f'{file_path} conflicts with {action}'},
+                        status=400,
+                    )
+            for action in data['actions']:
+                if action['action'] == 'delete':
+                    del files[action['file_path']]
+                else:
+                    files[action['file_path']] = action['content']
+            self.server.commits.append(data)
+            return self.send_json({'id': str(len(self.server.commits))}, 201)
+
+        if method == 'GET' and path == '/tree':
+            return self.send_tree(parse_qs(url.query))
+
+        if method == 'GET' and path == '/archive.tar.gz':
+            return self.send_archive(parse_qs(url.query))
+
+        if not path.startswith('/files/'):
+            return self.send_json({'message': '404 Not Found'}, 404)
+        file_path = unquote(path.removeprefix('/files/'))
+        is_raw = file_path.endswith('/raw')
+        file_path = file_path.removesuffix('/raw')
+        exists = file_path in files
+        if method == 'HEAD':
+            self.send_response(200 if exists else 404)
+            self.end_headers()
+            return
+        if method == 'GET' and exists:
+            if is_raw:
+                return self.send_text(files[file_path])
+            return self.send_json({'file_path': file_path})
+        if method == 'POST' and not exists or method == 'PUT' and exists:
+            files[file_path] = data['content']
+            self.server.commits.append(data)
+            return self.send_json({'file_path': file_path}, 201)
+        if method == 'DELETE' and exists:
+            del files[file_path]
+            self.server.commits.append(data)
+            return self.send_json({}, 204)
+        if method == 'POST':
+            return self.send_json({'message': 'A file with this name already exists'}, 400)
+        return self.send_json({'message': '404 File Not Found'}, 404)
+
+    def send_tree(self, params):
+        # Recursive listing with offset pagination, blobs only.
+        prefix = f'{params.get("path", [""])[0]}/'.lstrip('/')
+        page, per_page = int(params['page'][0]), int(params['per_page'][0])
+        paths = sorted(p for p in self.server.files if p.startswith(prefix))
+        items = [
+            {'path': p, 'type': 'blob'}
+            for p in paths[(page - 1) * per_page:page * per_page]
+        ]
+        has_next = page * per_page < len(paths)
+        return self.send_json(items, headers={'X-Next-Page': str(page + 1) if has_next else ''})
+
+    def send_archive(self, params):
+        # The files below `path`, in a `<project>-<sha>-<path>` directory.
+        path = params.get('path', [''])[0]
+        prefix = f'{path}/'.lstrip('/')
+        paths = sorted(p for p in self.server.files if p.startswith(prefix))
+        if not paths:
+            return self.send_json({'message': '404 File Not Found'}, 404)
+        root = f'project-{len(self.server.commits)}-{path.replace("/", "-")}'
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+            for file_path in paths:
+                content = self.server.files[file_path].encode('utf-8')
+                info = tarfile.TarInfo(f'{root}/{file_path}')
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        body = buffer.getvalue()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeGitlab(FakeServer):
+    def __init__(self):
+        super().__init__(FakeGitlabHandler)
+        self.files: dict[str, str] = {}
+        self.commits: list[dict] = []
+
+    @property
+    def files_url(self):
+        return f'{self.base_url}{GITLAB_PROJECT_PATH}/files'
+
+    @property
+    def commits_url(self):
+        return f'{self.base_url}{GITLAB_PROJECT_PATH}/commits'
+
+    @property
+    def tree_url(self):
+        return f'{self.base_url}{GITLAB_PROJECT_PATH}/tree'
+
+    @property
+    def archive_url(self):
+        return f'{self.base_url}{GITLAB_PROJECT_PATH}/archive.tar.gz'
+
+
+class FakeTelegramHandler(JsonRequestHandler):
+    server: 'FakeTelegram'
+
+    def handle_request(self, method):
+        path = urlsplit(self.path).path
+        if path.startswith('/file/'):
+            return self.send_file(path)
+        _, _, endpoint = path.rpartition('/')
+        data = self.read_json() or {}
+        self.server.requests.append((method, endpoint, data))
+        self.send_json({'ok': True, 'result': self.server.get_result(endpoint, data)})
+
+    def send_file(self, path):
+        # /file/bot<token>/media/<file_id>.jpg
+        file_id = path.rpartition('/')[2].partition('.')[0]
+        self.server.requests.append(('GET', 'file', file_id))
+        body = self.server.files[file_id]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeTelegram(FakeServer):
+    # Bot API stand-in: methods returning a message get one echoing the
+    # request, getFile serves `files` by file id, everything else returns
+    # True.
+    MESSAGE_METHODS = frozenset([
+        'sendMessage',
+        'editMessageText',
+        'editMessageReplyMarkup',
+    ])
+
+    def __init__(self):
+        super().__init__(FakeTelegramHandler)
+        self.files: dict[str, bytes] = {}
+        self._message_ids = count(1)
+
+    @property
+    def bot_api_url(self):
+        return f'{self.base_url}/bot'
+
+    @property
+    def file_url(self):
+        return f'{self.base_url}/file/bot'
+
+    def get_result(self, endpoint: str, data: dict):
+        if endpoint == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Bot', 'username': 'bot'}
+        if endpoint == 'getFile':
+            file_id = data['file_id']
+            return {
+                'file_id': file_id,
+                'file_unique_id': file_id,
+                'file_size': len(self.files[file_id]),
+                'file_path': f'media/{file_id}.jpg',
+            }
+        if endpoint not in self.MESSAGE_METHODS:
+            return True
+        return {
+            'message_id': data.get('message_id') or next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(data['chat_id']), 'type': 'supergroup'},
+            'text': data.get('text', ''),
+        }
+
+    def calls(self, endpoint: str):
+        return [data for _, e, data in self.requests if e == endpoint]
+
+
+class FakeEmbedAdapter(BaseAdapter):
+    # Serves saved t.me `?embed=1` pages to a requests session, keyed by the
+    # `data-post` attribute of each page (`chan/101` for t.me/chan/101).
+    def __init__(self, pages: dict[str, str]):
+        super().__init__()
+        self.pages = pages
+        self.requests: list[str] = []
+
+    @classmethod
+    def from_dir(cls, path: Path):
+        pages = {}
+        for page in sorted(path.glob('*.html')):
+            text = page.read_text()
+            pages[DATA_POST_RE.search(text)['post']] = text
+        return cls(pages)
+
+    def send(self, request, **kwargs):
+        self.requests.append(request.url)
+        text = self.pages.get(urlsplit(request.url).path.strip('/'))
+        response = Response()
+        response.status_code = 200 if text is not None else 404
+        response.headers['Content-Type'] = 'text/html; charset=utf-8'
+        response.encoding = 'utf-8'
+        response._content = (text or 'Not Found').encode('utf-8')
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
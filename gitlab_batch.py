@@ -0,0 +1,204 @@
+import base64
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from threading import Lock, Timer
+from typing import BinaryIO, Callable, Optional
+from uuid import uuid4
+
+import http_client
+from timing import span
+
+
+def get_repository_url(base_url: str, endpoint: str):
+    # Other repository API URLs, from the files API URL.
+    return base_url and f'{base_url.removesuffix("/").removesuffix("/files")}/{endpoint}'
+
+
+GITLAB_API_TOKEN = os.environ.get('GITLAB_API_TOKEN')
+REPOSITORY_BASE_URL = os.environ.get('REPOSITORY_BASE_URL')
+REPOSITORY_COMMITS_URL = os.environ.get(
+    'REPOSITORY_COMMITS_URL',
+    get_repository_url(REPOSITORY_BASE_URL, 'commits'),
+)
+GITLAB_BATCH_SIZE = int(os.environ.get('GITLAB_BATCH_SIZE', 1))
+GITLAB_BATCH_INTERVAL = float(os.environ.get('GITLAB_BATCH_INTERVAL', 10))
+# Binary files are copied in chunks of this size; a multiple of 3, so that
+# base64 encoded chunks join up.
+BLOB_CHUNK_SIZE = 3 * 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PendingAction:
+    action: str
+    file_path: str
+    content: Optional[str]
+    commit_message: Optional[str]
+    on_commit: list[Callable] = field(default_factory=list)
+    # Binary content, stored instead of `content`.
+    file: Optional[BinaryIO] = field(default=None, repr=False)
+
+    def as_payload(self):
+        payload = {'action': self.action, 'file_path': self.file_path}
+        if self.content is not None:
+            payload['content'] = self.content
+        return payload
+
+
+def merge_actions(previous: PendingAction, action: PendingAction):
+    # Collapse two pending actions on the same file into the one action
+    # that has the same effect on the repository, or None if they cancel out.
+    on_commit = previous.on_commit + action.on_commit
+    if action.action == 'delete':
+        if previous.action == 'create':
+            return None
+        return PendingAction('delete', action.file_path, None,
+                             action.commit_message, on_commit)
+    if previous.action == 'create':
+        kind = 'create'
+    else:
+        kind = 'update'
+    return PendingAction(kind, action.file_path, action.content,
+                         action.commit_message, on_commit, action.file)
+
+
+class Base64JsonBody:
+    # A JSON payload with `files` as base64 strings, encoded chunk by chunk
+    # while the request is sent, so that they are never held in memory as a
+    # whole. In the payload each file is its placeholder string. Iterating
+    # again starts over, so the request can be retried.
+    def __init__(self, payload: dict, files: dict[str, BinaryIO]):
+        self.payload = payload
+        self.files = files
+
+    def __iter__(self):
+        body = json.dumps(self.payload)
+        for placeholder, file in self.files.items():
+            head, _, body = body.partition(json.dumps(placeholder))
+            yield f'{head}"'.encode('utf-8')
+            file.seek(0)
+            while chunk := file.read(BLOB_CHUNK_SIZE):
+                yield base64.b64encode(chunk)
+            yield b'"'
+        yield body.encode('utf-8')
+
+
+def get_commit_message(actions: list[PendingAction]):
+    # Actions without a message (index files) ride along with the others.
+    messages = [a.commit_message for a in actions if a.commit_message]
+    if len(messages) == 1:
+        return messages[0]
+    return '\n'.join([
+        f'Sync {len(messages)} tgposts',
+        '',
+        *messages,
+    ])
+
+
+class GitlabBatchWriter:
+    def __init__(
+            self,
+            max_actions: int = GITLAB_BATCH_SIZE,
+            interval: float = GITLAB_BATCH_INTERVAL,
+            commits_url: str = REPOSITORY_COMMITS_URL,
+            branch: str = 'master',
+    ):
+        self.max_actions = max_actions
+        self.interval = interval
+        self.commits_url = commits_url
+        self.branch = branch
+        self._pending: dict[str, PendingAction] = {}
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._timer: Optional[Timer] = None
+
+    @property
+    def auth_headers(self):
+        return {
+            'Authorization': 'Bearer {}'.format(GITLAB_API_TOKEN),
+        }
+
+    def add(self, *actions: PendingAction):
+        # Actions added together end up in the same commit.
+        with self._lock:
+            for action in actions:
+                if previous := self._pending.pop(action.file_path, None):
+                    action = merge_actions(previous, action)
+                if action:
+                    self._pending[action.file_path] = action
+            is_full = len(self._pending) >= self.max_actions
+            if not is_full and self._pending and not self._timer:
+                self._timer = Timer(self.interval, self.try_flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if is_full:
+            self.try_flush()
+
+    def try_flush(self):
+        # Failed batches are requeued, so the actions added are not lost.
+        try:
+            self.flush()
+        except ValueError:
+            logger.exception('Batched GitLab commit failed')
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+                actions = list(self._pending.values())
+                self._pending.clear()
+            if not actions:
+                return
+            try:
+                self.commit(actions)
+            except ValueError:
+                self.requeue(actions)
+                raise
+            for action in actions:
+                for callback in action.on_commit:
+                    callback()
+
+    def requeue(self, actions: list[PendingAction]):
+        with self._lock:
+            for action in actions:
+                if newer := self._pending.pop(action.file_path, None):
+                    action = merge_actions(action, newer)
+                if action:
+                    self._pending[action.file_path] = action
+
+    def commit(self, actions: list[PendingAction]):
+        payloads, files = [], {}
+        for action in actions:
+            payload = action.as_payload()
+            if action.file:
+                placeholder = uuid4().hex
+                payload.update(encoding='base64', content=placeholder)
+                files[placeholder] = action.file
+            payloads.append(payload)
+        payload = {
+            'branch': self.branch,
+            'commit_message': get_commit_message(actions),
+            'actions': payloads,
+        }
+        with span('gitlab_commit'):
+            if files:
+                response = http_client.request(
+                    method='POST',
+                    url=self.commits_url,
+                    data=Base64JsonBody(payload, files),
+                    headers={**self.auth_headers, 'Content-Type': 'application/json'},
+                )
+            else:
+                response = http_client.request(
+                    method='POST',
+                    url=self.commits_url,
+                    json=payload,
+                    headers=self.auth_headers,
+                )
+        if not response.ok:
+            raise ValueError(f'{len(actions)} actions: {response.text}')
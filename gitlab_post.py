@@ -1,32 +1,58 @@
+import hashlib
 import os
-from urllib.parse import quote_plus
+import re
+from typing import TYPE_CHECKING
 
-import requests
-import yaml
+from gitlab_batch import PendingAction
+from manifest import ManifestEntry, get_manifest
+from post import Post, memoized_property
+from storage import Storage, get_storage
+from timing import span
 
-from post import Post
+if TYPE_CHECKING:
+    from media_mirror import MediaMirror, MirroredMedia
 
-GITLAB_API_TOKEN = os.environ.get('GITLAB_API_TOKEN')
-REPOSITORY_BASE_URL = os.environ.get('REPOSITORY_BASE_URL')
 TG_POST_FILE_PATH = os.environ.get('TG_POST_FILE_PATH',
                                    'content/tgposts/{}/index.md')
 
+CONTENT_HASH_RE = re.compile(r'^content_hash: (?P<content_hash>\w+)$', re.MULTILINE)
+
+
+def dump_yaml(data: dict):
+    with span('yaml'):
+        import yaml
+        return yaml.dump(data)
+
 
 class GitlabPost:
-    branch: str = 'master'
     _post: Post = None
     _post_id: int = None
+    _storage: Storage = None
+    _mirror: 'MediaMirror' = None
+    _path_template: str = None
+
+    def __init__(self):
+        # Per instance: functools.cached_property locks all instances at
+        # once before Python 3.12, which would render one post at a time.
+        self._cache = {}
 
     @classmethod
-    def from_post(cls, post: Post):
+    def from_post(cls, post: Post, storage: Storage = None,
+                  mirror: 'MediaMirror' = None, path_template: str = None):
         gitlab_post = cls()
         gitlab_post._post = post
+        gitlab_post._storage = storage
+        gitlab_post._mirror = mirror
+        gitlab_post._path_template = path_template
         return gitlab_post
 
     @classmethod
-    def from_id(cls, post_id: int):
+    def from_id(cls, post_id: int, storage: Storage = None,
+                path_template: str = None):
         gitlab_post = cls()
-        gitlab_post._post_ = post_id
+        gitlab_post._post_id = int(post_id)
+        gitlab_post._storage = storage
+        gitlab_post._path_template = path_template
         return gitlab_post
 
     @property
@@ -38,20 +64,49 @@ class GitlabPost:
         return self._post
 
     @property
-    def auth_headers(self):
-        return {
-            'Authorization': 'Bearer {}'.format(GITLAB_API_TOKEN),
-        }
+    def storage(self):
+        return self._storage or get_storage()
 
     @property
-    def url(self):
-        filepath = TG_POST_FILE_PATH.format(self.post_id)
-        url = '{}/{}'.format(REPOSITORY_BASE_URL, quote_plus(filepath))
-        return url
+    def manifest(self):
+        return get_manifest(self.storage)
 
     @property
-    def front_matter(self):
-        return yaml.dump({
+    def file_path(self):
+        # Posts stay where they were written, even if the template changed.
+        if entry := self.manifest.get(self.post_id):
+            return entry.path
+        return (self._path_template or TG_POST_FILE_PATH).format(self.post_id)
+
+    @memoized_property
+    def media(self) -> list['MirroredMedia']:
+        if not self._mirror or not self.post.contains_media:
+            return []
+        from media_mirror import MirroredMedia
+
+        entry = self.manifest.get(self.post_id)
+        media = self._mirror.mirror(self.post.media_group,
+                                    known=entry.media if entry else None)
+        if not entry or not entry.media_group:
+            return media
+        # An edit of one album message: the others keep their media.
+        message_ids = set(self.post.message_ids)
+        media += [
+            MirroredMedia(m['type'], m['file_unique_id'], path, m['message_id'])
+            for m in entry.media_group
+            if m['message_id'] not in message_ids
+            and (path := entry.media.get(m['file_unique_id']))
+        ]
+        return sorted(media, key=lambda m: m.message_id)
+
+    @property
+    def media_actions(self):
+        # New media files, committed with the post.
+        return [m.action for m in self.media if m.action]
+
+    @property
+    def front_matter_data(self):
+        data = {
             'post_id': self.post_id,
             'title': self.post.title,
             'date': self.post.date,
@@ -59,49 +114,88 @@ class GitlabPost:
             'link': self.post.message_link,
             'html': '',
             'media_html': self.post.media_html,
+        }
+        if media := self.media:
+            data['media'] = [{'type': m.type, 'path': m.path} for m in media]
+        return data
+
+    @memoized_property
+    def content_hash(self):
+        # edit_date changes on every edit, so it is left out of the hash to
+        # let edits that do not change the rendered post be detected.
+        data = self.front_matter_data
+        data.pop('edit_date')
+        payload = f'{dump_yaml(data)}\n{self.post.html}'
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @property
+    def front_matter(self):
+        return dump_yaml({
+            **self.front_matter_data,
+            'content_hash': self.content_hash,
         })
 
-    def get(self):
-        response = requests.get(
-            url=self.url,
-            headers=self.auth_headers,
+    @memoized_property
+    def content(self):
+        return f'---\n{self.front_matter}\n---\n{self.post.html}\n'
+
+    @memoized_property
+    def last_content_hash(self):
+        if entry := self.manifest.get(self.post_id):
+            return entry.content_hash
+        # Posts synced before the manifest existed.
+        if (content := self.storage.read(self.file_path)) is None:
+            return None
+        if match := CONTENT_HASH_RE.search(content):
+            return match['content_hash']
+
+    @property
+    def manifest_entry(self):
+        entry = ManifestEntry(
+            title=self.post.title,
+            date=self.post.date.isoformat(),
+            path=self.file_path,
+            content_hash=self.content_hash,
+            media={m.file_unique_id: m.path for m in self.media},
         )
-        if response.status_code == requests.codes.not_found:
-            pass
+        if self.post.media_group_id:
+            # An edit of one message keeps the other messages of the album.
+            last_entry = self.manifest.get(self.post_id)
+            entry.message_ids = sorted({
+                *self.post.message_ids,
+                *(last_entry.message_ids if last_entry else ()),
+            })
+            entry.media_group = [
+                {'message_id': m.message_id, 'type': m.type, 'file_unique_id': m.file_unique_id}
+                for m in self.media
+            ]
+        return entry
 
     def create_or_update(self, is_update=False):
         post = self.post
+        if is_update and self.content_hash == self.last_content_hash:
+            return False
 
         action = 'Create new' if not is_update else 'Update'
-        commit_message = f'{action} tgpost {self.post_id}: [{post.date}]: {post.title}'
-
-        payload = {
-            'branch': self.branch,
-            'content': f'---\n{self.front_matter}\n---\n{post.html}\n',
-            'commit_message': commit_message,
-        }
-
-        response = requests.request(
-            method='PUT' if is_update else 'POST',
-            url=self.url,
-            json=payload,
-            headers=self.auth_headers,
+        self.manifest.update(
+            {self.post_id: self.manifest_entry},
+            PendingAction(
+                action='update' if is_update else 'create',
+                file_path=self.file_path,
+                content=self.content,
+                commit_message=f'{action} tgpost {self.post_id}: [{post.date}]: {post.title}',
+            ),
+            *self.media_actions,
         )
-        if not response.ok:
-            raise ValueError(f'{self.post_id}: {response.text}')
+        return True
 
     def delete(self):
-        commit_message = f'Delete tgpost {self.post_id}'
-
-        payload = {
-            'branch': self.branch,
-            'commit_message': commit_message,
-        }
-
-        response = requests.delete(
-            url=self.url,
-            json=payload,
-            headers=self.auth_headers,
-        )
-        if not response.ok:
-            raise ValueError(f'{self.post_id}: {response.text}')
+        # Already gone after an attempt that failed later on.
+        if not self.manifest.get(self.post_id) and not self.storage.exists(self.file_path):
+            return
+        self.manifest.write(self.post_id, None, PendingAction(
+            action='delete',
+            file_path=self.file_path,
+            content=None,
+            commit_message=f'Delete tgpost {self.post_id}',
+        ))
@@ -0,0 +1,88 @@
+import os
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import partial
+from threading import Lock
+from typing import TYPE_CHECKING, Optional
+from urllib.parse import urlsplit
+
+from rate_limit import get_limiter
+
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 10))
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Methods that can be repeated with the same effect, so they are retried on
+# timeouts and server errors. Others (file creates, commits) only if they
+# were throttled or could not connect.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+if TYPE_CHECKING:
+    import requests
+
+_session: 'requests.Session' = None
+_session_lock = Lock()
+
+
+def create_session():
+    # requests is imported on first use to keep it out of cold starts that
+    # never talk to t.me or GitLab.
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    # Retries are done by the shared rate limiter, not by urllib3.
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def get_retry_after(response: 'requests.Response',
+                    idempotent: bool = True) -> Optional[float]:
+    if response.status_code not in RETRY_STATUSES:
+        return None
+    if not idempotent and response.status_code != 429:
+        return None
+    if not (retry_after := response.headers.get('Retry-After')):
+        return 0
+    if retry_after.isdigit():
+        return float(retry_after)
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return 0
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+def request(method: str, url: str, **kwargs):
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    idempotent = method in IDEMPOTENT_METHODS
+    return get_limiter().call(
+        f'http:{urlsplit(url).hostname}',
+        get_session().request,
+        method=method,
+        url=url,
+        result_retry_after=partial(get_retry_after, idempotent=idempotent),
+        idempotent=idempotent,
+        **kwargs,
+    )
+
+
+def get(url: str, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def delete(url: str, **kwargs):
+    return request('DELETE', url, **kwargs)
@@ -0,0 +1,206 @@
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from threading import Lock, Timer
+from typing import Optional
+
+from telegram import Bot, InlineKeyboardMarkup, Message
+from telegram.error import RetryAfter
+
+from rate_limit import TokenBucket
+from timing import span
+
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', 2))
+LOG_FLUSH_LINES = int(os.environ.get('LOG_FLUSH_LINES', 20))
+# Telegram allows about 20 messages per minute in a group chat.
+LOG_CHAT_RATE = float(os.environ.get('LOG_CHAT_RATE', 1 / 3))
+LOG_CHAT_BURST = float(os.environ.get('LOG_CHAT_BURST', 3))
+MESSAGE_LENGTH_LIMIT = 4096
+# A tag, an entity or a run of plain text.
+HTML_TOKEN_RE = re.compile(r'<[^>]*>|&[^;\s]*;|[^<&]+|[<&]')
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class LogLine:
+    text: str
+    silent: bool = True
+    # Lines with buttons are sent as messages of their own.
+    reply_markup: Optional[InlineKeyboardMarkup] = None
+
+
+@dataclass
+class LogChat:
+    bucket: TokenBucket
+    lines: list[LogLine] = field(default_factory=list)
+    series: bool = False
+    series_message: Optional[Message] = None
+    timer: Optional[Timer] = None
+    # Held while the lines are sent, which waits for the chat's bucket.
+    flush_lock: Lock = field(default_factory=Lock)
+
+
+class LogSink:
+    # Buffers log lines per chat and sends them as few messages as possible,
+    # from a timer thread per chat, so that neither the callers nor the
+    # other chats wait for a chat's rate limit. In series mode lines are
+    # appended to one message, which is edited once per flush instead of
+    # once per line, and a new message is started when the text would not
+    # fit into one.
+    def __init__(
+            self,
+            bot: Bot,
+            interval: float = LOG_FLUSH_INTERVAL,
+            max_lines: int = LOG_FLUSH_LINES,
+            rate: float = LOG_CHAT_RATE,
+            burst: float = LOG_CHAT_BURST,
+    ):
+        self.bot = bot
+        self.interval = interval
+        self.max_lines = max_lines
+        self.rate = rate
+        self.burst = burst
+        self._chats: dict[int, LogChat] = {}
+        self._lock = Lock()
+
+    def get_chat(self, chat_id: int):
+        if (chat := self._chats.get(chat_id)) is None:
+            chat = self._chats[chat_id] = LogChat(
+                bucket=TokenBucket(rate=self.rate, capacity=self.burst),
+            )
+        return chat
+
+    def write(self, chat_id: int, text: str, silent: bool = True):
+        self.add(chat_id, LogLine(truncate(text), silent))
+
+    def send(self, chat_id: int, text: str, silent: bool = True,
+             reply_markup: InlineKeyboardMarkup = None):
+        self.add(chat_id, LogLine(truncate(text), silent, reply_markup))
+
+    def add(self, chat_id: int, line: LogLine):
+        if self.interval <= 0:
+            with self._lock:
+                self.get_chat(chat_id).lines.append(line)
+            return self.flush(chat_id)
+        with self._lock:
+            chat = self.get_chat(chat_id)
+            chat.lines.append(line)
+            is_full = len(chat.lines) >= self.max_lines
+            if chat.timer and not is_full:
+                return
+            if chat.timer:
+                chat.timer.cancel()
+            chat.timer = Timer(0 if is_full else self.interval, self.flush, (chat_id,))
+            chat.timer.daemon = True
+            chat.timer.start()
+
+    def start_series(self, chat_id: int):
+        self.set_series(chat_id, True)
+
+    def end_series(self, chat_id: int):
+        self.set_series(chat_id, False)
+
+    def set_series(self, chat_id: int, series: bool):
+        self.flush(chat_id)
+        with self._lock:
+            chat = self.get_chat(chat_id)
+        with chat.flush_lock:
+            chat.series = series
+            chat.series_message = None
+
+    def call(self, chat: LogChat, method, **kwargs):
+        while True:
+            chat.bucket.acquire()
+            try:
+                with span('log_send'):
+                    return method(**kwargs)
+            except RetryAfter as e:
+                logger.warning('Log chat throttled for %ss', e.retry_after)
+                chat.bucket.block(e.retry_after)
+
+    def flush(self, chat_id: int = None):
+        with self._lock:
+            chats = [(i, c) for i, c in self._chats.items() if chat_id in (None, i)]
+        for i, chat in chats:
+            with chat.flush_lock:
+                with self._lock:
+                    if chat.timer:
+                        chat.timer.cancel()
+                        chat.timer = None
+                    lines, chat.lines = chat.lines, []
+                if lines:
+                    self.flush_lines(i, chat, lines)
+
+    def flush_lines(self, chat_id: int, chat: LogChat, lines: list[LogLine]):
+        message = chat.series_message if chat.series else None
+        text = message.text_html if message else ''
+        silent = True
+        for line in lines:
+            if line.reply_markup:
+                if text:
+                    self.emit(chat_id, chat, message, text, silent)
+                self.call(chat, self.bot.send_message,
+                          chat_id=chat_id,
+                          text=line.text,
+                          parse_mode='HTML',
+                          disable_notification=line.silent,
+                          reply_markup=line.reply_markup)
+                message, text, silent = None, '', True
+                continue
+            if text and len(text) + 1 + len(line.text) > MESSAGE_LENGTH_LIMIT:
+                self.emit(chat_id, chat, message, text, silent)
+                message, text, silent = None, '', True
+            text = f'{text}\n{line.text}' if text else line.text
+            silent = silent and line.silent
+        if text:
+            message = self.emit(chat_id, chat, message, text, silent)
+        chat.series_message = message if chat.series else None
+
+    def emit(self, chat_id: int, chat: LogChat, message: Optional[Message],
+             text: str, silent: bool):
+        if message:
+            return self.call(chat, self.bot.edit_message_text,
+                             chat_id=chat_id,
+                             message_id=message.message_id,
+                             text=text,
+                             parse_mode='HTML')
+        return self.call(chat, self.bot.send_message,
+                         chat_id=chat_id,
+                         text=text,
+                         parse_mode='HTML',
+                         disable_notification=silent)
+
+
+def get_closing_tag(tag: str):
+    return f'</{tag[1:].split(maxsplit=1)[0].rstrip(">")}>'
+
+
+def truncate(text: str):
+    # Cuts the HTML text between tags and entities and closes the tags left
+    # open, so Telegram can still parse it.
+    if len(text) <= MESSAGE_LENGTH_LIMIT:
+        return text
+    parts, closing_tags = [], []
+    # Keeps room for the ellipsis and the closing tags.
+    room = MESSAGE_LENGTH_LIMIT - 1
+    for token in HTML_TOKEN_RE.findall(text):
+        if token.startswith('</') and token in closing_tags:
+            # Its room was kept already.
+            parts.append(token)
+            while closing_tags.pop() != token:
+                pass
+            continue
+        is_opening_tag = token.startswith('<') and token[1:2] not in ('', '/')
+        closing_tag = get_closing_tag(token) if is_opening_tag else ''
+        if len(token) + len(closing_tag) > room:
+            # Only plain text can be cut.
+            if not token.startswith(('<', '&')) or len(token) == 1:
+                parts.append(token[:room])
+            break
+        parts.append(token)
+        room -= len(token) + len(closing_tag)
+        if closing_tag:
+            closing_tags.append(closing_tag)
+    return ''.join(parts) + '…' + ''.join(reversed(closing_tags))
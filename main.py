@@ -1,5 +1,10 @@
-from telegram_bot import TelegramBot
+from auth import get_request_data, is_authorized
 
 
 def main(request):
+    # Reject unauthenticated calls before importing the bot: telegram.ext,
+    # lxml, yaml and requests are only loaded by requests that need them.
+    if not is_authorized(request, get_request_data(request)):
+        return 'Forbidden'
+    from telegram_bot import TelegramBot
     return TelegramBot.process_gcf_call(request)
@@ -0,0 +1,140 @@
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from pathlib import PurePosixPath
+from threading import Lock
+from typing import Optional
+from weakref import WeakKeyDictionary
+
+from gitlab_batch import PendingAction
+from storage import Storage
+
+# A data directory with a file per post, so that the site can build post
+# listings from it: Hugo merges the files into one map keyed by post id.
+TG_POST_MANIFEST_PATH = os.environ.get('TG_POST_MANIFEST_PATH', 'data/tgposts')
+
+_manifests: 'WeakKeyDictionary[Storage, Manifest]' = WeakKeyDictionary()
+_manifests_lock = Lock()
+
+
+@dataclass
+class ManifestEntry:
+    title: str
+    date: str
+    path: str
+    content_hash: str
+    # Mirrored media paths by Telegram file_unique_id.
+    media: dict[str, str] = field(default_factory=dict)
+    # Albums: the channel message ids and the mirrored media of each message,
+    # as {message_id, type, file_unique_id}, since edits come one message at
+    # a time.
+    message_ids: list[int] = field(default_factory=list)
+    media_group: list[dict] = field(default_factory=list)
+
+
+class Manifest:
+    # Every synced post by post id. Each post has its own entry file, which
+    # `write` commits together with the post action, so function instances
+    # syncing different posts never overwrite each other's entries. Entries
+    # are read when first needed, all of them at once (one archive download
+    # on GitLab) for `entries` or with `preload`, and then kept up to date by
+    # the writes of this process.
+    def __init__(self, storage: Storage, path: str = TG_POST_MANIFEST_PATH,
+                 preload: bool = False):
+        self.storage = storage
+        self.path = path
+        self.preload = preload
+        # None for posts known to have no entry.
+        self._entries: dict[int, Optional[ManifestEntry]] = {}
+        self._listed = False
+        self._lock = Lock()
+        self._load_lock = Lock()
+
+    def get_path(self, post_id: int):
+        return f'{self.path}/{post_id}.json'
+
+    def read(self, post_id: int) -> Optional[ManifestEntry]:
+        if (content := self.storage.read(self.get_path(post_id))) is None:
+            return None
+        return ManifestEntry(**json.loads(content))
+
+    def load(self):
+        with self._load_lock:
+            if self._listed:
+                return
+            entries = {
+                int(path.stem): ManifestEntry(**json.loads(content))
+                for file_path, content in self.storage.read_files(self.path).items()
+                if (path := PurePosixPath(file_path)).suffix == '.json'
+            }
+            with self._lock:
+                for post_id, entry in entries.items():
+                    self._entries.setdefault(post_id, entry)
+            self._listed = True
+
+    @property
+    def entries(self) -> dict[int, ManifestEntry]:
+        self.load()
+        return {
+            post_id: entry
+            for post_id, entry in sorted(self._entries.items()) if entry
+        }
+
+    def get(self, post_id: int) -> Optional[ManifestEntry]:
+        # Function instances read the entry of each post they sync, a GET
+        # (a 404 for new posts) that is cheaper than reading every entry on
+        # each cold start, and sees the entries other instances wrote since.
+        # Long-lived processes `preload` them all on the first lookup.
+        if self.preload:
+            self.load()
+        if post_id not in self._entries and not self._listed:
+            entry = self.read(post_id)
+            with self._lock:
+                # Unless written meanwhile.
+                self._entries.setdefault(post_id, entry)
+        return self._entries.get(post_id)
+
+    @staticmethod
+    def dump(entry: ManifestEntry):
+        return json.dumps(asdict(entry), ensure_ascii=False, indent=2) + '\n'
+
+    def write(self, post_id: int, entry: Optional[ManifestEntry],
+              action: PendingAction):
+        self.update({post_id: entry}, action)
+
+    def update(self, changes: dict[int, Optional[ManifestEntry]],
+               *actions: PendingAction, commit_message: str = None):
+        # `None` entries are removed. The entries are only changed here once
+        # the storage took the actions.
+        entry_actions = []
+        for post_id, entry in changes.items():
+            exists = self.get(post_id) is not None
+            if entry:
+                entry_actions.append(PendingAction(
+                    action='update' if exists else 'create',
+                    file_path=self.get_path(post_id),
+                    content=self.dump(entry),
+                    commit_message=None,
+                ))
+            elif exists:
+                entry_actions.append(PendingAction(
+                    action='delete',
+                    file_path=self.get_path(post_id),
+                    content=None,
+                    commit_message=None,
+                ))
+        if not actions and not entry_actions:
+            return
+        if commit_message and entry_actions:
+            entry_actions[0].commit_message = commit_message
+        self.storage.write(*actions, *entry_actions)
+        with self._lock:
+            self._entries.update(changes)
+
+
+def get_manifest(storage: Storage):
+    if (manifest := _manifests.get(storage)) is None:
+        with _manifests_lock:
+            if (manifest := _manifests.get(storage)) is None:
+                manifest = _manifests[storage] = Manifest(storage)
+    return manifest
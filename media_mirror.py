@@ -0,0 +1,156 @@
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import PurePosixPath
+from tempfile import SpooledTemporaryFile
+from typing import Iterable, Optional
+
+from telegram import Bot, Message
+from telegram.error import BadRequest, NetworkError
+
+import http_client
+from gitlab_batch import BLOB_CHUNK_SIZE, PendingAction
+from storage import Storage
+from timing import span
+
+MEDIA_MIRROR = os.environ.get('MEDIA_MIRROR') == '1'
+MEDIA_MIRROR_PATH = os.environ.get('MEDIA_MIRROR_PATH', 'static/tgmedia')
+MEDIA_MIRROR_CONCURRENCY = int(os.environ.get('MEDIA_MIRROR_CONCURRENCY', 4))
+# getFile only serves files up to 20MB.
+MEDIA_MIRROR_MAX_SIZE = 20 * 1024 * 1024
+# Downloads are kept in memory up to this size and spill to disk past it.
+MEDIA_SPOOL_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class MediaFile:
+    type: str
+    file_id: str
+    file_unique_id: str
+    file_size: Optional[int]
+
+
+@dataclass
+class MirroredMedia:
+    type: str
+    file_unique_id: str
+    path: str
+    message_id: Optional[int] = None
+    # Stores the file, if it is new; committed with the post.
+    action: Optional[PendingAction] = field(default=None, repr=False, compare=False)
+
+
+def get_media_files(message: Message):
+    files = []
+    if message.photo:
+        # The largest size.
+        photo = message.photo[-1]
+        files.append(MediaFile('photo', photo.file_id, photo.file_unique_id, photo.file_size))
+    if video := message.video:
+        files.append(MediaFile('video', video.file_id, video.file_unique_id, video.file_size))
+    return files
+
+
+class MediaMirror:
+    # Copies post media to storage under their sha256, so the same photo
+    # posted again or kept by an edit is stored once. Files are streamed from
+    # getFile to a spooled temporary file, as the hash is only known once the
+    # download is complete, and the files that are not stored yet come back
+    # as create actions, to be committed with the post.
+    def __init__(self, bot: Bot, storage: Storage,
+                 path: str = MEDIA_MIRROR_PATH,
+                 concurrency: int = MEDIA_MIRROR_CONCURRENCY,
+                 store: bool = True):
+        self.bot = bot
+        self.storage = storage
+        self.path = path
+        self.concurrency = concurrency
+        self.store = store
+
+    def preview(self):
+        # Works out the paths without storing anything, for dry runs.
+        return MediaMirror(self.bot, self.storage, self.path, self.concurrency, store=False)
+
+    def get_path(self, content_hash: str, suffix: str):
+        return f'{self.path}/{content_hash[:2]}/{content_hash}{suffix}'
+
+    def download(self, media: MediaFile) -> tuple[str, Optional[PendingAction]]:
+        with span('media_get_file'):
+            file = self.bot.get_file(media.file_id)
+        content_hash = hashlib.sha256()
+        spool = SpooledTemporaryFile(max_size=MEDIA_SPOOL_SIZE)
+        try:
+            with span('media_download'):
+                response = http_client.get(file.file_path, stream=True)
+                with response:
+                    if not response.ok:
+                        raise ValueError(f'{media.file_id}: {response.status_code}')
+                    for chunk in response.iter_content(BLOB_CHUNK_SIZE):
+                        content_hash.update(chunk)
+                        spool.write(chunk)
+            path = self.get_path(content_hash.hexdigest(),
+                                 PurePosixPath(file.file_path).suffix)
+            if not self.store or self.storage.exists(path):
+                spool.close()
+                return path, None
+        except Exception:
+            spool.close()
+            raise
+        return path, PendingAction('create', path, None, None,
+                                   on_commit=[spool.close], file=spool)
+
+    def try_download(self, media: MediaFile) -> Optional[tuple[str, Optional[PendingAction]]]:
+        # A post is synced without the media that could not be mirrored.
+        if media.file_size and media.file_size > MEDIA_MIRROR_MAX_SIZE:
+            logger.warning('%s %s is too big to mirror', media.type, media.file_unique_id)
+            return None
+        import requests
+
+        try:
+            return self.download(media)
+        except BadRequest:
+            logger.exception('Mirroring %s %s failed', media.type, media.file_unique_id)
+        except (NetworkError, requests.RequestException) as e:
+            # Without the error itself: it names the file URL, which holds the
+            # bot token.
+            logger.error('Mirroring %s %s failed: %s', media.type, media.file_unique_id,
+                         type(e).__name__)
+        except ValueError:
+            logger.exception('Mirroring %s %s failed', media.type, media.file_unique_id)
+        return None
+
+    def mirror(self, messages: Iterable[Message],
+               known: dict[str, str] = None) -> list[MirroredMedia]:
+        # `known` are paths mirrored before by file_unique_id; the rest of an
+        # album is downloaded in parallel.
+        files = [
+            (message.forward_from_message_id or message.message_id, media)
+            for message in sorted(messages, key=lambda m: m.message_id)
+            for media in get_media_files(message)
+        ]
+        paths = dict(known or {})
+        missing = list({
+            media.file_unique_id: media
+            for _, media in files if media.file_unique_id not in paths
+        }.values())
+        # By path: different files of an album may have the same content.
+        actions: dict[str, PendingAction] = {}
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(missing))) as executor:
+                for media, downloaded in zip(missing, executor.map(self.try_download, missing)):
+                    if not downloaded:
+                        continue
+                    path, action = downloaded
+                    paths[media.file_unique_id] = path
+                    if action and actions.setdefault(path, action) is not action:
+                        action.file.close()
+        return [
+            MirroredMedia(media.type, media.file_unique_id, path, message_id,
+                          actions.pop(path, None))
+            for message_id, media in files
+            if (path := paths.get(media.file_unique_id))
+        ]
@@ -1,46 +1,179 @@
+import os
 import re
+from dataclasses import dataclass, field
+from functools import cache, wraps
+from html import escape, unescape
+from typing import TYPE_CHECKING
 
 from telegram import Message
-import requests
 
-from lxml import etree
-from lxml.html import document_fromstring, Element
+import http_client
+from timing import span
+
+if TYPE_CHECKING:
+    from lxml.html import HtmlElement
 
 MEDIA_ATTRS: list[str] = ['photo', 'video', 'media_group_id']
+# Telegram albums hold at most 10 messages.
+MEDIA_GROUP_LIMIT = 10
+
+# `embed` scrapes the body from the t.me embed page, `local` renders it from
+# the message entities and only fetches the embed page for media markup.
+RENDER_MODE_EMBED = 'embed'
+RENDER_MODE_LOCAL = 'local'
+POST_RENDER_MODE = os.environ.get('POST_RENDER_MODE', RENDER_MODE_EMBED)
+
+# What the embed page does to the text, so that both modes write the same
+# bytes: links open in a new tab, emoji are wrapped in an image, non-ASCII
+# characters are numeric entities (lxml serializes to ASCII) and the
+# indentation after the text div is kept as its tail.
+HTML_TAG_RE = re.compile(r'(<[^>]+>)')
+LINK_TAG_RE = re.compile(r'<a href="([^"]*)">')
+EMOJI_PART = '(?:[\u2300-\u27bf\u2b00-\u2bff\U0001f000-\U0001faff]\ufe0f?[\U0001f3fb-\U0001f3ff]?)'
+EMOJI_RE = re.compile(
+    '[\U0001f1e6-\U0001f1ff]{2}'
+    '|[#*0-9]\ufe0f?\u20e3'
+    f'|{EMOJI_PART}(?:\u200d{EMOJI_PART})*'
+)
+EMOJI_URL = '//telegram.org/img/emoji/40/{}.png'
+EMBED_TEXT_TAIL = '\n      '
+
+
+# lxml is only imported (and the selector compiled, once) by posts that
+# actually need the embed page.
+@cache
+def message_text_xpath():
+    from lxml import etree
+    return etree.XPath('//div[contains(@class, "js-message_text")]')
+
+
+def tostring(element: 'HtmlElement'):
+    from lxml import etree
+    return etree.tostring(element).decode('utf-8')
+
+
+@dataclass
+class EmbedParts:
+    text: list[str] = field(default_factory=list)
+    default_media: list[str] = field(default_factory=list)
+    photo_media: list[str] = field(default_factory=list)
+
+
+def extract_embed_parts(element: 'HtmlElement'):
+    # One lookup of the message text nodes; media are their preceding
+    # siblings, classified in place instead of re-querying the document.
+    parts = EmbedParts()
+    default_media, photo_media = {}, {}
+    for message_text in message_text_xpath()(element):
+        parts.text.append(tostring(message_text))
+        siblings = list(message_text.itersiblings(preceding=True))
+        for sibling in reversed(siblings):
+            css_class = sibling.get('class') or ''
+            if sibling.tag == 'div' and 'js-message' in css_class:
+                default_media[sibling] = None
+            elif sibling.tag == 'a' and 'photo' in css_class:
+                photo_media[sibling] = None
+    parts.default_media = [tostring(e) for e in default_media]
+    parts.photo_media = [tostring(e) for e in photo_media]
+    return parts
+
+
+def embed_link(match: re.Match):
+    href = escape(unescape(match[1]), quote=False).replace('"', '&quot;')
+    return f'<a href="{href}" target="_blank" rel="noopener">'
+
+
+def embed_emoji(match: re.Match):
+    url = EMOJI_URL.format(match[0].encode('utf-8').hex().upper())
+    return f'<i class="emoji" style="background-image:url(\'{url}\')"><b>{match[0]}</b></i>'
+
+
+def embed_text(text: str):
+    # lxml only escapes &, < and > in text.
+    text = text.replace('&#x27;', "'").replace('&quot;', '"')
+    return EMOJI_RE.sub(embed_emoji, text)
+
+
+def embed_html(html: str):
+    html = ''.join(
+        LINK_TAG_RE.sub(embed_link, part) if part.startswith('<') else embed_text(part)
+        for part in HTML_TAG_RE.split(html)
+    )
+    return html.replace('\n', '<br/>').encode('ascii', 'xmlcharrefreplace').decode('ascii')
+
+
+def memoized_property(func):
+    name = func.__name__
+
+    @wraps(func)
+    def getter(self):
+        try:
+            return self._cache[name]
+        except KeyError:
+            value = self._cache[name] = func(self)
+            return value
+
+    return property(getter)
 
 
 class Post:
-    _message: Message
-    _element: Element = None
+    __slots__ = ('_message', '_media_group', '_post_id', 'render_mode', '_cache')
+
+    def __init__(self, message: Message = None,
+                 render_mode: str = POST_RENDER_MODE,
+                 media_group: tuple[Message, ...] = (),
+                 post_id: int = None):
+        self._message = message
+        self._media_group = media_group
+        self._post_id = post_id
+        self.render_mode = render_mode
+        self._cache = {}
+
+    @classmethod
+    def from_message(cls, message: Message, render_mode: str = None,
+                     post_id: int = None):
+        # `post_id` is the album's for an edited album message.
+        return cls(message=message,
+                   render_mode=render_mode or POST_RENDER_MODE,
+                   post_id=post_id)
 
     @classmethod
-    def from_message(cls, message: Message):
-        post = cls()
-        post._message = message
-        return post
+    def from_media_group(cls, messages: list[Message], render_mode: str = None):
+        messages = tuple(sorted(messages, key=lambda m: m.message_id))
+        message = next(
+            (m for m in messages if m.text or m.caption),
+            messages[0],
+        )
+        return cls(message=message,
+                   render_mode=render_mode or POST_RENDER_MODE,
+                   media_group=messages)
 
     @property
+    def media_group(self):
+        return self._media_group or (self._message,)
+
+    @memoized_property
     def element(self):
-        if not self._element:
-            response = requests.get(
+        with span('embed_fetch'):
+            response = http_client.get(
                 url=self.message_link,
                 params={'embed': 1},
             )
-            self._element = document_fromstring(response.text)
-        return self._element
+        with span('embed_parse'):
+            from lxml.html import document_fromstring
+            return document_fromstring(response.text)
 
-    def get_html_by_xpath(self, xpath: str):
-        return [
-            etree.tostring(o).decode('utf-8') for o in self.element.xpath(xpath)
-        ]
+    @memoized_property
+    def embed_parts(self):
+        element = self.element
+        with span('xpath'):
+            return extract_embed_parts(element)
 
     def get_default_media(self):
-        xpath = '//div[contains(@class, "js-message_text")]/preceding-sibling::div[contains(@class, "js-message")]'
-        return self.get_html_by_xpath(xpath)
+        return self.embed_parts.default_media
 
     def get_media_type_photo(self):
-        xpath = '//div[contains(@class, "js-message_text")]/preceding-sibling::a[contains(@class, "photo")]'
-        return self.get_html_by_xpath(xpath)
+        return self.embed_parts.photo_media
 
     def get_media(self):
         media = []
@@ -59,68 +192,87 @@ class Post:
 
     def text_body(self):
         html = self._message.text_html_urled or self._message.caption_html_urled
-        return f'<div class="tg_post_body">{html}</div>'
+        if not html:
+            return ''
+        return f'<div class="tgme_widget_message_text js-message_text" dir="auto">' \
+               f'{embed_html(html)}</div>{EMBED_TEXT_TAIL}'
 
-    @property
+    @memoized_property
     def contains_media(self):
         return any([getattr(self._message, a) for a in MEDIA_ATTRS])
 
-    @property
+    @memoized_property
     def media_html(self):
         if not self.contains_media:
             return None
         return self.get_media_html()
 
-    @property
+    @memoized_property
     def post_id(self):
-        return self._message.forward_from_message_id or self._message.message_id
+        return self._post_id or min(self.message_ids)
+
+    @property
+    def media_group_id(self):
+        return self._message.media_group_id
 
     @property
+    def message_ids(self):
+        # In the channel, for forwards too.
+        return [m.forward_from_message_id or m.message_id for m in self.media_group]
+
+    @memoized_property
+    def channel_id(self):
+        if self.is_forward:
+            return self._message.forward_from_chat.id
+        return self._message.chat_id
+
+    @memoized_property
     def message_link(self):
         if self.is_forward:
             return f'{self._message.forward_from_chat.link.removesuffix("/")}' \
                    f'/{self._message.forward_from_message_id}'
         return self._message.link
 
-    @property
+    @memoized_property
     def message_text_md(self):
         return self._message.text_markdown_v2 or self._message.caption_markdown_v2
 
-    @property
+    @memoized_property
     def message_text(self):
         return self._message.text or self._message.caption
 
-    @property
+    @memoized_property
     def title_match(self):
         return re.match(r'[^\n]?\*(?P<title>.+?)\*', self.message_text_md)
 
-    @property
+    @memoized_property
     def fallback_title(self):
         if not self.title_match:
             return ' '.join(self.message_text.splitlines()[0].split()[:10])
 
-    @property
+    @memoized_property
     def title(self):
         return self.fallback_title or self.title_match.groupdict()['title']
 
-    @property
+    @memoized_property
     def md(self):
         return (self._message.text_markdown_v2_urled
                 or self._message.caption_markdown_v2_urled)
 
-    @property
+    @memoized_property
     def html(self):
-        xpath = '//div[contains(@class, "js-message_text")]'
-        return ''.join(self.get_html_by_xpath(xpath))
+        if self.render_mode == RENDER_MODE_LOCAL:
+            return self.text_body()
+        return ''.join(self.embed_parts.text)
 
-    @property
+    @memoized_property
     def is_forward(self):
         return bool(self._message.forward_from_message_id)
 
-    @property
+    @memoized_property
     def date(self):
         return self._message.forward_date if self.is_forward else self._message.date
 
-    @property
+    @memoized_property
     def edit_date(self):
         return self._message.date if self.is_forward else self._message.edit_date
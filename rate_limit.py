@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass
+from threading import Lock
+from typing import Any, Callable, Optional
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+# {"telegram:sendMessage": [rate per second, burst], "http": [10, 20], ...};
+# endpoint keys fall back to their group (the part before the colon).
+RATE_LIMITS: dict[str, tuple[float, float]] = {
+    'telegram': (30, 30),
+    'telegram:sendMessage': (20, 20),
+    'telegram:editMessageText': (20, 20),
+    'http': (10, 20),
+    **json.loads(os.environ.get('RATE_LIMITS', '{}')),
+}
+DEFAULT_RATE = float(os.environ.get('DEFAULT_RATE', 10))
+DEFAULT_BURST = float(os.environ.get('DEFAULT_BURST', 10))
+RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 5))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', 0.5))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', 30))
+
+logger = logging.getLogger(__name__)
+
+_limiter: 'RateLimiter' = None
+_limiter_lock = Lock()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated_at
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    def reserve(self) -> float:
+        # Takes a token and returns how long the caller has to wait for it.
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = max(-self._tokens / self.rate, self._blocked_until - now, 0)
+            return wait
+
+    def acquire(self) -> float:
+        if (wait := self.reserve()) > 0:
+            time.sleep(wait)
+        return wait
+
+    def block(self, seconds: float):
+        # Server-side throttling (RetryAfter / Retry-After) overrides the
+        # local estimate: nothing is let through until it is over.
+        with self._lock:
+            self._blocked_until = max(self._blocked_until,
+                                      time.monotonic() + seconds)
+            self._tokens = min(self._tokens, 0)
+
+
+@dataclass
+class CallCounters:
+    calls: int = 0
+    throttled: int = 0
+    retried: int = 0
+    failed: int = 0
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = RETRY_MAX_ATTEMPTS
+    base_delay: float = RETRY_BASE_DELAY
+    max_delay: float = RETRY_MAX_DELAY
+
+    def backoff(self, attempt: int) -> float:
+        # "Full jitter" exponential backoff.
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def is_connect_error(error: BaseException) -> bool:
+    # The request never reached the server: no connection could be made.
+    # Telegram and requests errors wrap the urllib3 error, which is the
+    # cause, the first argument or the reason of a MaxRetryError.
+    connect_errors = tuple(
+        sys.modules[name].ConnectTimeoutError
+        for name in ('urllib3.exceptions', 'telegram.vendor.ptb_urllib3.urllib3.exceptions')
+        if name in sys.modules
+    )
+    while error is not None:
+        # NewConnectionError is a ConnectTimeoutError.
+        if isinstance(error, connect_errors):
+            return True
+        error = error.__cause__ or getattr(error, 'reason', None) or next(
+            (arg for arg in error.args if isinstance(arg, BaseException)), None,
+        )
+    return False
+
+
+def get_retry_after(error: Exception, idempotent: bool = True) -> Optional[float]:
+    # How long to wait before retrying after `error`: the server-provided
+    # delay, 0 for transient errors (use backoff), None if not retryable.
+    # A call that is not idempotent may have taken effect when it timed out
+    # or failed with a server error, so it is only retried if it was
+    # throttled or never sent.
+    if isinstance(error, RetryAfter):
+        return float(error.retry_after)
+    if isinstance(error, BadRequest):
+        return None
+    if not idempotent:
+        return 0 if is_connect_error(error) else None
+    if isinstance(error, NetworkError):
+        return 0
+    if 'requests' in sys.modules:
+        from requests.exceptions import ConnectionError, Timeout
+        if isinstance(error, (ConnectionError, Timeout)):
+            return 0
+    return None
+
+
+class RateLimiter:
+    # Every outbound call is made through `call` with an endpoint key such as
+    # `telegram:sendMessage` or `http:gitlab.com`. Each key has its own token
+    # bucket (RATE_LIMITS, falling back to DEFAULT_RATE/DEFAULT_BURST) and
+    # counters for calls that had to wait, were retried or gave up.
+    def __init__(self, limits: dict[str, tuple[float, float]] = None,
+                 retry_policy: RetryPolicy = None):
+        self.limits = RATE_LIMITS if limits is None else limits
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.buckets: dict[str, TokenBucket] = {}
+        self.counters: dict[str, CallCounters] = defaultdict(CallCounters)
+        self._lock = Lock()
+
+    def get_bucket(self, endpoint: str) -> TokenBucket:
+        if (bucket := self.buckets.get(endpoint)) is None:
+            with self._lock:
+                if (bucket := self.buckets.get(endpoint)) is None:
+                    group = endpoint.partition(':')[0]
+                    rate, burst = self.limits.get(
+                        endpoint,
+                        self.limits.get(group, (DEFAULT_RATE, DEFAULT_BURST)),
+                    )
+                    bucket = self.buckets[endpoint] = TokenBucket(rate, burst)
+        return bucket
+
+    def call(self, endpoint: str, func: Callable, *args,
+             result_retry_after: Callable[[Any], Optional[float]] = None,
+             idempotent: bool = True,
+             **kwargs):
+        bucket = self.get_bucket(endpoint)
+        counters = self.counters[endpoint]
+        attempt = 0
+        while True:
+            counters.calls += 1
+            if bucket.acquire() > 0:
+                counters.throttled += 1
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                retry_after = get_retry_after(e, idempotent)
+                if retry_after is None or attempt + 1 >= self.retry_policy.max_attempts:
+                    counters.failed += 1
+                    raise
+            else:
+                retry_after = result_retry_after and result_retry_after(result)
+                if retry_after is None:
+                    return result
+                if attempt + 1 >= self.retry_policy.max_attempts:
+                    counters.failed += 1
+                    return result
+            counters.retried += 1
+            if retry_after:
+                logger.warning('%s throttled for %ss', endpoint, retry_after)
+                bucket.block(retry_after)
+            else:
+                time.sleep(self.retry_policy.backoff(attempt))
+            attempt += 1
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {endpoint: asdict(c) for endpoint, c in self.counters.items()}
+
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter()
+    return _limiter
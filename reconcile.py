@@ -0,0 +1,139 @@
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field, replace
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Iterable, Optional
+
+from telegram import Message
+
+from gitlab_batch import PendingAction
+from gitlab_post import TG_POST_FILE_PATH, GitlabPost
+from manifest import ManifestEntry, get_manifest
+from post import MEDIA_GROUP_LIMIT, Post
+from storage import Storage
+
+if TYPE_CHECKING:
+    from media_mirror import MediaMirror
+
+RECONCILE_CONCURRENCY = int(os.environ.get('RECONCILE_CONCURRENCY', 4))
+
+logger = logging.getLogger(__name__)
+
+
+def get_post_id_re(template: str = TG_POST_FILE_PATH):
+    prefix, _, suffix = template.partition('{}')
+    return re.compile(f'^{re.escape(prefix)}(?P<post_id>\\d+){re.escape(suffix)}$')
+
+
+@dataclass
+class ReconcileReport:
+    dry_run: bool
+    listed: int = 0
+    checked: int = 0
+    unchanged: int = 0
+    create: list[int] = field(default_factory=list)
+    update: list[int] = field(default_factory=list)
+    delete: list[int] = field(default_factory=list)
+
+    def as_dict(self):
+        return asdict(self)
+
+
+@dataclass
+class Reconcile:
+    # Compares the posts in the repository (one listing of the posts
+    # directory plus the manifest, read at once) with what is in the channel
+    # now, and writes the difference as a single commit. `fetch_message`
+    # reads a channel message by id and returns None if there is none.
+    storage: Storage
+    fetch_message: Callable[[int], Optional[Message]]
+    mirror: Optional['MediaMirror'] = None
+    path_template: str = TG_POST_FILE_PATH
+    concurrency: int = RECONCILE_CONCURRENCY
+    _messages: dict[int, Optional[Message]] = field(default_factory=dict, init=False, repr=False)
+    _lock: Lock = field(default_factory=Lock, init=False, repr=False)
+
+    def list_posts(self) -> dict[int, str]:
+        post_id_re = get_post_id_re(self.path_template)
+        prefix = self.path_template.partition('{}')[0]
+        return {
+            int(match['post_id']): path
+            for path in self.storage.list_files(prefix)
+            if (match := post_id_re.match(path))
+        }
+
+    def fetch(self, message_id: int) -> Optional[Message]:
+        with self._lock:
+            if message_id in self._messages:
+                return self._messages[message_id]
+        message = self.fetch_message(message_id)
+        with self._lock:
+            self._messages[message_id] = message
+        return message
+
+    def get_post(self, post_id: int) -> Optional[Post]:
+        if not (message := self.fetch(post_id)):
+            return None
+        if not (media_group_id := message.media_group_id):
+            return Post.from_message(message) if message.text or message.caption else None
+        # Only the first message of an album is a post.
+        previous = self.fetch(post_id - 1)
+        if previous and previous.media_group_id == media_group_id:
+            return None
+        messages = [message]
+        for message_id in range(post_id + 1, post_id + MEDIA_GROUP_LIMIT):
+            message = self.fetch(message_id)
+            if not message or message.media_group_id != media_group_id:
+                break
+            messages.append(message)
+        if not any(m.text or m.caption for m in messages):
+            return None
+        return Post.from_media_group(messages)
+
+    def run(self, dry_run: bool = True, post_ids: Iterable[int] = None):
+        # All known posts are checked, plus `post_ids` to find posts that
+        # were never synced.
+        manifest = get_manifest(self.storage)
+        mirror = self.mirror.preview() if self.mirror and dry_run else self.mirror
+        listed = self.list_posts()
+        post_ids = sorted({*listed, *manifest.entries, *(post_ids or ())})
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            posts = dict(zip(post_ids, executor.map(self.get_post, post_ids)))
+
+        report = ReconcileReport(dry_run=dry_run, listed=len(listed),
+                                 checked=len(post_ids))
+        changes: dict[int, Optional[ManifestEntry]] = {}
+        actions: list[PendingAction] = []
+        for post_id in post_ids:
+            path, entry = listed.get(post_id), manifest.get(post_id)
+            if not (post := posts[post_id]):
+                if path:
+                    actions.append(PendingAction('delete', path, None,
+                                                 f'Reconcile: delete tgpost {post_id}'))
+                if path or entry:
+                    changes[post_id] = None
+                    report.delete.append(post_id)
+                continue
+            gitlab_post = GitlabPost.from_post(post, self.storage, mirror, self.path_template)
+            content_hash = gitlab_post.content_hash
+            if path and entry and entry.content_hash == content_hash:
+                report.unchanged += 1
+                continue
+            kind = 'update' if path else 'create'
+            file_path = path or gitlab_post.file_path
+            actions.append(PendingAction(
+                kind, file_path, gitlab_post.content,
+                f'Reconcile: {kind} tgpost {post_id}: [{post.date}]: {post.title}',
+            ))
+            actions += gitlab_post.media_actions
+            changes[post_id] = replace(gitlab_post.manifest_entry, path=file_path)
+            getattr(report, kind).append(post_id)
+
+        logger.info('Reconcile: %s', report.as_dict())
+        if changes and not dry_run:
+            manifest.update(changes, *actions,
+                            commit_message=None if actions else 'Reconcile tgposts manifest')
+            self.storage.flush()
+        return report
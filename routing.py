@@ -0,0 +1,92 @@
+import json
+import os
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Iterable, Optional
+
+from gitlab_post import TG_POST_FILE_PATH
+from storage import STORAGE_BACKEND, Storage, create_storage, get_storage
+from telegram_bot_base import LOG_CHAT_ID
+
+# A JSON list of routes, e.g. [{"channel_id": -100123, "log_chat_id": -100456,
+# "storage_location": "https://gitlab.com/api/v4/projects/1/repository/files",
+# "post_file_path": "content/posts/{}/index.md"}]. Without it CHANNEL_ID is
+# synced to the repository and path configured by the environment.
+ROUTES = os.environ.get('ROUTES')
+CHANNEL_ID = os.environ.get('CHANNEL_ID')
+
+_routing_table: 'RoutingTable' = None
+_routing_table_lock = Lock()
+
+
+@dataclass
+class Route:
+    channel_id: int
+    # LOG_CHAT_ID if not set.
+    log_chat_id: Optional[int] = None
+    storage_backend: str = STORAGE_BACKEND
+    # The files API URL for gitlab, a local path for filesystem and git;
+    # the environment default if empty.
+    storage_location: Optional[str] = None
+    batch_size: Optional[int] = None
+    post_file_path: str = TG_POST_FILE_PATH
+    storage: Storage = field(default=None, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.log_chat_id is None:
+            self.log_chat_id = LOG_CHAT_ID
+
+    def create_storage(self, batch_size: int = None):
+        return create_storage(
+            backend=self.storage_backend,
+            batch_size=self.batch_size if batch_size is None else batch_size,
+            location=self.storage_location,
+        )
+
+
+class RoutingTable:
+    # Routes by channel id. Routes to the same repository share its storage,
+    # and so its commit batches and manifest.
+    def __init__(self, routes: Iterable[Route]):
+        self.routes: dict[int, Route] = {}
+        storages: dict[tuple[str, Optional[str]], Storage] = {}
+        for route in routes:
+            if route.channel_id in self.routes:
+                raise ValueError(f'{route.channel_id}: more than one route')
+            if not route.storage:
+                location = (route.storage_backend, route.storage_location)
+                if location not in storages:
+                    storages[location] = route.create_storage()
+                route.storage = storages[location]
+            self.routes[route.channel_id] = route
+
+    @classmethod
+    def from_json(cls, routes: str):
+        return cls(Route(**route) for route in json.loads(routes))
+
+    @classmethod
+    def from_env(cls):
+        if ROUTES:
+            return cls.from_json(ROUTES)
+        return cls([Route(channel_id=int(CHANNEL_ID), storage=get_storage())])
+
+    @property
+    def channel_ids(self):
+        return list(self.routes)
+
+    @property
+    def default(self) -> Route:
+        # For log buttons made before routing, which only carry a post id.
+        return next(iter(self.routes.values()))
+
+    def get(self, channel_id: Optional[int]) -> Optional[Route]:
+        return self.routes.get(channel_id)
+
+
+def get_routing_table():
+    global _routing_table
+    if _routing_table is None:
+        with _routing_table_lock:
+            if _routing_table is None:
+                _routing_table = RoutingTable.from_env()
+    return _routing_table
@@ -0,0 +1,434 @@
+import io
+import logging
+import os
+import subprocess
+from abc import ABC, abstractmethod
+from pathlib import Path
+from threading import Lock, Timer
+from typing import Callable, Iterable, Optional
+from urllib.parse import quote_plus
+
+import http_client
+from gitlab_batch import (
+    BLOB_CHUNK_SIZE,
+    GITLAB_API_TOKEN,
+    GITLAB_BATCH_SIZE,
+    REPOSITORY_BASE_URL,
+    REPOSITORY_COMMITS_URL,
+    GitlabBatchWriter,
+    PendingAction,
+    get_commit_message,
+    get_repository_url,
+)
+from timing import span
+
+# gitlab (REST API), filesystem or git (a local working copy).
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'gitlab')
+STORAGE_PATH = os.environ.get('STORAGE_PATH', '.')
+GIT_BATCH_SIZE = int(os.environ.get('GIT_BATCH_SIZE', 20))
+GIT_COMMIT_INTERVAL = float(os.environ.get('GIT_COMMIT_INTERVAL', 10))
+GIT_PUSH_INTERVAL = float(os.environ.get('GIT_PUSH_INTERVAL', 60))
+GIT_REMOTE = os.environ.get('GIT_REMOTE', 'origin')
+GIT_BRANCH = os.environ.get('GIT_BRANCH', 'master')
+REPOSITORY_TREE_URL = os.environ.get(
+    'REPOSITORY_TREE_URL',
+    get_repository_url(REPOSITORY_BASE_URL, 'tree'),
+)
+REPOSITORY_ARCHIVE_URL = os.environ.get(
+    'REPOSITORY_ARCHIVE_URL',
+    get_repository_url(REPOSITORY_BASE_URL, 'archive.tar.gz'),
+)
+GITLAB_TREE_PAGE_SIZE = 100
+
+logger = logging.getLogger(__name__)
+
+_storage: 'Storage' = None
+_storage_lock = Lock()
+
+
+class Storage(ABC):
+    # Where post files are kept. `write` applies creates, updates and
+    # deletes as one commit and runs the actions' `on_commit` callbacks once
+    # they are stored; backends that batch writes may do that later, at the
+    # latest on `flush`. If `write` raises, nothing was stored; a failed
+    # batch stays queued instead. Actions with a `file` store binary files,
+    # such as mirrored media, in the same commit as the post using them.
+    @abstractmethod
+    def read(self, file_path: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def exists(self, file_path: str) -> bool:
+        pass
+
+    @abstractmethod
+    def write(self, *actions: PendingAction):
+        pass
+
+    @abstractmethod
+    def list_files(self, prefix: str) -> list[str]:
+        pass
+
+    def read_files(self, prefix: str) -> dict[str, str]:
+        # Text files under `prefix` by path, in one call where the backend
+        # allows it.
+        return {path: self.read(path) for path in self.list_files(prefix)}
+
+    def flush(self):
+        pass
+
+
+def run_callbacks(actions: Iterable[PendingAction]):
+    for action in actions:
+        for callback in action.on_commit:
+            callback()
+
+
+class GitlabStorage(Storage):
+    # One files API call for a single file, one commits API call for several,
+    # or one commit per batch with a `writer`.
+    def __init__(
+            self,
+            base_url: str = REPOSITORY_BASE_URL,
+            commits_url: str = REPOSITORY_COMMITS_URL,
+            tree_url: str = REPOSITORY_TREE_URL,
+            archive_url: str = REPOSITORY_ARCHIVE_URL,
+            branch: str = 'master',
+            writer: GitlabBatchWriter = None,
+    ):
+        self.base_url = base_url
+        self.tree_url = tree_url
+        self.archive_url = archive_url
+        self.branch = branch
+        self.writer = writer
+        self.committer = writer or GitlabBatchWriter(
+            commits_url=commits_url,
+            branch=branch,
+        )
+
+    @property
+    def auth_headers(self):
+        return {
+            'Authorization': 'Bearer {}'.format(GITLAB_API_TOKEN),
+        }
+
+    def get_url(self, file_path: str):
+        return '{}/{}'.format(self.base_url, quote_plus(file_path))
+
+    def read(self, file_path: str):
+        with span('gitlab_read'):
+            response = http_client.get(
+                url=f'{self.get_url(file_path)}/raw',
+                params={'ref': self.branch},
+                headers=self.auth_headers,
+            )
+        if response.status_code == 404:
+            return None
+        if not response.ok:
+            raise ValueError(f'{file_path}: {response.text}')
+        return response.text
+
+    def exists(self, file_path: str):
+        with span('gitlab_exists'):
+            response = http_client.request(
+                method='HEAD',
+                url=self.get_url(file_path),
+                params={'ref': self.branch},
+                headers=self.auth_headers,
+            )
+        if response.status_code == 404:
+            return False
+        if not response.ok:
+            raise ValueError(f'{file_path}: {response.status_code}')
+        return True
+
+    def write(self, *actions: PendingAction):
+        if self.writer:
+            self.writer.add(*actions)
+            return
+        # The files API takes binary files, but not streamed.
+        if len(actions) > 1 or actions[0].file:
+            self.committer.commit(list(actions))
+        else:
+            self.write_file(*actions)
+        run_callbacks(actions)
+
+    def write_file(self, action: PendingAction):
+        payload = {
+            'branch': self.branch,
+            'commit_message': action.commit_message,
+        }
+        if action.content is not None:
+            payload['content'] = action.content
+        method = {'create': 'POST', 'update': 'PUT', 'delete': 'DELETE'}[action.action]
+        with span('gitlab_write'):
+            response = http_client.request(
+                method=method,
+                url=self.get_url(action.file_path),
+                json=payload,
+                headers=self.auth_headers,
+            )
+        if not response.ok:
+            raise ValueError(f'{action.file_path}: {response.text}')
+
+    def list_files(self, prefix: str):
+        paths, page = [], '1'
+        while page:
+            with span('gitlab_tree'):
+                response = http_client.get(
+                    url=self.tree_url,
+                    params={
+                        'ref': self.branch,
+                        'path': prefix.rstrip('/'),
+                        'recursive': 'true',
+                        'per_page': GITLAB_TREE_PAGE_SIZE,
+                        'page': page,
+                    },
+                    headers=self.auth_headers,
+                )
+            if response.status_code == 404:
+                return []
+            if not response.ok:
+                raise ValueError(f'{prefix}: {response.text}')
+            paths += [i['path'] for i in response.json() if i['type'] == 'blob']
+            page = response.headers.get('X-Next-Page')
+        return paths
+
+    def read_files(self, prefix: str):
+        # One archive of the directory instead of a read per file.
+        if not self.archive_url:
+            return super().read_files(prefix)
+        import tarfile
+        with span('gitlab_archive'):
+            response = http_client.get(
+                url=self.archive_url,
+                params={'sha': self.branch, 'path': prefix.rstrip('/')},
+                headers=self.auth_headers,
+            )
+        if response.status_code == 404:
+            return {}
+        if not response.ok:
+            raise ValueError(f'{prefix}: {response.text}')
+        files = {}
+        with tarfile.open(fileobj=io.BytesIO(response.content), mode='r:gz') as archive:
+            for member in archive:
+                if member.isfile():
+                    # Below a `<project>-<sha>-<path>` directory.
+                    path = member.name.partition('/')[2]
+                    files[path] = archive.extractfile(member).read().decode('utf-8')
+        return files
+
+    def flush(self):
+        if self.writer:
+            self.writer.flush()
+
+
+class FileSystemStorage(Storage):
+    def __init__(self, path: str = STORAGE_PATH):
+        self.root = Path(path)
+
+    def read(self, file_path: str):
+        path = self.root / file_path
+        if not path.exists():
+            return None
+        return path.read_text(encoding='utf-8')
+
+    def exists(self, file_path: str):
+        return (self.root / file_path).exists()
+
+    def apply(self, action: PendingAction):
+        path = self.root / action.file_path
+        if action.action == 'delete':
+            if not path.exists():
+                raise ValueError(f'{action.file_path}: not found')
+            path.unlink()
+            # Post directories hold nothing but the post.
+            for parent in path.relative_to(self.root).parents[:-1]:
+                try:
+                    (self.root / parent).rmdir()
+                except OSError:
+                    break
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        if action.file:
+            action.file.seek(0)
+            with tmp_path.open('wb') as f:
+                while chunk := action.file.read(BLOB_CHUNK_SIZE):
+                    f.write(chunk)
+        else:
+            tmp_path.write_text(action.content, encoding='utf-8')
+        os.replace(tmp_path, path)
+
+    def write(self, *actions: PendingAction):
+        with span('fs_write'):
+            for action in actions:
+                self.apply(action)
+        run_callbacks(actions)
+
+    def list_files(self, prefix: str):
+        return sorted(
+            path.relative_to(self.root).as_posix()
+            for path in (self.root / prefix).rglob('*')
+            if path.is_file() and not path.name.startswith('.')
+        )
+
+
+class GitStorage(FileSystemStorage):
+    # Files are written to the working copy right away, so reads see them;
+    # they are committed in batches and pushed every `push_interval` seconds
+    # (after every commit if it is 0, never if there is no remote).
+    def __init__(
+            self,
+            path: str = STORAGE_PATH,
+            max_actions: int = GIT_BATCH_SIZE,
+            interval: float = GIT_COMMIT_INTERVAL,
+            push_interval: float = GIT_PUSH_INTERVAL,
+            remote: Optional[str] = GIT_REMOTE,
+            branch: str = GIT_BRANCH,
+    ):
+        super().__init__(path)
+        self.max_actions = max_actions
+        self.interval = interval
+        self.push_interval = push_interval
+        self.remote = remote
+        self.branch = branch
+        self._pending: list[PendingAction] = []
+        self._lock = Lock()
+        self._commit_lock = Lock()
+        self._timer: Optional[Timer] = None
+        self._push_timer: Optional[Timer] = None
+
+    def git(self, *args: str):
+        result = subprocess.run(
+            ['git', '-C', str(self.root), *args],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode:
+            raise ValueError(f'git {args[0]}: {result.stderr.strip()}')
+        return result.stdout
+
+    def write(self, *actions: PendingAction):
+        # Kept out of a commit in progress, which would stage partly written
+        # files.
+        with self._commit_lock, self._lock:
+            with span('fs_write'):
+                for action in actions:
+                    self.apply(action)
+            self._pending.extend(actions)
+            is_full = len(self._pending) >= self.max_actions
+            if not is_full and not self._timer:
+                self._timer = Timer(self.interval, self.logging_errors(self.commit))
+                self._timer.daemon = True
+                self._timer.start()
+        if is_full:
+            self.logging_errors(self.commit)()
+
+    @staticmethod
+    def logging_errors(func: Callable):
+        def run():
+            try:
+                func()
+            except ValueError:
+                logger.exception('git %s failed', func.__name__)
+
+        return run
+
+    def commit(self):
+        with self._commit_lock:
+            with self._lock:
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+                actions, self._pending = self._pending, []
+            if not actions:
+                return
+            try:
+                # The working copy belongs to the bot, so everything in it
+                # is staged; actions that cancelled out leave nothing to
+                # commit.
+                with span('git_commit'):
+                    self.git('add', '--all')
+                    if self.git('status', '--porcelain'):
+                        self.git('commit', '--quiet',
+                                 '--message', get_commit_message(actions))
+            except ValueError:
+                with self._lock:
+                    self._pending[:0] = actions
+                raise
+        run_callbacks(actions)
+        self.schedule_push()
+
+    def schedule_push(self):
+        if not self.remote:
+            return
+        if self.push_interval <= 0:
+            self.push()
+            return
+        with self._lock:
+            if not self._push_timer:
+                self._push_timer = Timer(self.push_interval, self.logging_errors(self.push))
+                self._push_timer.daemon = True
+                self._push_timer.start()
+
+    def push(self):
+        with self._lock:
+            if self._push_timer:
+                self._push_timer.cancel()
+                self._push_timer = None
+        if self.remote:
+            with span('git_push'):
+                self.git('push', '--quiet', self.remote, f'HEAD:{self.branch}')
+
+    def flush(self):
+        self.commit()
+        self.push()
+
+
+def create_gitlab_storage(batch_size: int, base_url: str = None):
+    commits_url, tree_url = REPOSITORY_COMMITS_URL, REPOSITORY_TREE_URL
+    archive_url = REPOSITORY_ARCHIVE_URL
+    if base_url:
+        commits_url = get_repository_url(base_url, 'commits')
+        tree_url = get_repository_url(base_url, 'tree')
+        archive_url = get_repository_url(base_url, 'archive.tar.gz')
+    return GitlabStorage(
+        base_url=base_url or REPOSITORY_BASE_URL,
+        commits_url=commits_url,
+        tree_url=tree_url,
+        archive_url=archive_url,
+        writer=GitlabBatchWriter(
+            max_actions=batch_size,
+            commits_url=commits_url,
+        ) if batch_size > 1 else None,
+    )
+
+
+# By backend, from a batch size and a location: the files API URL of a
+# GitLab repository or a local path. The environment sets the defaults.
+STORAGES: dict[str, Callable[[int, Optional[str]], Storage]] = {
+    'gitlab': create_gitlab_storage,
+    'filesystem': lambda batch_size, path=None: FileSystemStorage(path or STORAGE_PATH),
+    'git': lambda batch_size, path=None: GitStorage(path or STORAGE_PATH, max_actions=batch_size),
+}
+DEFAULT_BATCH_SIZES = {
+    'gitlab': GITLAB_BATCH_SIZE,
+    'git': GIT_BATCH_SIZE,
+}
+
+
+def create_storage(backend: str = STORAGE_BACKEND, batch_size: int = None,
+                   location: str = None):
+    if batch_size is None:
+        batch_size = DEFAULT_BATCH_SIZES.get(backend, 1)
+    return STORAGES[backend](batch_size, location)
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
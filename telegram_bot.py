@@ -1,11 +1,14 @@
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Optional
 
 from telegram import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
+    Message,
     User,
 )
+from telegram.error import BadRequest
 from telegram.ext import (
     Dispatcher,
     Filters,
@@ -15,18 +18,71 @@ from telegram.ext import (
 )
 from telegram.update import Update
 
-from telegram_bot_base import TelegramBotBase
-from post import Post
+from async_pipeline import gather
+from coalescer import Coalescer
+from telegram_bot_base import LOG_CHAT_ID, TelegramBotBase
+from timing import span, traced
+from post import MEDIA_GROUP_LIMIT, Post
 from gitlab_post import GitlabPost
+from manifest import get_manifest
+from media_mirror import MEDIA_MIRROR, MediaMirror
+from routing import Route, RoutingTable, get_routing_table
 
-CHANNEL_ID = int(os.environ['CHANNEL_ID'])
+# The first update of an album or of a burst of edits waits this long for
+# the others. Unless set, only long-lived processes (polling, the ASGI
+# server) wait: a Cloud Function instance takes one request at a time, so the
+# other updates go to other instances and nothing would be merged.
+MEDIA_GROUP_WINDOW = os.environ.get('MEDIA_GROUP_WINDOW')
+EDIT_QUIET_PERIOD = os.environ.get('EDIT_QUIET_PERIOD')
+LONG_LIVED_MEDIA_GROUP_WINDOW = 2
+LONG_LIVED_EDIT_QUIET_PERIOD = 3
+
+# The answer to each callback command, sent before the command runs.
+CALLBACK_ANSWERS = {
+    'del_attempt': 'Confirmation required',
+    'del': 'Deleting...',
+    'del_cancel': 'Deletion cancelled',
+    'deleted': 'Already deleted',
+}
 
 
 @dataclass
 class TelegramBot(TelegramBotBase):
+    media_groups: Coalescer = None
+    edits: Coalescer = None
+    routing: RoutingTable = field(default_factory=get_routing_table)
+    # By channel id.
+    media_mirrors: dict[int, MediaMirror] = field(default_factory=dict)
+
+    def __post_init__(self):
+        super().__post_init__()
+        if self.media_groups is None:
+            self.media_groups = Coalescer(
+                window=self.get_window(MEDIA_GROUP_WINDOW, LONG_LIVED_MEDIA_GROUP_WINDOW),
+            )
+        if self.edits is None:
+            self.edits = Coalescer(
+                window=self.get_window(EDIT_QUIET_PERIOD, LONG_LIVED_EDIT_QUIET_PERIOD),
+                sliding=True,
+                remember_closed=False,
+            )
+        if self.long_lived:
+            for route in self.routing.routes.values():
+                get_manifest(route.storage).preload = True
+        if MEDIA_MIRROR and not self.media_mirrors:
+            self.media_mirrors = {
+                channel_id: MediaMirror(bot=self.bot, storage=route.storage)
+                for channel_id, route in self.routing.routes.items()
+            }
+
+    def get_window(self, window: Optional[str], long_lived_window: float):
+        if window is not None:
+            return float(window)
+        return long_lived_window if self.long_lived else 0
+
     def set_handlers(self, dispatcher: Dispatcher):
         channel_post_message_filter = (
-            Filters.chat(chat_id=CHANNEL_ID) &
+            Filters.chat(chat_id=self.routing.channel_ids) &
             ~Filters.status_update &
             ~Filters.forwarded
         )
@@ -40,7 +96,7 @@ class TelegramBot(TelegramBotBase):
             Filters.chat_type.private &
             # Filters.user(user_id=OWNER_ID) &
             Filters.forwarded &
-            Filters.forwarded_from(chat_id=CHANNEL_ID)
+            Filters.forwarded_from(chat_id=self.routing.channel_ids)
         )
         channel_post_forward_message_handler = MessageHandler(
             filters=channel_post_forward_message_filter,
@@ -54,48 +110,162 @@ class TelegramBot(TelegramBotBase):
         dispatcher.add_handler(channel_post_command_query_callback)
 
     @staticmethod
-    def get_delete_attempt_button(post_id: int):
+    def get_update_key(update: Update):
+        # The channel and the post an update touches. Album messages keep
+        # their own id, so that they reach the media group coalescer
+        # concurrently instead of queueing behind the batch leader.
+        if message := update.effective_message:
+            if query := update.callback_query:
+                _, *args = query.data.split('|')
+                if not args:
+                    return message.chat_id, message.message_id
+                post_id, *channel_id = args
+                return int(channel_id[0]) if channel_id else None, int(post_id)
+            if message.forward_from_message_id:
+                return message.forward_from_chat.id, message.forward_from_message_id
+            return message.chat_id, message.message_id
+        return None, update.update_id
+
+    @staticmethod
+    def get_update_group(update: Update):
+        channel_id, _ = TelegramBot.get_update_key(update)
+        return channel_id
+
+    @staticmethod
+    def is_debounced(update: Update):
+        return bool(update.edited_channel_post)
+
+    @property
+    def debouncer(self):
+        return self.edits
+
+    def get_log_chat_id(self, update: object):
+        if isinstance(update, Update):
+            if route := self.routing.get(self.get_update_group(update)):
+                return route.log_chat_id
+        return LOG_CHAT_ID
+
+    def get_command_route(self, args: list[str]) -> Route:
+        # Buttons carry the post id and the channel id, older ones only the
+        # post id.
+        _, *channel_id = args
+        if not channel_id:
+            return self.routing.default
+        if not (route := self.routing.get(int(channel_id[0]))):
+            raise ValueError(f'No route for channel {channel_id[0]}')
+        return route
+
+    @staticmethod
+    def get_delete_attempt_button(post_id: int, channel_id: int):
         return InlineKeyboardButton(
             text='🗑',
-            callback_data=f'del_attempt|{post_id}',
+            callback_data=f'del_attempt|{post_id}|{channel_id}',
         )
 
-    def create_or_update_post(self, post: Post, is_update: bool = False):
-        GitlabPost.from_post(post).create_or_update(
-            is_update=is_update,
-        )
+    def log_post(self, post: Post, route: Route, is_update: bool = False):
         icon = '🔃' if is_update else '🆕'
         self.log(
             message=f'{icon} #{post.post_id} <a href="{post.message_link}">'
                     f'{post.title}'
                     f'</a>',
             reply_markup=InlineKeyboardMarkup([[
-                self.get_delete_attempt_button(post_id=post.post_id)
+                self.get_delete_attempt_button(post_id=post.post_id,
+                                               channel_id=route.channel_id)
             ]]),
+            chat_id=route.log_chat_id,
         )
 
-    def delete_post(self, post_id: int, user: User = None):
-        GitlabPost.from_id(post_id=post_id).delete()
-        self.bot.delete_message(
-            chat_id=CHANNEL_ID,
-            message_id=post_id,
+    def create_or_update_post(self, post: Post, route: Route, is_update: bool = False):
+        gitlab_post = GitlabPost.from_post(
+            post,
+            storage=route.storage,
+            mirror=self.media_mirrors.get(route.channel_id),
+            path_template=route.post_file_path,
         )
-        self.error(
-            message=f'🗑 #{post_id}',
-            user=user,
+
+        if is_update:
+            # Render the post and read the stored hash at the same time, then
+            # only write and log if the content changed.
+            gather(lambda: gitlab_post.content, lambda: gitlab_post.last_content_hash)
+        # Logged once written, so that a failed write is not reported as synced.
+        if gitlab_post.create_or_update(is_update=is_update):
+            self.log_post(post, route, is_update=is_update)
+
+    @traced('delete_post')
+    def delete_post(self, post_id: int, route: Route, user: User = None):
+        gitlab_post = GitlabPost.from_id(
+            post_id=post_id,
+            storage=route.storage,
+            path_template=route.post_file_path,
+        )
+
+        def delete_message():
+            with span('telegram_delete'):
+                try:
+                    self.bot.delete_message(
+                        chat_id=route.channel_id,
+                        message_id=post_id,
+                    )
+                except BadRequest as e:
+                    # Deleted by an earlier attempt or by hand.
+                    if 'message to delete not found' not in e.message.lower():
+                        raise
+
+        # The message is only deleted once the post is gone from storage, so
+        # that a failed attempt can be tried again as a whole.
+        gitlab_post.delete()
+        gather(
+            delete_message,
+            lambda: self.error(
+                message=f'🗑 #{post_id}',
+                user=user,
+                chat_id=route.log_chat_id,
+            ),
         )
 
+    def get_edited_post(self, message: Message):
+        # An album message is synced as its album, whose entry is the first
+        # one before it: albums are numbered consecutively.
+        if message.media_group_id and (route := self.routing.get(message.chat_id)):
+            manifest = get_manifest(route.storage)
+            for post_id in range(message.message_id, message.message_id - MEDIA_GROUP_LIMIT, -1):
+                if entry := manifest.get(post_id):
+                    if message.message_id in entry.message_ids:
+                        return Post.from_message(message, post_id=post_id)
+                    break
+        return Post.from_message(message)
+
+    @traced('channel_post')
     def channel_post_message_handler(self, update: Update, context: CallbackContext):
         message = update.effective_message
-        post = Post.from_message(message)
+        if update.edited_channel_post:
+            # A pooled dispatcher or the webhook pool only passes on the
+            # last edit of a burst.
+            if self.pool or getattr(context.dispatcher, 'debouncer', None) is self.edits:
+                messages = [message]
+            else:
+                messages = self.edits.add((message.chat_id, message.message_id), message)
+            if not messages:
+                return
+            post = self.get_edited_post(max(messages, key=lambda m: m.edit_date))
+        elif message.media_group_id:
+            messages = self.media_groups.add(message.media_group_id, message)
+            if not messages:
+                return
+            post = Post.from_media_group(messages)
+        else:
+            post = Post.from_message(message)
+        route = self.routing.get(post.channel_id)
         is_update = bool(update.edited_channel_post or post.is_forward)
-        self.create_or_update_post(post=post, is_update=is_update)
+        self.create_or_update_post(post=post, route=route, is_update=is_update)
 
         if fallback_title := post.fallback_title:
             self.error(f'Set proper title!\n\n'
                        f'Fallback title set:\n'
-                       f'{fallback_title}')
+                       f'{fallback_title}',
+                       chat_id=route.log_chat_id)
 
+    @traced('forward')
     def forward_message_handler(self, update: Update, context: CallbackContext):
         self.channel_post_message_handler(update=update, context=context)
 
@@ -106,15 +276,14 @@ class TelegramBot(TelegramBotBase):
         context: CallbackContext,
     ):
         post_id, *_ = args
-        update.callback_query.answer('Confirmation required')
-
+        route = self.get_command_route(args)
         delete_button = InlineKeyboardButton(
             text='🗑',
-            callback_data=f'del|{post_id}',
+            callback_data=f'del|{post_id}|{route.channel_id}',
         )
         cancel_button = InlineKeyboardButton(
             text='❌',
-            callback_data=f'del_cancel|{post_id}',
+            callback_data=f'del_cancel|{post_id}|{route.channel_id}',
         )
         update.callback_query.edit_message_reply_markup(
             reply_markup=InlineKeyboardMarkup([[
@@ -130,11 +299,27 @@ class TelegramBot(TelegramBotBase):
         context: CallbackContext,
     ):
         post_id, *_ = args
-        update.callback_query.answer('Deleting...')
+        route = self.get_command_route(args)
         user = update.effective_user
-        self.delete_post(post_id=post_id, user=user)
-        update.callback_query.edit_message_reply_markup()
-        update.callback_query.answer('Deleted')
+        try:
+            self.delete_post(post_id=post_id, route=route, user=user)
+        except Exception:
+            # Offer to try again.
+            update.callback_query.edit_message_reply_markup(
+                reply_markup=InlineKeyboardMarkup([[
+                    self.get_delete_attempt_button(post_id=post_id,
+                                                   channel_id=route.channel_id),
+                ]])
+            )
+            raise
+        update.callback_query.edit_message_reply_markup(
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton(
+                    text='✅ Deleted',
+                    callback_data=f'deleted|{post_id}|{route.channel_id}',
+                ),
+            ]])
+        )
 
     def command_del_cancel(
         self,
@@ -143,25 +328,69 @@ class TelegramBot(TelegramBotBase):
         context: CallbackContext,
     ):
         post_id, *_ = args
-        update.callback_query.answer('Deletion cancelled')
+        route = self.get_command_route(args)
         update.callback_query.edit_message_reply_markup(
             reply_markup=InlineKeyboardMarkup([[
-                self.get_delete_attempt_button(post_id=post_id),
+                self.get_delete_attempt_button(post_id=post_id,
+                                               channel_id=route.channel_id),
             ]])
         )
 
+    def shutdown(self, timeout: float = None):
+        super().shutdown(timeout=timeout)
+        storages = {id(r.storage): r.storage for r in self.routing.routes.values()}
+        for storage in storages.values():
+            storage.flush()
+
+    def request_reconcile(self, data: dict):
+        # Imported here to keep them out of the webhook path.
+        from backfill import forward_channel_message
+        from reconcile import Reconcile
+
+        route = self.routing.default
+        if 'channel_id' in data:
+            if not (route := self.routing.get(int(data['channel_id']))):
+                return 'Unknown channel'
+        post_ids = ()
+        if 'first_id' in data and 'last_id' in data:
+            post_ids = range(int(data['first_id']), int(data['last_id']) + 1)
+        dry_run = str(data.get('dry_run', '1')).lower() not in ('0', 'false')
+        report = Reconcile(
+            storage=route.storage,
+            fetch_message=lambda message_id: forward_channel_message(
+                self.bot, message_id, channel_id=route.channel_id,
+            ),
+            mirror=self.media_mirrors.get(route.channel_id),
+            path_template=route.post_file_path,
+        ).run(dry_run=dry_run, post_ids=post_ids)
+        self.log(f'🔍 Reconcile{" (dry run)" if dry_run else ""}: '
+                 f'{report.checked} checked, '
+                 f'{len(report.create)} to create, '
+                 f'{len(report.update)} to update, '
+                 f'{len(report.delete)} to delete',
+                 chat_id=route.log_chat_id)
+        return report.as_dict()
+
+    @traced('callback_query')
     def channel_post_command_callback_query(
         self,
         update: Update,
         context: CallbackContext,
     ):
         command_name, *command_args = update.callback_query.data.split('|')
-        command = getattr(self, f'command_{command_name}')
-        command(
-            *command_args,
-            update=update,
-            context=context,
-        )
+        # Telegram takes one answer per query; answering first stops the
+        # button's spinner while the command runs.
+        update.callback_query.answer(CALLBACK_ANSWERS.get(command_name))
+        # Buttons that only show an outcome, like "✅ Deleted", get nothing
+        # but the answer.
+        if not (command := getattr(self, f'command_{command_name}', None)):
+            return
+        with span(f'command_{command_name}'):
+            command(
+                *command_args,
+                update=update,
+                context=context,
+            )
 
 
 if __name__ == '__main__':
@@ -1,39 +1,128 @@
 import os
 import logging
+import time
 from abc import abstractmethod
 from contextlib import contextmanager
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from functools import partial
 from queue import Queue
-from typing import Optional
+from threading import Lock
+from typing import Callable, Hashable, Optional
 
-from telegram import Bot, Message, User, InlineKeyboardMarkup, Update
+from telegram import Bot, User, InlineKeyboardMarkup, Update
 from telegram.ext import Dispatcher, CallbackContext, Updater
+from telegram.utils.request import Request
+
+import async_pipeline
+from auth import WEBHOOK_SECRET_TOKEN, get_request_data, is_authorized
+from coalescer import Coalescer
+from log_sink import LogSink
+from rate_limit import get_limiter
+from timing import traced
+from update_store import UPDATE_STORE_DRAIN_INTERVAL, get_update_store
+from worker_pool import KeyedWorkerPool, POLLING_QUEUE_SIZE, POLLING_WORKERS
 
 BOT_TOKEN = os.environ['BOT_TOKEN']
-APP_TOKEN = os.environ.get('APP_TOKEN')
 WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))
 
 LOG_CHAT_ID = int(os.environ['LOG_CHAT_ID'])
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG')
+# Bot API methods that post a new message (sendMessage, forwardMessage, ...).
+MESSAGE_SENDING_METHOD_PREFIXES = ('send', 'forward', 'copy')
+
+# Warm Cloud Function instances keep module state between invocations, so the
+# bot, its dispatcher and the handler graph are built once per process.
+_instances: dict[type, 'TelegramBotBase'] = {}
+_instances_lock = Lock()
+
+
+class RateLimitedBot(Bot):
+    __slots__ = ()
+
+    def _post(self, endpoint: str, *args, **kwargs):
+        if endpoint == 'getUpdates':
+            return super()._post(endpoint, *args, **kwargs)
+        return get_limiter().call(
+            f'telegram:{endpoint}', super()._post, endpoint, *args,
+            # Repeated, they would post the message twice.
+            idempotent=not endpoint.startswith(MESSAGE_SENDING_METHOD_PREFIXES),
+            **kwargs,
+        )
+
+
+class PooledDispatcher(Dispatcher):
+    # Hands updates from the polling loop to a worker pool keyed by
+    # `get_update_key`, so updates of one post stay in order while
+    # different posts are processed in parallel, taking turns between the
+    # groups (channels) from `get_update_group`. Updates for which
+    # `is_debounced` is true are held back by `debouncer` first, on a timer
+    # rather than in a worker, and only the last one of a burst is submitted.
+    def __init__(self, *args, pool: KeyedWorkerPool,
+                 get_update_key: Callable[[Update], Hashable],
+                 get_update_group: Callable[[Update], Hashable],
+                 is_debounced: Callable[[Update], bool] = lambda update: False,
+                 debouncer: Coalescer = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = pool
+        self.get_update_key = get_update_key
+        self.get_update_group = get_update_group
+        self.is_debounced = is_debounced
+        self.debouncer = debouncer
+
+    def process_update(self, update: object):
+        if not isinstance(update, Update):
+            return super().process_update(update)
+        if self.debouncer and self.is_debounced(update):
+            self.debouncer.schedule(
+                self.get_update_key(update),
+                update,
+                lambda updates: self.submit(max(updates, key=lambda u: u.update_id)),
+            )
+        else:
+            self.submit(update)
+
+    def submit(self, update: Update):
+        self.pool.submit(
+            self.get_update_key(update),
+            super().process_update,
+            update,
+            group=self.get_update_group(update),
+        )
+
+    def stop(self):
+        super().stop()
+        if self.debouncer:
+            self.debouncer.flush()
+        self.pool.shutdown()
 
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+def configure_logging():
+    logging.basicConfig(level=LOG_LEVEL,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 
 @dataclass
 class TelegramBotBase:
     dispatcher: Dispatcher = None
     bot: Bot = None
-    _log_series_enabled: bool = False
-    _log_message: Optional[Message] = None
+    log_sink: LogSink = None
+    # Polling or self-hosted, as opposed to a Cloud Function instance.
+    long_lived: bool = False
+    # Self-hosted: webhook updates are processed on it, in order per
+    # `get_update_key`, and debounced like in polling mode.
+    pool: Optional[KeyedWorkerPool] = None
+    _drained_at: float = field(default=float('-inf'), init=False, repr=False)
+    _drain_lock: Lock = field(default_factory=Lock, init=False, repr=False)
 
     def __post_init__(self):
         queue = Queue()
         self.dispatcher = self.dispatcher or Dispatcher(
-            bot=Bot(token=BOT_TOKEN),
+            bot=RateLimitedBot(token=BOT_TOKEN),
             update_queue=queue,
         )
         self.bot = self.dispatcher.bot
+        self.log_sink = self.log_sink or LogSink(bot=self.bot)
         self.dispatcher.add_error_handler(self.error_callback)
         self.set_handlers(self.dispatcher)
 
@@ -41,6 +130,27 @@ class TelegramBotBase:
     def set_handlers(self, dispatcher: Dispatcher):
         pass
 
+    @staticmethod
+    def get_update_key(update: Update) -> Hashable:
+        # Updates with the same key are processed in order in polling mode.
+        return update.update_id
+
+    @staticmethod
+    def get_update_group(update: Update) -> Hashable:
+        return None
+
+    @staticmethod
+    def is_debounced(update: Update) -> bool:
+        return False
+
+    @property
+    def debouncer(self) -> Optional[Coalescer]:
+        # Debounces the updates from `is_debounced` in polling mode.
+        return None
+
+    def get_log_chat_id(self, update: object) -> int:
+        return LOG_CHAT_ID
+
     @staticmethod
     def get_user_info(user: User):
         user_info = f'<b><a href="tg://user?id={user.id}">{user.full_name}</a></b> ' \
@@ -55,78 +165,178 @@ class TelegramBotBase:
             user: User = None,
             silent: bool = True,
             reply_markup: InlineKeyboardMarkup = None,
+            chat_id: int = LOG_CHAT_ID,
     ):
         text = message
         if user:
             text += f'\n\nby {self.get_user_info(user)}'
 
-        message_params = dict(
-            chat_id=LOG_CHAT_ID,
-            parse_mode='HTML',
-            reply_markup=reply_markup,
-        )
-        if self._log_series_enabled and (log_message := self._log_message):
-            self._log_message = self.bot.edit_message_text(
-                **message_params,
-                text=f'{log_message.text}\n{text}',
-                message_id=log_message.message_id,
-            )
-        else:
-            self._log_message = self.bot.send_message(
-                **message_params,
+        if reply_markup:
+            self.log_sink.send(
+                chat_id=chat_id,
                 text=text,
-                disable_notification=silent,
+                silent=silent,
+                reply_markup=reply_markup,
             )
+        else:
+            self.log_sink.write(chat_id=chat_id, text=text, silent=silent)
 
     @contextmanager
-    def logging_series(self):
-        self._log_series_enabled = True
-        self._log_message = None
-        yield self.log
-        self._log_message = None
-        self._log_series_enabled = False
+    def logging_series(self, chat_id: int = LOG_CHAT_ID):
+        self.log_sink.start_series(chat_id)
+        try:
+            yield partial(self.log, chat_id=chat_id)
+        finally:
+            self.log_sink.end_series(chat_id)
 
     def error(self, *args, **kwargs):
         self.log(*args, **kwargs, silent=False)
 
     def error_callback(self, update: object, context: CallbackContext):
         error = context.error
-        message = f'⚠️ {error}'
-        self.error(message=message)
+        # Errors of file downloads name the URL, which holds the token.
+        message = f'⚠️ {error}'.replace(BOT_TOKEN, '<token>')
+        self.error(message=message, chat_id=self.get_log_chat_id(update))
         raise error
 
     @staticmethod
     def set_webhook():
-        updater = Updater(token=BOT_TOKEN)
-        updater.bot.set_webhook(WEBHOOK_URL)
+        RateLimitedBot(token=BOT_TOKEN).set_webhook(
+            WEBHOOK_URL,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+        )
 
     @classmethod
     def start_polling(cls):
-        updater = Updater(token=BOT_TOKEN)
-        telegram_bot = cls(dispatcher=updater.dispatcher)
+        configure_logging()
+        # A connection per worker, as sized by Updater itself.
+        bot = RateLimitedBot(
+            token=BOT_TOKEN,
+            request=Request(con_pool_size=POLLING_WORKERS + 4),
+        )
+        dispatcher = PooledDispatcher(
+            bot=bot,
+            update_queue=Queue(),
+            # Only for run_async, which the pool replaces.
+            workers=1,
+            pool=KeyedWorkerPool(
+                workers=POLLING_WORKERS,
+                queue_size=POLLING_QUEUE_SIZE,
+            ),
+            get_update_key=cls.get_update_key,
+            get_update_group=cls.get_update_group,
+            is_debounced=cls.is_debounced,
+        )
+        updater = Updater(dispatcher=dispatcher, workers=None)
+        telegram_bot = cls(dispatcher=dispatcher, long_lived=True)
+        dispatcher.debouncer = telegram_bot.debouncer
+        telegram_bot.drain_pending_updates()
         updater.bot.delete_webhook()
         updater.start_polling()
 
+    @classmethod
+    def get_instance(cls, **kwargs):
+        # `kwargs` are only used by the call that builds the instance.
+        if (telegram_bot := _instances.get(cls)) is None:
+            with _instances_lock:
+                if (telegram_bot := _instances.get(cls)) is None:
+                    configure_logging()
+                    telegram_bot = _instances[cls] = cls(**kwargs)
+                    telegram_bot.drain_pending_updates()
+        return telegram_bot
+
+    @traced('webhook_update')
+    def process_update(self, update: Update):
+        try:
+            self.dispatcher.process_update(update)
+            get_update_store().complete(update.update_id)
+        finally:
+            if not (self.pool or async_pipeline.ASYNC_UPDATES):
+                # The function instance may be frozen after responding.
+                self.log_sink.flush()
+
+    def enqueue_update(self, update: Update):
+        if self.pool:
+            if self.debouncer and self.is_debounced(update):
+                self.debouncer.schedule(self.get_update_key(update), update,
+                                        self.submit_last_update)
+            else:
+                self.submit_update(update)
+        elif async_pipeline.ASYNC_UPDATES:
+            async_pipeline.get_pipeline().submit(self.process_update, update)
+        else:
+            self.process_update(update)
+
+    def submit_update(self, update: Update):
+        self.pool.submit(
+            self.get_update_key(update),
+            self.process_update,
+            update,
+            group=self.get_update_group(update),
+        )
+
+    def submit_last_update(self, updates: list[Update]):
+        *superseded, last = sorted(updates, key=lambda u: u.update_id)
+        for update in superseded:
+            get_update_store().complete(update.update_id)
+        self.submit_update(last)
+
+    def shutdown(self, timeout: float = None):
+        # Updates still queued after `timeout` stay in the update store and
+        # are processed on the next start.
+        if self.pool:
+            if self.debouncer:
+                self.debouncer.flush()
+            self.pool.drain(timeout=timeout)
+        if async_pipeline.ASYNC_UPDATES:
+            async_pipeline.get_pipeline().drain(timeout=timeout)
+        self.log_sink.flush()
+
+    def drain_pending_updates(self):
+        # At start-up and then every UPDATE_STORE_DRAIN_INTERVAL from the
+        # webhook path, so that updates left by a process that died shortly
+        # before a restart are not stuck until the next one. Each update is
+        # claimed again, in case Telegram redelivered it meanwhile.
+        if not self._drain_lock.acquire(blocking=False):
+            return
+        try:
+            self._drained_at = time.monotonic()
+            store = get_update_store()
+            for update_id, data in store.pending():
+                if store.claim(update_id, data):
+                    logging.info('Processing pending update %s', update_id)
+                    self.enqueue_update(Update.de_json(data, self.bot))
+        finally:
+            self._drain_lock.release()
+
     @classmethod
     def process_webhook_request(cls, data):
-        telegram_bot = cls()
+        telegram_bot = cls.get_instance()
+        if not get_update_store().claim(data['update_id'], data):
+            return 'ok'
         update = Update.de_json(data, telegram_bot.bot)
-        telegram_bot.dispatcher.process_update(update)
+        telegram_bot.enqueue_update(update)
+        if time.monotonic() - telegram_bot._drained_at >= UPDATE_STORE_DRAIN_INTERVAL:
+            telegram_bot.drain_pending_updates()
         return 'ok'
 
     @classmethod
     def process_request(cls, data):
-        # TODO
-        return 'OK'
+        telegram_bot = cls.get_instance()
+        command = getattr(telegram_bot, f'request_{data.get("command")}', None)
+        if not command:
+            return 'Unknown command'
+        try:
+            return command(data)
+        finally:
+            telegram_bot.log_sink.flush()
 
     @classmethod
     def process_gcf_call(cls, request):
-        data = request.args if request.method == 'GET' else request.get_json(
-            force=True
-        )
+        data = get_request_data(request)
+        if not is_authorized(request, data):
+            return 'Forbidden'
         if 'update_id' in data:
             return cls.process_webhook_request(data)
-        if (token := data.get('token', '')) and (token == APP_TOKEN):
-            return cls.process_request(data)
-        else:
-            return 'Forbidden'
+        return cls.process_request(data)
@@ -1,67 +1,1497 @@
-from unittest import TestCase
-from post import Post
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from queue import Queue
+from threading import Barrier, Event
+from types import SimpleNamespace
+from unittest import TestCase, skipUnless
+from unittest.mock import patch
+
+from lxml.html import document_fromstring
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import Dispatcher
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.vendor.ptb_urllib3.urllib3.exceptions import NewConnectionError
+
+from async_pipeline import AsyncPipeline, gather
+from benchmarks import (
+    FIXTURES_DIR,
+    OFFLINE_BOT_TOKEN,
+    IMPORT_TIME_BUDGETS_MS,
+    legacy_embed_parts,
+    load_scenarios,
+    measure_import,
+    offline_run,
+)
+# After benchmarks, which sets the environment the bot needs.
+from asgi import WebhookApp
+from backfill import ACTIONS_PER_POST, Backfill, forward_channel_message
+from coalescer import Coalescer
+from fakes import FakeEmbedAdapter, FakeGitlab, FakeTelegram
+from gitlab_batch import GitlabBatchWriter, PendingAction
+from gitlab_post import GitlabPost
+import http_client
+import main
+from log_sink import MESSAGE_LENGTH_LIMIT, LogSink
+from manifest import Manifest, ManifestEntry, get_manifest
+from media_mirror import MediaMirror
+from post import Post, extract_embed_parts
+from rate_limit import RateLimiter, RetryPolicy
+from reconcile import Reconcile
+from routing import Route, RoutingTable
+from storage import FileSystemStorage, GitStorage, GitlabStorage
+from telegram_bot import TelegramBot
+from telegram_bot_base import PooledDispatcher, RateLimitedBot
+import timing
+import update_store
+from update_store import MemoryUpdateStore, SQLiteUpdateStore
+from worker_pool import KeyedWorkerPool
+
+
+def make_message(**kwargs):
+    return SimpleNamespace(**{
+        'text': None,
+        'caption': None,
+        'text_markdown_v2': None,
+        'caption_markdown_v2': None,
+        'forward_from_message_id': None,
+        'message_id': 1,
+        'link': 'https://t.me/chan/1',
+        'photo': [],
+        'video': None,
+        'media_group_id': None,
+        **kwargs,
+    })
 
 
 class PostParserTestCase(TestCase):
     def test_title_parsing(self):
-        setattr(Post, 'message_text_md', '')
-        setattr(Post, 'message_text', '')
-        p = Post()
-
         message_text = 'Lorem ipsum dolor sit amet, consectetur\n\nadipiscing elit'
 
         lorem = '*Lorem ipsum dolor sit amet, consectetur*\n\n*adipiscing elit*'
-        setattr(p, 'message_text_md', lorem)
-        setattr(p, 'message_text', message_text)
+        p = Post.from_message(make_message(
+            text=message_text,
+            text_markdown_v2=lorem,
+        ))
         self.assertFalse(p.fallback_title)
         self.assertEqual('Lorem ipsum dolor sit amet, consectetur', p.title)
 
         lorem = 'Lorem ipsum dolor sit *amet, consectetur*\n\nadipiscing elit'
-        setattr(p, 'message_text_md', lorem)
-        setattr(p, 'message_text', message_text)
+        p = Post.from_message(make_message(
+            text=message_text,
+            text_markdown_v2=lorem,
+        ))
         self.assertTrue(p.fallback_title)
         self.assertEqual('Lorem ipsum dolor sit amet, consectetur', p.title)
 
         lorem = 'Lorem ipsum dolor *sit amet,* consectetur\n\nadipiscing elit'
-        setattr(p, 'message_text_md', lorem)
-        setattr(p, 'message_text', message_text)
+        p = Post.from_message(make_message(
+            text=message_text,
+            text_markdown_v2=lorem,
+        ))
         self.assertTrue(p.fallback_title)
         self.assertEqual('Lorem ipsum dolor sit amet, consectetur', p.title)
 
         lorem = '*Lorem ipsum dolor sit amet,* consectetur\n\nadipiscing elit'
-        setattr(p, 'message_text_md', lorem)
-        setattr(p, 'message_text', message_text)
+        p = Post.from_message(make_message(
+            text=message_text,
+            text_markdown_v2=lorem,
+        ))
         self.assertFalse(p.fallback_title)
         self.assertEqual('Lorem ipsum dolor sit amet,', p.title)
 
         lorem = 'Lorem ipsum [*dolor sit*](https://example.com/) amet, consectetur\n\nadipiscing elit'
-        setattr(p, 'message_text_md', lorem)
-        setattr(p, 'message_text', message_text)
+        p = Post.from_message(make_message(
+            text=message_text,
+            text_markdown_v2=lorem,
+        ))
         self.assertTrue(p.fallback_title)
         self.assertEqual('Lorem ipsum dolor sit amet, consectetur', p.title)
 
         lorem = 'Lorem *ipsum *[*dolor*](https://example.com/) [sit](https://example.com/) amet, consectetur\n\nadipiscing elit'
-        setattr(p, 'message_text_md', lorem)
-        setattr(p, 'message_text', message_text)
+        p = Post.from_message(make_message(
+            text=message_text,
+            text_markdown_v2=lorem,
+        ))
         self.assertTrue(p.fallback_title)
         self.assertEqual('Lorem ipsum dolor sit amet, consectetur', p.title)
 
         lorem = '[*Lorem ipsum dolor sit amet, consectetur\n\nadipiscing elit*](https://example.com/)'
-        setattr(p, 'message_text_md', lorem)
-        setattr(p, 'message_text', message_text)
+        p = Post.from_message(make_message(
+            text=message_text,
+            text_markdown_v2=lorem,
+        ))
         self.assertTrue(p.fallback_title)
         self.assertEqual('Lorem ipsum dolor sit amet, consectetur', p.title)
 
         lorem = 'Lorem ipsum dolor sit amet, consectetur\n\nadipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua\. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat\. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur\. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum\.'
         message_text = 'Lorem ipsum dolor sit amet, consectetur\n\nadipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.'
-        setattr(p, 'message_text_md', lorem)
-        setattr(p, 'message_text', message_text)
+        p = Post.from_message(make_message(
+            text=message_text,
+            text_markdown_v2=lorem,
+        ))
         self.assertTrue(p.fallback_title)
         self.assertEqual('Lorem ipsum dolor sit amet, consectetur', p.title)
 
         lorem = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor\n\nincididunt ut labore et dolore magna aliqua\. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat\. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur\. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum\.'
         message_text = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor\n\nincididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.'
-        setattr(p, 'message_text_md', lorem)
-        setattr(p, 'message_text', message_text)
+        p = Post.from_message(make_message(
+            text=message_text,
+            text_markdown_v2=lorem,
+        ))
         self.assertTrue(p.fallback_title)
         self.assertEqual('Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do', p.title)
+
+
+class CountingMessage:
+    def __init__(self, **kwargs):
+        self.__dict__['_message'] = make_message(**kwargs)
+        self.__dict__['reads'] = {}
+
+    def __getattr__(self, name):
+        self.reads[name] = self.reads.get(name, 0) + 1
+        return getattr(self._message, name)
+
+
+class PostMemoizationTestCase(TestCase):
+    def test_derivations_run_once(self):
+        message = CountingMessage(
+            text='Lorem ipsum\n\ndolor',
+            text_markdown_v2='Lorem ipsum\n\ndolor',
+            photo=['photo'],
+        )
+        post = Post.from_message(message)
+        page = (FIXTURES_DIR / 'embed' / 'photo.html').read_text()
+        response = SimpleNamespace(text=page)
+        with patch('http_client.get', return_value=response) as get, \
+                patch('post.extract_embed_parts',
+                      wraps=extract_embed_parts) as extract, \
+                patch('post.re.match', wraps=re.match) as match:
+            for _ in range(3):
+                self.assertEqual('Lorem ipsum', post.title)
+                self.assertTrue(post.fallback_title)
+                self.assertTrue(post.html)
+                self.assertTrue(post.media_html)
+                self.assertEqual(1, post.post_id)
+        self.assertEqual(1, get.call_count)
+        self.assertEqual(1, extract.call_count)
+        self.assertEqual(1, match.call_count)
+        self.assertEqual(1, message.reads['text_markdown_v2'])
+        self.assertEqual(1, message.reads['text'])
+
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            Post().title = 'title'
+        self.assertFalse(hasattr(Post(), '__dict__'))
+
+
+class EmbedPartsTestCase(TestCase):
+    def test_matches_legacy_xpath(self):
+        pages = sorted((FIXTURES_DIR / 'embed').glob('*.html'))
+        self.assertTrue(pages)
+        for page in pages:
+            element = document_fromstring(page.read_text())
+            parts = extract_embed_parts(element)
+            legacy = legacy_embed_parts(element)
+            self.assertEqual(legacy['text'], parts.text, page.name)
+            self.assertEqual(legacy['default_media'], parts.default_media, page.name)
+            self.assertEqual(legacy['photo_media'], parts.photo_media, page.name)
+
+    def test_local_render_matches_embed(self):
+        session = http_client.create_session()
+        session.mount('https://t.me/', FakeEmbedAdapter.from_dir(FIXTURES_DIR / 'embed'))
+        bot = Bot(OFFLINE_BOT_TOKEN)
+        rendered = 0
+        with patch('http_client._session', session):
+            for path in sorted((FIXTURES_DIR / 'updates').glob('*.json')):
+                for data in json.loads(path.read_text()):
+                    update = Update.de_json(data, bot)
+                    message = update.channel_post or update.edited_channel_post
+                    if not (message and (message.text or message.caption)):
+                        continue
+                    embed = Post.from_message(message, render_mode='embed')
+                    local = Post.from_message(message, render_mode='local')
+                    self.assertEqual(embed.html, local.html, path.name)
+                    rendered += 1
+        self.assertEqual(4, rendered)
+
+
+class CoalescerTestCase(TestCase):
+    def test_album_coalesced_into_one_batch(self):
+        coalescer = Coalescer(window=0.2)
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            results = list(executor.map(
+                lambda i: coalescer.add('album', i), range(10),
+            ))
+        batches = [r for r in results if r is not None]
+        self.assertEqual(1, len(batches))
+        self.assertEqual(list(range(10)), sorted(batches[0]))
+        self.assertIsNone(coalescer.add('album', 10))
+
+    def test_sliding_window(self):
+        coalescer = Coalescer(window=0.2, sliding=True, remember_closed=False)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(coalescer.add, 'post', 1)
+            for i in range(2, 5):
+                time.sleep(0.1)
+                self.assertIsNone(coalescer.add('post', i))
+            self.assertEqual([1, 2, 3, 4], leader.result())
+        self.assertEqual([5], Coalescer(window=0.01).add('post', 5))
+
+    def test_scheduled_batches(self):
+        coalescer = Coalescer(window=0.2, sliding=True, remember_closed=False)
+        batches = []
+        for i in range(3):
+            coalescer.schedule('post', i, batches.append)
+            time.sleep(0.1)
+        self.assertEqual([], batches)
+        time.sleep(0.2)
+        self.assertEqual([[0, 1, 2]], batches)
+        coalescer.schedule('post', 3, batches.append)
+        coalescer.flush()
+        self.assertEqual([[0, 1, 2], [3]], batches)
+        time.sleep(0.3)
+        self.assertEqual(2, len(batches))
+
+    def test_disabled_window(self):
+        coalescer = Coalescer(window=0)
+        self.assertEqual([1], coalescer.add('album', 1))
+        self.assertEqual([2], coalescer.add('album', 2))
+
+    def test_windows_only_in_long_lived_processes(self):
+        def make_bot(**kwargs):
+            bot = RateLimitedBot(token=OFFLINE_BOT_TOKEN)
+            storage = FileSystemStorage()
+            return TelegramBot(dispatcher=Dispatcher(bot=bot, update_queue=Queue()),
+                               routing=RoutingTable([Route(channel_id=-1001, storage=storage)]),
+                               **kwargs)
+
+        for kwargs, windows in [({}, (0, 0)), ({'long_lived': True}, (2, 3))]:
+            bot = make_bot(**kwargs)
+            self.assertEqual(windows, (bot.media_groups.window, bot.edits.window))
+            # Long-lived processes read the whole manifest once.
+            manifest = get_manifest(bot.routing.default.storage)
+            self.assertEqual(bool(kwargs), manifest.preload)
+        with patch('telegram_bot.EDIT_QUIET_PERIOD', '1'):
+            self.assertEqual(1, make_bot().edits.window)
+
+    def test_media_group_post(self):
+        messages = [
+            make_message(message_id=12, media_group_id='g'),
+            make_message(message_id=11, media_group_id='g', caption='Title'),
+            make_message(message_id=13, media_group_id='g'),
+        ]
+        post = Post.from_media_group(messages)
+        self.assertEqual(11, post.post_id)
+        self.assertEqual('Title', post.message_text)
+        self.assertEqual([11, 12, 13], [m.message_id for m in post.media_group])
+
+
+class ContentHashTestCase(TestCase):
+    def make_post(self, edit_date):
+        return Post.from_message(make_message(
+            text='Lorem ipsum',
+            text_markdown_v2='*Lorem ipsum*',
+            date=datetime(2022, 9, 1),
+            edit_date=edit_date,
+        ), render_mode='local')
+
+    def test_unchanged_update_skipped(self):
+        with FakeGitlab() as gitlab, \
+                patch.object(Post, 'text_body', return_value='<div>Lorem</div>'):
+            storage = GitlabStorage(base_url=gitlab.files_url,
+                                    commits_url=gitlab.commits_url)
+            first = GitlabPost.from_post(self.make_post(datetime(2022, 9, 2)), storage)
+            second = GitlabPost.from_post(self.make_post(datetime(2022, 9, 3)), storage)
+            self.assertEqual(first.content_hash, second.content_hash)
+            self.assertIn(f'content_hash: {first.content_hash}', first.content)
+            self.assertTrue(first.create_or_update())
+            self.assertFalse(second.create_or_update(is_update=True))
+            # One read of the manifest entry, then one commit with the entry.
+            self.assertEqual(['GET', 'POST'], [r[0] for r in gitlab.requests])
+            self.assertEqual(1, len(gitlab.commits))
+
+
+    def test_posts_rendered_concurrently(self):
+        def front_matter(gitlab_post):
+            time.sleep(0.2)
+            return f'post_id: {gitlab_post.post_id}'
+
+        posts = [
+            GitlabPost.from_post(SimpleNamespace(post_id=i, html='<div>Lorem</div>'))
+            for i in range(4)
+        ]
+        with patch.object(GitlabPost, 'front_matter', property(front_matter)), \
+                ThreadPoolExecutor(max_workers=4) as executor:
+            start = time.perf_counter()
+            contents = list(executor.map(lambda p: p.content, posts))
+            self.assertLess(time.perf_counter() - start, 0.6)
+        self.assertIn('post_id: 3', contents[3])
+        self.assertIs(contents[3], posts[3].content)
+
+
+class ManifestTestCase(TestCase):
+    def test_kept_in_the_same_commit(self):
+        with tempfile.TemporaryDirectory() as path, \
+                patch.object(Post, 'text_body', return_value='<div>Lorem</div>'):
+            storage = FileSystemStorage(path)
+            post = Post.from_message(make_message(
+                message_id=7,
+                text='Lorem ipsum',
+                text_markdown_v2='*Lorem ipsum*',
+                date=datetime(2022, 9, 1),
+                edit_date=None,
+            ), render_mode='local')
+            gitlab_post = GitlabPost.from_post(post, storage)
+            gitlab_post.create_or_update()
+
+            manifest = Manifest(storage)
+            self.assertEqual(ManifestEntry(
+                title='Lorem ipsum',
+                date='2022-09-01T00:00:00',
+                path='content/tgposts/7/index.md',
+                content_hash=gitlab_post.content_hash,
+            ), manifest.get(7))
+
+            with patch('gitlab_post.TG_POST_FILE_PATH', 'posts/{}.md'):
+                GitlabPost.from_id(7, storage).delete()
+            self.assertEqual({}, Manifest(storage).entries)
+            self.assertEqual([], os.listdir(path))
+
+    def test_writers_keep_each_others_entries(self):
+        # Function instances with a manifest each, writing at the same time.
+        with FakeGitlab() as gitlab:
+            storage = GitlabStorage(base_url=gitlab.files_url,
+                                    commits_url=gitlab.commits_url,
+                                    tree_url=gitlab.tree_url,
+                                    archive_url=gitlab.archive_url)
+            first, second = Manifest(storage), Manifest(storage)
+            self.assertIsNone(first.get(1))
+            self.assertIsNone(second.get(2))
+            first.write(1, ManifestEntry('One', '', 'one.md', 'hash'),
+                        PendingAction('create', 'one.md', 'one', 'Create'))
+            second.write(2, ManifestEntry('Two', '', 'two.md', 'hash'),
+                         PendingAction('create', 'two.md', 'two', 'Create'))
+            self.assertEqual([1, 2], list(Manifest(storage).entries))
+
+            gitlab.requests.clear()
+            preloaded = Manifest(storage, preload=True)
+            self.assertEqual('one.md', preloaded.get(1).path)
+            self.assertIsNone(preloaded.get(3))
+            self.assertEqual([('GET', '/archive.tar.gz', None)], gitlab.requests)
+
+    def test_reverted_on_failure(self):
+        with tempfile.TemporaryDirectory() as path:
+            manifest = Manifest(FileSystemStorage(path))
+            with self.assertRaises(ValueError):
+                manifest.write(1, None, PendingAction(
+                    'delete', 'content/tgposts/1/index.md', None, 'Delete'))
+            manifest.write(2, ManifestEntry('Two', '', 'two.md', 'hash'),
+                           PendingAction('create', 'two.md', 'two', 'Create'))
+            with self.assertRaises(ValueError):
+                manifest.write(2, None, PendingAction(
+                    'delete', 'content/tgposts/2/index.md', None, 'Delete'))
+            self.assertEqual([2], list(manifest.entries))
+            self.assertEqual([2], list(Manifest(manifest.storage).entries))
+
+
+class GitlabBatchWriterTestCase(TestCase):
+    def make_action(self, action, post_id, content=None):
+        return PendingAction(
+            action=action,
+            file_path=f'content/tgposts/{post_id}/index.md',
+            content=content,
+            commit_message=f'{action} {post_id}',
+        )
+
+    def test_flush_on_size(self):
+        with FakeGitlab() as gitlab:
+            gitlab.files['content/tgposts/3/index.md'] = 'old'
+            writer = GitlabBatchWriter(
+                max_actions=3, interval=60, commits_url=gitlab.commits_url,
+            )
+            writer.add(self.make_action('create', 1, 'one'))
+            writer.add(self.make_action('update', 1, 'one, edited'))
+            writer.add(self.make_action('create', 2, 'two'))
+            writer.add(self.make_action('delete', 2))
+            writer.add(self.make_action('create', 4, 'four'))
+            self.assertEqual([], gitlab.commits)
+            writer.add(self.make_action('delete', 3))
+            self.assertEqual(1, len(gitlab.commits))
+            self.assertEqual({
+                'content/tgposts/1/index.md': 'one, edited',
+                'content/tgposts/4/index.md': 'four',
+            }, gitlab.files)
+
+    def test_flush_on_interval(self):
+        with FakeGitlab() as gitlab:
+            writer = GitlabBatchWriter(
+                max_actions=100, interval=0.1, commits_url=gitlab.commits_url,
+            )
+            writer.add(self.make_action('create', 1, 'one'))
+            writer.add(self.make_action('create', 2, 'two'))
+            time.sleep(0.5)
+            self.assertEqual(1, len(gitlab.commits))
+            self.assertEqual(2, len(gitlab.commits[0]['actions']))
+
+    def test_failed_flush_requeued(self):
+        with FakeGitlab() as gitlab:
+            gitlab.files['content/tgposts/1/index.md'] = 'one'
+            writer = GitlabBatchWriter(
+                max_actions=100, interval=60, commits_url=gitlab.commits_url,
+            )
+            writer.add(self.make_action('create', 1, 'new'))
+            with self.assertRaises(ValueError):
+                writer.flush()
+            del gitlab.files['content/tgposts/1/index.md']
+            writer.flush()
+            self.assertEqual({'content/tgposts/1/index.md': 'new'}, gitlab.files)
+
+
+class StorageTestCase(TestCase):
+    def make_action(self, action, post_id, content=None, committed=None):
+        return PendingAction(
+            action=action,
+            file_path=f'content/tgposts/{post_id}/index.md',
+            content=content,
+            commit_message=f'{action} {post_id}',
+            on_commit=[lambda: committed.append(post_id)] if committed is not None else [],
+        )
+
+    def git(self, path, *args):
+        return subprocess.run(['git', '-C', path, *args], check=True,
+                              capture_output=True, text=True).stdout
+
+    def test_filesystem(self):
+        with tempfile.TemporaryDirectory() as path:
+            storage, committed = FileSystemStorage(path), []
+            storage.write(self.make_action('create', 1, 'one', committed))
+            storage.write(self.make_action('update', 1, 'one, edited', committed))
+            self.assertEqual('one, edited', storage.read('content/tgposts/1/index.md'))
+            storage.write(self.make_action('delete', 1, committed=committed))
+            self.assertIsNone(storage.read('content/tgposts/1/index.md'))
+            self.assertEqual([], os.listdir(path))
+            self.assertEqual([1, 1, 1], committed)
+            with self.assertRaises(ValueError):
+                storage.write(self.make_action('delete', 1))
+            blob = bytes(range(256)) * 4096
+            storage.write(PendingAction('create', 'static/blob.bin', None, None,
+                                        file=io.BytesIO(blob)))
+            with open(f'{path}/static/blob.bin', 'rb') as f:
+                self.assertEqual(blob, f.read())
+
+    @skipUnless(shutil.which('git'), 'git is not installed')
+    def test_git_batches_commits_and_pushes(self):
+        with tempfile.TemporaryDirectory() as path:
+            remote, working_copy = f'{path}/remote.git', f'{path}/posts'
+            self.git(path, 'init', '--quiet', '--bare', remote)
+            self.git(path, 'init', '--quiet', working_copy)
+            self.git(working_copy, 'config', 'user.name', 'test')
+            self.git(working_copy, 'config', 'user.email', 'test@localhost')
+            self.git(working_copy, 'remote', 'add', 'origin', remote)
+            storage, committed = GitStorage(
+                working_copy, max_actions=3, interval=60, push_interval=0,
+                remote='origin', branch='master',
+            ), []
+            storage.write(self.make_action('create', 1, 'one', committed))
+            storage.write(self.make_action('create', 2, 'two', committed))
+            self.assertEqual('two', storage.read('content/tgposts/2/index.md'))
+            self.assertEqual([], committed)
+            storage.write(self.make_action('delete', 2, committed=committed))
+            self.assertEqual([1, 2, 2], committed)
+            self.assertEqual('Sync 3 tgposts\n', self.git(remote, 'log', '--format=%s'))
+            self.assertEqual('content/tgposts/1/index.md\n',
+                             self.git(remote, 'ls-tree', '-r', '--name-only', 'master'))
+            storage.flush()
+            self.assertEqual(1, len(self.git(remote, 'log', '--format=%s').splitlines()))
+
+
+class MediaMirrorTestCase(TestCase):
+    def make_photo(self, file_id):
+        return [SimpleNamespace(file_id=f'{file_id}_small', file_unique_id=f'{file_id}_small',
+                                file_size=1),
+                SimpleNamespace(file_id=file_id, file_unique_id=file_id, file_size=None)]
+
+    def make_album(self, *file_ids):
+        return Post.from_media_group([
+            make_message(
+                message_id=message_id,
+                text='Lorem ipsum' if message_id == 1 else None,
+                text_markdown_v2='*Lorem ipsum*' if message_id == 1 else None,
+                date=datetime(2022, 9, 1),
+                edit_date=None,
+                media_group_id='album',
+                photo=self.make_photo(file_id),
+            )
+            for message_id, file_id in enumerate(file_ids, 1)
+        ], render_mode='local')
+
+    def test_streamed_content_addressed(self):
+        content = os.urandom(1024 * 1024)
+        with FakeGitlab() as gitlab, FakeTelegram() as telegram, \
+                patch.object(Post, 'text_body', return_value='<div>Lorem</div>'), \
+                patch.object(Post, 'get_media_html', return_value='<img/>'):
+            telegram.files.update(one=content, two=b'two', repost=content)
+            storage = GitlabStorage(base_url=gitlab.files_url,
+                                    commits_url=gitlab.commits_url)
+            mirror = MediaMirror(
+                bot=RateLimitedBot(token='123:abc', base_url=telegram.bot_api_url,
+                                   base_file_url=telegram.file_url),
+                storage=storage,
+            )
+            gitlab_post = GitlabPost.from_post(
+                self.make_album('one', 'two', 'repost'), storage, mirror)
+            self.assertTrue(gitlab_post.create_or_update())
+
+            path = f'static/tgmedia/{hashlib.sha256(content).hexdigest()[:2]}/' \
+                   f'{hashlib.sha256(content).hexdigest()}.jpg'
+            self.assertEqual(path, gitlab_post.media[0].path)
+            self.assertEqual(path, gitlab_post.media[2].path)
+            self.assertIn(f'- path: {path}', gitlab_post.content)
+            # The repost has the same content, so only two blobs are stored,
+            # in the commit of the post.
+            self.assertEqual(1, len(gitlab.commits))
+            blobs = [a for a in gitlab.commits[0]['actions'] if a.get('encoding') == 'base64']
+            self.assertEqual(2, len(blobs))
+            self.assertEqual(content, base64.b64decode(gitlab.files[path]))
+            self.assertEqual(3, len(telegram.calls('getFile')))
+
+            # Media of an edited post are known from the manifest.
+            edited = GitlabPost.from_post(
+                self.make_album('one', 'two', 'repost'), storage, mirror)
+            self.assertFalse(edited.create_or_update(is_update=True))
+            self.assertEqual(3, len(telegram.calls('getFile')))
+
+
+    def test_network_errors_skip_media(self):
+        import requests
+
+        with FakeGitlab() as gitlab, FakeTelegram() as telegram:
+            telegram.files.update(one=b'one', two=b'two', three=b'three')
+            bot = RateLimitedBot(token='123:abc', base_url=telegram.bot_api_url,
+                                 base_file_url=telegram.file_url)
+            mirror = MediaMirror(bot=bot, storage=GitlabStorage(base_url=gitlab.files_url))
+            get, get_file = http_client.get, bot.get_file
+
+            def get_download(url, **kwargs):
+                if 'one' in url:
+                    raise requests.ConnectionError(f'Max retries exceeded with url: {url}')
+                return get(url, **kwargs)
+
+            def get_file_or_time_out(file_id, **kwargs):
+                if file_id == 'two':
+                    raise TimedOut()
+                return get_file(file_id, **kwargs)
+
+            with patch('http_client.get', get_download), \
+                    patch.object(bot, 'get_file', get_file_or_time_out), \
+                    self.assertLogs('media_mirror') as logs:
+                media = mirror.mirror(self.make_album('one', 'two', 'three').media_group)
+            self.assertEqual(['three'], [m.file_unique_id for m in media])
+            self.assertEqual(2, len(logs.output))
+            self.assertNotIn('123:abc', '\n'.join(logs.output))
+
+    def test_album_edit_keeps_other_media(self):
+        def make_member(message_id, file_id, caption=None):
+            return make_message(
+                message_id=message_id,
+                chat_id=-1001,
+                caption=caption,
+                caption_markdown_v2=caption and f'*{caption}*',
+                date=datetime(2022, 9, 1),
+                edit_date=datetime(2022, 9, 2) if caption == 'Edited' else None,
+                media_group_id='album',
+                photo=self.make_photo(file_id),
+            )
+
+        with FakeGitlab() as gitlab, FakeTelegram() as telegram, \
+                patch.object(Post, 'text_body', return_value='<div>Lorem</div>'), \
+                patch.object(Post, 'get_media_html', return_value='<img/>'), \
+                patch('post.POST_RENDER_MODE', 'local'):
+            telegram.files.update(one=b'one', two=b'two', three=b'three')
+            storage = GitlabStorage(base_url=gitlab.files_url,
+                                    commits_url=gitlab.commits_url)
+            mirror = MediaMirror(
+                bot=RateLimitedBot(token='123:abc', base_url=telegram.bot_api_url,
+                                   base_file_url=telegram.file_url),
+                storage=storage,
+            )
+            # The caption is on the second message.
+            album = Post.from_media_group([
+                make_member(1, 'one'), make_member(2, 'two', 'Lorem'), make_member(3, 'three'),
+            ])
+            GitlabPost.from_post(album, storage, mirror).create_or_update()
+            created = GitlabPost.from_id(1, storage).manifest.get(1)
+
+            bot = SimpleNamespace(routing=RoutingTable([Route(channel_id=-1001, storage=storage)]))
+            post = TelegramBot.get_edited_post(bot, make_member(2, 'two', 'Edited'))
+            self.assertEqual(1, post.post_id)
+            edited = GitlabPost.from_post(post, storage, mirror)
+            self.assertTrue(edited.create_or_update(is_update=True))
+            self.assertEqual(['one', 'two', 'three'], [m.file_unique_id for m in edited.media])
+            entry = edited.manifest.get(1)
+            self.assertEqual('Edited', entry.title)
+            self.assertEqual([1, 2, 3], entry.message_ids)
+            self.assertEqual((created.media, created.media_group),
+                             (entry.media, entry.media_group))
+            self.assertEqual(['content/tgposts/1/index.md', 'data/tgposts/1.json'],
+                             sorted(p for p in gitlab.files if not p.startswith('static/')))
+            self.assertEqual(3, len(telegram.calls('getFile')))
+
+
+class ReconcileTestCase(TestCase):
+    def make_message(self, message_id, text, media_group_id=None):
+        return make_message(
+            message_id=message_id,
+            text=text,
+            text_markdown_v2=f'*{text}*',
+            date=datetime(2022, 9, message_id),
+            edit_date=None,
+            media_group_id=media_group_id,
+        )
+
+    def test_repository_matches_channel(self):
+        with FakeGitlab() as gitlab, \
+                patch.object(Post, 'text_body', return_value='<div>Lorem</div>'), \
+                patch.object(Post, 'get_media_html', return_value='<img/>'), \
+                patch('post.POST_RENDER_MODE', 'local'), \
+                patch('storage.GITLAB_TREE_PAGE_SIZE', 1):
+            storage = GitlabStorage(base_url=gitlab.files_url,
+                                    commits_url=gitlab.commits_url,
+                                    tree_url=gitlab.tree_url,
+                                    archive_url=gitlab.archive_url)
+            channel = {
+                1: self.make_message(1, 'One'),
+                2: self.make_message(2, 'Two'),
+                3: self.make_message(3, 'Three'),
+                5: self.make_message(5, 'Five', media_group_id='a'),
+                6: self.make_message(6, 'Six', media_group_id='a'),
+            }
+            for message_id in (1, 2, 3):
+                GitlabPost.from_post(Post.from_message(channel[message_id]),
+                                     storage).create_or_update()
+            gitlab.files['content/tgposts/4/index.md'] = 'Four'
+            gitlab.files['content/tgposts/6/index.md'] = 'Six'
+            channel[2] = self.make_message(2, 'Two, edited')
+            del channel[3]
+
+            fetched = []
+
+            def fetch_message(message_id):
+                fetched.append(message_id)
+                return channel.get(message_id)
+
+            reconcile = Reconcile(storage, fetch_message)
+            gitlab.requests.clear()
+            report = reconcile.run(post_ids=[5])
+            # The manifest is read in one archive download.
+            self.assertEqual(
+                ['/archive.tar.gz'],
+                [p for m, p, _ in gitlab.requests if m == 'GET' and p != '/tree'],
+            )
+            self.assertEqual((5, 6, 1), (report.listed, report.checked, report.unchanged))
+            self.assertEqual(([5], [2], [3, 4, 6]),
+                             (report.create, report.update, report.delete))
+            # Messages are fetched once, albums are read past their first post.
+            self.assertEqual(len(fetched), len(set(fetched)))
+            self.assertEqual(3, len(gitlab.commits))
+
+            reconcile.run(dry_run=False, post_ids=[5])
+            self.assertEqual(4, len(gitlab.commits))
+            self.assertEqual(
+                ['content/tgposts/1/index.md', 'content/tgposts/2/index.md',
+                 'content/tgposts/5/index.md', 'data/tgposts/1.json',
+                 'data/tgposts/2.json', 'data/tgposts/5.json'],
+                sorted(gitlab.files),
+            )
+            self.assertEqual([1, 2, 5], list(Manifest(storage).entries))
+
+            report = Reconcile(storage, channel.get).run(post_ids=[5])
+            self.assertEqual(3, report.unchanged)
+            self.assertFalse(report.create or report.update or report.delete)
+
+
+    def test_foreign_errors_abort(self):
+        class ForwardingBot:
+            def __init__(self, error):
+                self.error = error
+
+            def forward_message(self, **kwargs):
+                raise BadRequest(self.error)
+
+        with FakeGitlab() as gitlab, \
+                patch.object(Post, 'text_body', return_value='<div>Lorem</div>'), \
+                patch('post.POST_RENDER_MODE', 'local'):
+            storage = GitlabStorage(base_url=gitlab.files_url,
+                                    commits_url=gitlab.commits_url,
+                                    tree_url=gitlab.tree_url,
+                                    archive_url=gitlab.archive_url)
+            GitlabPost.from_post(Post.from_message(self.make_message(1, 'One')),
+                                 storage).create_or_update()
+            for error in ('Chat not found', "Message can't be forwarded"):
+                with self.subTest(error=error), self.assertRaises(BadRequest):
+                    bot = ForwardingBot(error)
+                    Reconcile(storage, lambda i: forward_channel_message(bot, i, -1001)).run(
+                        dry_run=False)
+            self.assertEqual(['content/tgposts/1/index.md', 'data/tgposts/1.json'],
+                             sorted(gitlab.files))
+
+            bot = ForwardingBot('Message to forward not found')
+            report = Reconcile(storage, lambda i: forward_channel_message(bot, i, -1001)).run()
+            self.assertEqual([1], report.delete)
+
+
+class BackfillTestCase(TestCase):
+    def make_forward(self, message_id, text=None, media_group_id=None, photo=False):
+        return make_message(
+            message_id=1000 + message_id,
+            forward_from_message_id=message_id,
+            forward_from_chat=SimpleNamespace(id=-1001, link='https://t.me/chan'),
+            forward_date=datetime(2022, 9, 1),
+            date=datetime(2022, 9, 2),
+            edit_date=None,
+            media_group_id=media_group_id,
+            **({'caption': text, 'caption_markdown_v2': text and f'*{text}*',
+                'photo': [SimpleNamespace(file_id=str(message_id),
+                                          file_unique_id=str(message_id), file_size=1)]}
+               if photo else {'text': text, 'text_markdown_v2': f'*{text}*'}),
+        )
+
+    def test_albums_across_pages_resumed(self):
+        channel = {
+            1: self.make_forward(1, 'One'),
+            # The caption is not on the first member, the album spans pages.
+            2: self.make_forward(2, None, 'a', photo=True),
+            3: self.make_forward(3, 'Album', 'a', photo=True),
+            4: self.make_forward(4, None, 'a', photo=True),
+            6: self.make_forward(6, None, photo=True),
+            7: self.make_forward(7, 'Seven'),
+        }
+        forwarded, interrupted = [], []
+
+        def forward(backfill, message_id):
+            forwarded.append(message_id)
+            if message_id == 5 and not interrupted:
+                interrupted.append(message_id)
+                raise RuntimeError('Interrupted')
+            return channel.get(message_id)
+
+        albums, write = {}, Backfill.write
+
+        def write_post(backfill, post, post_paths):
+            albums[post.post_id] = [m.forward_from_message_id for m in post.media_group]
+            write(backfill, post, post_paths)
+
+        with tempfile.TemporaryDirectory() as path, \
+                patch.object(Post, 'text_body', return_value='<div>Lorem</div>'), \
+                patch.object(Post, 'get_media_html', return_value='<img/>'), \
+                patch.object(Backfill, 'forward', forward), \
+                patch.object(Backfill, 'write', write_post), \
+                patch('post.POST_RENDER_MODE', 'local'):
+            storage = FileSystemStorage(path)
+            backfill = Backfill(
+                telegram_bot=SimpleNamespace(bot=None),
+                route=Route(channel_id=-1001),
+                storage=storage,
+                first_id=1,
+                last_id=7,
+                page_size=3,
+                checkpoint_path=Path(path) / 'checkpoint.json',
+            )
+            with self.assertRaises(RuntimeError):
+                backfill.run()
+            self.assertEqual([1], list(Manifest(storage).entries))
+            self.assertEqual(2, backfill.load_checkpoint())
+
+            forwarded.clear()
+            backfill.run()
+            self.assertEqual(2, min(forwarded))
+            entries = Manifest(storage).entries
+            self.assertEqual([1, 2, 7], list(entries))
+            self.assertEqual('Album', entries[2].title)
+            self.assertEqual([2, 3, 4], albums[2])
+
+    def test_repository_read_once_and_committed_per_page(self):
+        channel = {i: self.make_forward(i, f'Post {i}') for i in range(1, 5)}
+        with FakeGitlab() as gitlab, tempfile.TemporaryDirectory() as path, \
+                patch.object(Post, 'text_body', return_value='<div>Lorem</div>'), \
+                patch.object(Backfill, 'forward', lambda backfill, i: channel.get(i)), \
+                patch('post.POST_RENDER_MODE', 'local'):
+            storage = GitlabStorage(
+                base_url=gitlab.files_url,
+                commits_url=gitlab.commits_url,
+                tree_url=gitlab.tree_url,
+                archive_url=gitlab.archive_url,
+                writer=GitlabBatchWriter(max_actions=4 * ACTIONS_PER_POST,
+                                         commits_url=gitlab.commits_url),
+            )
+            GitlabPost.from_post(Post.from_message(channel[1]), storage).create_or_update()
+            storage.flush()
+            channel[1] = self.make_forward(1, 'Post 1, edited')
+            gitlab.requests.clear()
+            Backfill(
+                telegram_bot=SimpleNamespace(bot=None),
+                route=Route(channel_id=-1001),
+                storage=storage,
+                first_id=1,
+                last_id=4,
+                page_size=4,
+                checkpoint_path=Path(path) / 'checkpoint.json',
+            ).run()
+            self.assertEqual(
+                [('GET', '/archive.tar.gz'), ('GET', '/tree'), ('POST', '/commits')],
+                [(m, p) for m, p, _ in gitlab.requests],
+            )
+            self.assertEqual(
+                ['update', 'update', 'create', 'create', 'create', 'create', 'create', 'create'],
+                [a['action'] for a in gitlab.commits[-1]['actions']],
+            )
+
+
+class RoutingTestCase(TestCase):
+    @patch('routing.LOG_CHAT_ID', -1002)
+    def test_from_json(self):
+        routing = RoutingTable.from_json(json.dumps([
+            {'channel_id': -1001, 'storage_location': 'https://gitlab.test/files'},
+            {'channel_id': -1003, 'log_chat_id': -1004,
+             'storage_location': 'https://gitlab.test/files',
+             'post_file_path': 'content/other/{}.md'},
+            {'channel_id': -1005, 'storage_location': 'https://gitlab.test/other/files'},
+        ]))
+        self.assertEqual([-1001, -1003, -1005], routing.channel_ids)
+        first, second, third = routing.routes.values()
+        self.assertEqual(-1002, first.log_chat_id)
+        self.assertIs(first.storage, second.storage)
+        self.assertIsNot(first.storage, third.storage)
+        self.assertEqual('https://gitlab.test/other/tree', third.storage.tree_url)
+        self.assertIs(first, routing.default)
+        self.assertIsNone(routing.get(-1002))
+        with self.assertRaises(ValueError):
+            RoutingTable([Route(channel_id=-1001), Route(channel_id=-1001)])
+
+    def test_channels_synced_to_their_repositories(self):
+        text, photo = (load_scenarios()[name].updates[0] for name in ('text', 'photo'))
+        text = {**text, 'update_id': 1, 'channel_post': {
+            **text['channel_post'],
+            'chat': {**text['channel_post']['chat'], 'id': -1003},
+        }}
+        with tempfile.TemporaryDirectory() as path:
+            route = Route(channel_id=-1003, log_chat_id=-1004,
+                          storage_backend='filesystem', storage_location=path,
+                          post_file_path='posts/{}.md')
+            with offline_run(routes=[route]) as run:
+                run.telegram_bot.process_webhook_request(text)
+                run.telegram_bot.process_webhook_request({**photo, 'update_id': 2})
+                self.assertEqual(['data/tgposts/101.json', 'posts/101.md'],
+                                 route.storage.list_files(''))
+                self.assertEqual(['content/tgposts/102/index.md', 'data/tgposts/102.json'],
+                                 sorted(run.gitlab.files))
+                logs = run.telegram.calls('sendMessage')
+                self.assertEqual([-1004, -1002], [int(data['chat_id']) for data in logs])
+                self.assertIn('del_attempt|101|-1003', str(logs[0]['reply_markup']))
+
+
+class AsyncPipelineTestCase(TestCase):
+    def test_bounded_background_jobs_with_concurrent_io(self):
+        pipeline = AsyncPipeline(max_in_flight=2)
+        running, peak = [], []
+
+        def job():
+            running.append(1)
+            peak.append(len(running))
+            start = time.monotonic()
+            pipeline.gather(lambda: time.sleep(0.1), lambda: time.sleep(0.1))
+            running.pop()
+            return time.monotonic() - start
+
+        futures = [pipeline.submit(job) for _ in range(4)]
+        pipeline.drain(timeout=5)
+        self.assertEqual(2, max(peak))
+        for future in futures:
+            self.assertLess(future.result(), 0.19)
+
+    def test_gather_concurrent_without_async_updates(self):
+        # Each call waits for the other, so they only finish side by side;
+        # nested calls run inline.
+        barrier = Barrier(2, timeout=1)
+
+        def call():
+            barrier.wait()
+            return gather(lambda: 1, lambda: 2)
+
+        with patch('async_pipeline.ASYNC_UPDATES', False):
+            self.assertEqual([[1, 2], [1, 2]], gather(call, call))
+
+
+class UpdateStoreTestCase(TestCase):
+    def check_store(self, store):
+        self.assertTrue(store.claim(1, {'update_id': 1}))
+        self.assertTrue(store.claim(2, {'update_id': 2}))
+        self.assertFalse(store.claim(1, {'update_id': 1}))
+        store.complete(1)
+        self.assertFalse(store.claim(1, {'update_id': 1}))
+        self.assertEqual([], list(store.pending(stale_after=60)))
+        self.assertEqual([(2, {'update_id': 2})], list(store.pending(stale_after=0)))
+        # A stale update is taken over once, a completed one never.
+        self.assertFalse(store.claim(2, {'update_id': 2}))
+        self.assertTrue(store.claim(2, {'update_id': 2}, stale_after=0))
+        self.assertFalse(store.claim(2, {'update_id': 2}))
+        store.complete(2)
+        self.assertEqual([], list(store.pending(stale_after=0)))
+        self.assertFalse(store.claim(2, {'update_id': 2}, stale_after=0))
+
+    def test_memory_store(self):
+        self.check_store(MemoryUpdateStore())
+
+    def test_sqlite_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/updates.db'
+            self.check_store(SQLiteUpdateStore(path))
+            store = SQLiteUpdateStore(path)
+            self.assertFalse(store.claim(2, {'update_id': 2}))
+            self.assertTrue(store.claim(3, {'update_id': 3}))
+
+
+class KeyedWorkerPoolTestCase(TestCase):
+    def test_ordered_per_key_parallel_across_keys(self):
+        pool = KeyedWorkerPool(workers=4, queue_size=16)
+        done, blocked = [], Event()
+        pool.submit('slow', blocked.wait, 5)
+        for i in range(3):
+            pool.submit('slow', done.append, ('slow', i))
+            pool.submit(i, done.append, ('fast', i))
+        time.sleep(0.1)
+        self.assertEqual([('fast', 0), ('fast', 1), ('fast', 2)], sorted(done))
+        blocked.set()
+        pool.shutdown()
+        self.assertEqual([('slow', 0), ('slow', 1), ('slow', 2)],
+                         [item for item in done if item[0] == 'slow'])
+
+    def test_groups_take_turns(self):
+        pool = KeyedWorkerPool(workers=1, queue_size=16)
+        done, blocked = [], Event()
+        pool.submit('blocker', blocked.wait, 5, group='a')
+        for key in ('a1', 'a2', 'a3'):
+            pool.submit(key, done.append, key, group='a')
+        pool.submit('b1', done.append, 'b1', group='b')
+        blocked.set()
+        pool.shutdown()
+        self.assertEqual(['a1', 'b1', 'a2', 'a3'], done)
+
+    def test_update_keys(self):
+        keys = {
+            name: [TelegramBot.get_update_key(Update.de_json(data, None))
+                   for data in scenario.updates]
+            for name, scenario in load_scenarios().items()
+        }
+        self.assertEqual({
+            'text': [(-1001, 101)],
+            'photo': [(-1001, 102)],
+            'album': [(-1001, 103), (-1001, 104), (-1001, 105)],
+            'edit': [(-1001, 101)],
+            'delete': [(-1001, 101)],
+        }, keys)
+
+
+class RecordingBot:
+    def __init__(self, retry_after: int = 0):
+        self.calls = []
+        self.retry_after = retry_after
+
+    def record(self, method, **kwargs):
+        if self.retry_after:
+            retry_after, self.retry_after = self.retry_after, 0
+            raise RetryAfter(retry_after)
+        self.calls.append((method, kwargs))
+        return SimpleNamespace(
+            message_id=len(self.calls),
+            text_html=kwargs['text'],
+        )
+
+    def send_message(self, **kwargs):
+        return self.record('send_message', **kwargs)
+
+    def edit_message_text(self, **kwargs):
+        return self.record('edit_message_text', **kwargs)
+
+
+class LogSinkTestCase(TestCase):
+    def test_lines_coalesced(self):
+        bot = RecordingBot()
+        sink = LogSink(bot=bot, interval=60, max_lines=3, rate=100, burst=10)
+        sink.write(1, 'one')
+        sink.write(1, 'two', silent=False)
+        self.assertEqual([], bot.calls)
+        sink.write(1, 'three')
+        time.sleep(0.1)
+        self.assertEqual([('send_message', {
+            'chat_id': 1,
+            'text': 'one\ntwo\nthree',
+            'parse_mode': 'HTML',
+            'disable_notification': False,
+        })], bot.calls)
+
+    def test_buttons_queued_per_chat(self):
+        bot = RecordingBot()
+        sink = LogSink(bot=bot, interval=0.1, rate=2, burst=1)
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton(text='🗑', callback_data='del')]])
+        start = time.monotonic()
+        sink.write(1, 'line')
+        sink.send(1, 'post 1', reply_markup=markup)
+        sink.send(1, 'post 2', reply_markup=markup)
+        sink.write(2, 'other chat')
+        self.assertLess(time.monotonic() - start, 0.05)
+        time.sleep(0.3)
+        # The second message waits for the first chat's bucket, the other
+        # chat does not.
+        self.assertEqual(['line', 'other chat'], sorted(kwargs['text'] for _, kwargs in bot.calls))
+        sink.flush()
+        self.assertEqual(['line', 'post 1', 'post 2'],
+                         [kwargs['text'] for _, kwargs in bot.calls if kwargs['chat_id'] == 1])
+        self.assertEqual(markup, bot.calls[-1][1]['reply_markup'])
+
+    def test_series_edits_once_per_flush_and_rolls_over(self):
+        bot = RecordingBot()
+        sink = LogSink(bot=bot, interval=60, max_lines=100, rate=100, burst=10)
+        sink.start_series(1)
+        sink.write(1, 'first')
+        sink.flush()
+        for i in range(3):
+            sink.write(1, f'line {i}')
+        sink.flush()
+        self.assertEqual(['send_message', 'edit_message_text'],
+                         [method for method, _ in bot.calls])
+        self.assertEqual('first\nline 0\nline 1\nline 2', bot.calls[-1][1]['text'])
+        sink.write(1, 'x' * (MESSAGE_LENGTH_LIMIT - 10))
+        sink.end_series(1)
+        self.assertEqual('send_message', bot.calls[-1][0])
+        self.assertEqual(MESSAGE_LENGTH_LIMIT - 10, len(bot.calls[-1][1]['text']))
+
+    def test_truncated_between_tags(self):
+        bot = RecordingBot()
+        sink = LogSink(bot=bot, interval=0, rate=100, burst=10)
+        url = 'https://t.me/channel/1'
+        sink.write(1, f'<b>{"x" * (MESSAGE_LENGTH_LIMIT - 12)}&amp;</b> <a href="{url}">link</a>')
+        text = bot.calls[-1][1]['text']
+        self.assertLessEqual(len(text), MESSAGE_LENGTH_LIMIT)
+        self.assertTrue(text.endswith('x…</b>'))
+        sink.write(1, f'<i>{"y" * (MESSAGE_LENGTH_LIMIT - 20)}</i><a href="{url}">link</a>')
+        text = bot.calls[-1][1]['text']
+        self.assertLessEqual(len(text), MESSAGE_LENGTH_LIMIT)
+        self.assertTrue(text.endswith('y</i>…'))
+
+    def test_retry_after(self):
+        bot = RecordingBot(retry_after=1)
+        sink = LogSink(bot=bot, interval=0, rate=100, burst=10)
+        start = time.monotonic()
+        sink.write(1, 'line')
+        self.assertGreaterEqual(time.monotonic() - start, 1)
+        self.assertEqual(1, len(bot.calls))
+
+
+class RateLimiterTestCase(TestCase):
+    def setUp(self):
+        self.limiter = RateLimiter(
+            limits={'test': (1000, 1000), 'test:slow': (10, 1)},
+            retry_policy=RetryPolicy(max_attempts=3, base_delay=0.01),
+        )
+
+    def failing(self, *errors):
+        errors = list(errors)
+
+        def call():
+            if errors:
+                raise errors.pop(0)
+            return 'ok'
+
+        return call
+
+    def test_retries_transient_errors(self):
+        call = self.failing(TimedOut(), RetryAfter(0.1))
+        self.assertEqual('ok', self.limiter.call('test:send', call))
+        self.assertEqual({'calls': 3, 'throttled': 1, 'retried': 2, 'failed': 0},
+                         self.limiter.stats()['test:send'])
+
+    def test_gives_up(self):
+        with self.assertRaises(BadRequest):
+            self.limiter.call('test:send', self.failing(BadRequest('bad')))
+        with self.assertRaises(TimedOut):
+            self.limiter.call('test:send', self.failing(*[TimedOut()] * 3))
+        self.assertEqual(2, self.limiter.stats()['test:send']['failed'])
+
+    def test_retries_unsent_only_if_not_idempotent(self):
+        refused = NetworkError('urllib3 HTTPError')
+        refused.__cause__ = NewConnectionError(None, 'Connection refused')
+        call = self.failing(refused, RetryAfter(0.01))
+        self.assertEqual('ok', self.limiter.call('test:send', call, idempotent=False))
+        for error in (TimedOut(), NetworkError('Bad Gateway')):
+            with self.subTest(error=error), self.assertRaises(type(error)):
+                self.limiter.call('test:send', self.failing(error), idempotent=False)
+        responses = iter([503, 429, 200])
+        result = self.limiter.call(
+            'test:http', lambda: SimpleNamespace(status_code=next(responses), headers={}),
+            result_retry_after=partial(http_client.get_retry_after, idempotent=False),
+        )
+        self.assertEqual(503, result.status_code)
+
+    def test_retries_results(self):
+        responses = iter([429, 503, 200])
+        result = self.limiter.call(
+            'test:http', lambda: next(responses),
+            result_retry_after=lambda status: 0 if status != 200 else None,
+        )
+        self.assertEqual(200, result)
+
+    def test_paces_calls(self):
+        start = time.monotonic()
+        for _ in range(3):
+            self.limiter.call('test:slow', lambda: None)
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+        self.assertEqual(2, self.limiter.stats()['test:slow']['throttled'])
+
+
+class ImportTimeTestCase(TestCase):
+    def test_cold_start_budget(self):
+        for path, budget_ms in IMPORT_TIME_BUDGETS_MS.items():
+            cumulative_ms, loaded = measure_import(path)
+            self.assertEqual([], loaded, path)
+            self.assertLess(cumulative_ms, budget_ms, path)
+
+
+class TimingTestCase(TestCase):
+    def test_disabled_is_noop(self):
+        def handler():
+            pass
+
+        self.assertIs(handler, timing.traced('handler')(handler))
+        self.assertIs(timing.span('a'), timing.span('b'))
+
+    def test_trace_record(self):
+        pipeline = AsyncPipeline(max_in_flight=1)
+        metrics = timing.Metrics()
+        with patch('timing.TIMING_ENABLED', True), \
+                patch('timing.metrics', metrics), \
+                patch('timing.emit', wraps=timing.emit) as emit:
+            @timing.traced('nested')
+            def nested():
+                with timing.span('fetch'):
+                    time.sleep(0.01)
+
+            @timing.traced('handler')
+            def handler(update):
+                pipeline.gather(nested, nested)
+                with timing.span('write'):
+                    pass
+
+            handler(SimpleNamespace(update_id=42))
+        record = emit.call_args.args[0]
+        self.assertEqual(1, emit.call_count)
+        self.assertEqual('handler', record['trace'])
+        self.assertEqual(42, record['update_id'])
+        self.assertEqual('ok', record['status'])
+        self.assertEqual({'nested', 'fetch', 'write'}, set(record['stages_ms']))
+        self.assertGreaterEqual(record['stages_ms']['fetch'], 20)
+        self.assertIn('tgsync_stage_seconds_count{trace="handler",stage="fetch"} 1',
+                      metrics.render_prometheus())
+
+    def test_concurrent_dumps(self):
+        metrics = timing.Metrics()
+        metrics.observe({'trace': 'handler', 'status': 'ok', 'duration_ms': 1,
+                         'stages_ms': {'fetch': 1}})
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.prom')
+            with ThreadPoolExecutor(8) as executor:
+                for future in [executor.submit(metrics.dump, path) for _ in range(200)]:
+                    future.result()
+            self.assertEqual(['metrics.prom'], os.listdir(directory))
+            with open(path) as f:
+                self.assertEqual(metrics.render_prometheus(), f.read())
+
+    def test_emit_never_raises(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('timing.metrics', timing.Metrics()), \
+                patch('timing.METRICS_DUMP_PATH', os.path.join(directory, 'missing', 'metrics.prom')), \
+                self.assertLogs('timing', 'ERROR'):
+            timing.emit({'trace': 'handler', 'status': 'ok', 'duration_ms': 1, 'stages_ms': {}})
+
+
+class EndToEndTestCase(TestCase):
+    def test_scenarios_replayed_offline(self):
+        scenarios = load_scenarios()
+        with offline_run() as run:
+            for name, scenario in scenarios.items():
+                with self.subTest(name):
+                    run.run(scenario)
+                    self.assertGreaterEqual(run.run_traced(scenario), 0)
+            self.assertEqual([(-1001, 101)] * 2, [
+                (int(data['chat_id']), int(data['message_id']))
+                for data in run.telegram.calls('deleteMessage')
+            ])
+            # One answer per query, then the button shows the outcome.
+            self.assertEqual(['Deleting...'] * 2, [
+                data['text'] for data in run.telegram.calls('answerCallbackQuery')
+            ])
+            self.assertEqual(2, sum(
+                'deleted|101|-1001' in str(data['reply_markup'])
+                for data in run.telegram.calls('editMessageReplyMarkup')
+            ))
+            self.assertEqual([
+                'content/tgposts/102/index.md',
+                'content/tgposts/103/index.md',
+                'data/tgposts/102.json',
+                'data/tgposts/103.json',
+            ], sorted(run.gitlab.files))
+            self.assertEqual('content/tgposts/103/index.md',
+                             json.loads(run.gitlab.files['data/tgposts/103.json'])['path'])
+
+    def test_deleted_button_only_answered(self):
+        delete = load_scenarios()['delete'].updates[0]
+        with offline_run() as run:
+            run.telegram_bot.process_webhook_request({**delete, 'callback_query': {
+                **delete['callback_query'],
+                'data': 'deleted|101|-1001',
+            }})
+            self.assertEqual(['Already deleted'], [
+                data['text'] for data in run.telegram.calls('answerCallbackQuery')
+            ])
+            # Neither deleted again nor logged as an error.
+            self.assertEqual([], run.telegram.calls('deleteMessage'))
+            self.assertEqual([], run.telegram.calls('sendMessage'))
+
+    def test_filesystem_storage(self):
+        with offline_run('filesystem') as run:
+            for scenario in load_scenarios().values():
+                run.run(scenario)
+            self.assertEqual([], run.gitlab.requests)
+
+    def test_edits_debounced_in_polling_mode(self):
+        scenario = load_scenarios()['edit']
+        edit = scenario.updates[0]
+        with offline_run() as run, \
+                patch.object(run.telegram_bot, 'edits',
+                             Coalescer(window=0.2, sliding=True, remember_closed=False)):
+            run.prepare(scenario)
+            commits = len(run.gitlab.commits)
+            pool = KeyedWorkerPool(workers=4, queue_size=16)
+            dispatcher = PooledDispatcher(
+                bot=run.telegram_bot.bot,
+                update_queue=Queue(),
+                workers=1,
+                pool=pool,
+                get_update_key=TelegramBot.get_update_key,
+                get_update_group=TelegramBot.get_update_group,
+                is_debounced=TelegramBot.is_debounced,
+                debouncer=run.telegram_bot.debouncer,
+            )
+            run.telegram_bot.set_handlers(dispatcher)
+            start = time.perf_counter()
+            for i in range(3):
+                dispatcher.process_update(Update.de_json({
+                    'update_id': i + 1,
+                    'edited_channel_post': {
+                        **edit['edited_channel_post'],
+                        'edit_date': edit['edited_channel_post']['edit_date'] + i,
+                        'text': f'Edit {i}\n\nText',
+                        'entities': [],
+                    },
+                }, run.telegram_bot.bot))
+            # The quiet period is waited for on a timer, not in a worker.
+            self.assertLess(time.perf_counter() - start, 0.1)
+            self.assertEqual({}, pool._queues)
+            time.sleep(0.4)
+            pool.shutdown()
+            # Before the fake Bot API stops, or the flush timer fires later.
+            run.telegram_bot.log_sink.flush()
+            post = run.telegram_bot.routing.default.storage.read('content/tgposts/101/index.md')
+            self.assertIn('title: Edit 2', post)
+            self.assertEqual(commits + 1, len(run.gitlab.commits))
+
+    def test_edits_debounced_on_the_webhook_pool(self):
+        scenario = load_scenarios()['edit']
+        edit = scenario.updates[0]
+        with offline_run() as run, \
+                patch.object(run.telegram_bot, 'edits',
+                             Coalescer(window=0.2, sliding=True, remember_closed=False)), \
+                patch.object(run.telegram_bot, 'pool', KeyedWorkerPool(workers=4, queue_size=16)):
+            run.prepare(scenario)
+            commits = len(run.gitlab.commits)
+            for i in range(3):
+                TelegramBot.process_webhook_request({
+                    'update_id': i + 1,
+                    'edited_channel_post': {
+                        **edit['edited_channel_post'],
+                        'edit_date': edit['edited_channel_post']['edit_date'] + i,
+                        'text': f'Edit {i}\n\nText',
+                        'entities': [],
+                    },
+                })
+            self.assertEqual({}, run.telegram_bot.pool._queues)
+            run.telegram_bot.shutdown(timeout=5)
+            post = run.telegram_bot.routing.default.storage.read('content/tgposts/101/index.md')
+            self.assertIn('title: Edit 2', post)
+            self.assertEqual(commits + 1, len(run.gitlab.commits))
+            # The superseded edits are done with too.
+            self.assertEqual([], list(update_store.get_update_store().pending(stale_after=0)))
+
+    def test_stale_updates_processed_after_restart(self):
+        # Claimed by a process that died 10 minutes ago.
+        text, photo = (load_scenarios()[name].updates[0] for name in ('text', 'photo'))
+        store = MemoryUpdateStore()
+        claimed_at = time.time() - 600
+        store._updates.update({
+            1: (claimed_at, {**text, 'update_id': 1}),
+            2: (claimed_at, {**photo, 'update_id': 2}),
+        })
+        with offline_run() as run, patch('update_store._store', store):
+            # Redelivered by Telegram, then found by the drain.
+            run.telegram_bot.process_webhook_request({**text, 'update_id': 1})
+            self.assertIn('content/tgposts/101/index.md', run.gitlab.files)
+            self.assertIn('content/tgposts/102/index.md', run.gitlab.files)
+            self.assertEqual([], list(store.pending(stale_after=0)))
+
+    def test_failed_write_not_logged(self):
+        text = load_scenarios()['text'].updates[0]
+        with offline_run() as run, \
+                patch('async_pipeline.ASYNC_UPDATES', True), \
+                patch.object(GitlabPost, 'create_or_update', side_effect=ValueError('GitLab is down')):
+            post = Post.from_message(Update.de_json(text, run.telegram_bot.bot).channel_post)
+            with self.assertRaises(ValueError):
+                run.telegram_bot.create_or_update_post(post, run.telegram_bot.routing.default)
+            run.telegram_bot.log_sink.flush()
+            self.assertEqual([], run.telegram.calls('sendMessage'))
+
+    def test_delete_retried_after_failure(self):
+        scenario = load_scenarios()['delete']
+        with offline_run() as run:
+            bot, route = run.telegram_bot, run.telegram_bot.routing.default
+            run.prepare(scenario)
+            with patch.object(GitlabPost, 'delete', side_effect=ValueError('GitLab is down')), \
+                    self.assertRaises(ValueError):
+                bot.delete_post(101, route)
+            bot.log_sink.flush()
+            # The message stays, and nothing is logged, until storage is done.
+            self.assertEqual([], run.telegram.calls('deleteMessage'))
+            self.assertEqual([], run.telegram.calls('sendMessage'))
+
+            with patch.object(RateLimitedBot, 'delete_message',
+                              side_effect=BadRequest('Message to delete not found')):
+                bot.delete_post(101, route)
+                # Retried once the storage part was done.
+                bot.delete_post(101, route)
+            bot.log_sink.flush()
+            self.assertNotIn('content/tgposts/101/index.md', run.gitlab.files)
+            logged = ''.join(data['text'] for data in run.telegram.calls('sendMessage'))
+            self.assertEqual(2, logged.count('🗑 #101'))
+
+
+class WebhookAppTestCase(TestCase):
+    SECRET = [(b'x-telegram-bot-api-secret-token', b'secret')]
+
+    def get_body(self, name, update_id):
+        return json.dumps({**load_scenarios()[name].updates[0], 'update_id': update_id}).encode()
+
+    async def post(self, app, chunks, headers=SECRET, method='POST'):
+        messages = [
+            {'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+            for i, chunk in enumerate(chunks)
+        ]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': '/', 'headers': list(headers)}
+        await app(scope, receive, send)
+        return sent[0]['status'], sent[1]['body']
+
+    def test_rejected_requests(self):
+        body = self.get_body('text', 1)
+        app = WebhookApp(secret_token='secret', max_body_size=len(body))
+        too_long = [*self.SECRET, (b'content-length', str(len(body) + 1).encode())]
+        for expected, args in [
+            (403, ([body], [])),
+            (403, ([body], [(b'x-telegram-bot-api-secret-token', b'other')])),
+            (405, ([b''], self.SECRET, 'GET')),
+            (413, ([body], too_long)),
+            (413, ([body[:10], body[10:], b' '],)),
+            (400, ([b'{}'],)),
+        ]:
+            with self.subTest(expected=expected, args=args):
+                self.assertEqual(expected, asyncio.run(self.post(app, *args))[0])
+
+    @patch('auth.APP_TOKEN', 'app')
+    @patch('auth.WEBHOOK_SECRET_TOKEN', 'secret')
+    @patch.object(TelegramBot, 'process_request', return_value='request')
+    @patch.object(TelegramBot, 'process_webhook_request', return_value='update')
+    def test_gcf_call_authorized(self, *_):
+        def make_request(data, secret=''):
+            return SimpleNamespace(
+                method='POST',
+                headers={'X-Telegram-Bot-Api-Secret-Token': secret},
+                get_json=lambda **kwargs: data,
+            )
+
+        for expected, request in [
+            ('update', make_request({'update_id': 1}, 'secret')),
+            ('Forbidden', make_request({'update_id': 1}, 'other')),
+            ('Forbidden', make_request({'update_id': 1})),
+            ('request', make_request({'token': 'app', 'command': 'sync'})),
+            ('Forbidden', make_request({'token': 'other'})),
+            ('Forbidden', make_request({'token': 1})),
+            ('Forbidden', make_request(None)),
+        ]:
+            for entry_point in (main.main, TelegramBot.process_gcf_call):
+                with self.subTest(expected=expected, request=request, entry_point=entry_point):
+                    self.assertEqual(expected, entry_point(request))
+
+    def test_concurrent_deliveries_drained_on_shutdown(self):
+        with offline_run() as run:
+            app = WebhookApp(secret_token='secret')
+
+            async def serve():
+                lifespan, sent = asyncio.Queue(), []
+
+                async def send(message):
+                    sent.append(message['type'])
+
+                server = asyncio.create_task(app({'type': 'lifespan'}, lifespan.get, send))
+                await lifespan.put({'type': 'lifespan.startup'})
+                responses = await asyncio.gather(
+                    self.post(app, [self.get_body('text', 1)]),
+                    self.post(app, [self.get_body('photo', 2)]),
+                    self.post(app, [self.get_body('photo', 2)]),
+                )
+                await lifespan.put({'type': 'lifespan.shutdown'})
+                await server
+                late = await self.post(app, [self.get_body('text', 3)])
+                return sent, responses, late
+
+            sent, responses, late = asyncio.run(serve())
+            self.assertEqual(['lifespan.startup.complete', 'lifespan.shutdown.complete'], sent)
+            self.assertEqual([(200, b'ok')] * 3, responses)
+            self.assertEqual(503, late[0])
+            self.assertIs(app.pool, run.telegram_bot.pool)
+            # Queued updates were processed before shutdown completed, the
+            # repeated delivery only once.
+            self.assertEqual([
+                'content/tgposts/101/index.md',
+                'content/tgposts/102/index.md',
+                'data/tgposts/101.json',
+                'data/tgposts/102.json',
+            ], sorted(run.gitlab.files))
+            self.assertEqual(2, len(run.telegram.calls('sendMessage')))
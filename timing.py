@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import wraps
+from threading import Lock, RLock
+from typing import Callable, Optional
+
+TIMING_ENABLED = os.environ.get('TIMING_ENABLED') == '1'
+METRICS_DUMP_PATH = os.environ.get('METRICS_DUMP_PATH')
+
+logger = logging.getLogger(__name__)
+
+_NULL_SPAN = nullcontext()
+_current_trace: ContextVar[Optional['Trace']] = ContextVar('trace', default=None)
+
+
+@dataclass
+class Trace:
+    name: str
+    update_id: Optional[int]
+    started_at: float = field(default_factory=time.perf_counter)
+    stages: dict[str, float] = field(default_factory=lambda: defaultdict(float))
+    _lock: Lock = field(default_factory=Lock)
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] += seconds
+
+    def as_record(self, status: str):
+        return {
+            'trace': self.name,
+            'update_id': self.update_id,
+            'status': status,
+            'duration_ms': round((time.perf_counter() - self.started_at) * 1000, 3),
+            'stages_ms': {k: round(v * 1000, 3) for k, v in self.stages.items()},
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.counts: dict[tuple[str, str], int] = defaultdict(int)
+        self.sums: dict[tuple[str, str], float] = defaultdict(float)
+        # Reentrant, for dump.
+        self._lock = RLock()
+
+    def observe(self, record: dict):
+        with self._lock:
+            stages = {'total': record['duration_ms'], **record['stages_ms']}
+            for stage, ms in stages.items():
+                key = (record['trace'], stage)
+                self.counts[key] += 1
+                self.sums[key] += ms / 1000
+
+    def render_prometheus(self):
+        lines = [
+            '# HELP tgsync_stage_seconds Time spent per pipeline stage.',
+            '# TYPE tgsync_stage_seconds summary',
+        ]
+        with self._lock:
+            for (trace, stage), count in sorted(self.counts.items()):
+                labels = f'trace="{trace}",stage="{stage}"'
+                lines.append(f'tgsync_stage_seconds_sum{{{labels}}} '
+                             f'{self.sums[trace, stage]:.6f}')
+                lines.append(f'tgsync_stage_seconds_count{{{labels}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str):
+        # One dump at a time, each through a temporary file of its own, so
+        # that the file is never read half written.
+        directory, name = os.path.split(path)
+        with self._lock:
+            fd, tmp_path = tempfile.mkstemp(dir=directory or '.', prefix=f'{name}.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(self.render_prometheus())
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def _span(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if trace := _current_trace.get():
+            trace.add(stage, time.perf_counter() - start)
+
+
+def span(stage: str):
+    if not TIMING_ENABLED:
+        return _NULL_SPAN
+    return _span(stage)
+
+
+def timed(stage: str):
+    def decorator(func: Callable):
+        if not TIMING_ENABLED:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _span(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def traced(name: str):
+    # Wraps an update handler: the outermost traced call emits one JSON
+    # record with the time spent in every span entered while it ran; nested
+    # traced calls are recorded as a stage of it.
+    def decorator(func: Callable):
+        if not TIMING_ENABLED:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current_trace.get():
+                with _span(name):
+                    return func(*args, **kwargs)
+            update = kwargs.get('update') or next(
+                (a for a in args if hasattr(a, 'update_id')), None,
+            )
+            trace = Trace(name=name, update_id=getattr(update, 'update_id', None))
+            token = _current_trace.set(trace)
+            status = 'error'
+            try:
+                result = func(*args, **kwargs)
+                status = 'ok'
+                return result
+            finally:
+                _current_trace.reset(token)
+                emit(trace.as_record(status))
+
+        return wrapper
+
+    return decorator
+
+
+def emit(record: dict):
+    # Runs after the handler, so it must not raise: that would report a
+    # handler that succeeded as failed, or hide the error it raised.
+    try:
+        logger.info(json.dumps(record))
+        metrics.observe(record)
+        if METRICS_DUMP_PATH:
+            metrics.dump(METRICS_DUMP_PATH)
+    except Exception:
+        logger.exception('Emitting the timing record failed')
@@ -0,0 +1,151 @@
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Iterator
+
+UPDATE_STORE = os.environ.get('UPDATE_STORE', 'memory://')
+UPDATE_STORE_RETENTION = float(os.environ.get('UPDATE_STORE_RETENTION', 24 * 3600))
+UPDATE_STORE_STALE_AFTER = float(os.environ.get('UPDATE_STORE_STALE_AFTER', 300))
+UPDATE_STORE_DRAIN_INTERVAL = float(os.environ.get('UPDATE_STORE_DRAIN_INTERVAL', 60))
+
+_store: 'UpdateStore' = None
+_store_lock = Lock()
+
+
+class UpdateStore(ABC):
+    # Inbox of webhook updates keyed by update_id. `claim` records an update
+    # before it is processed and rejects ids that were seen already;
+    # `complete` marks it done. Updates claimed but never completed (the
+    # process died) are handed out again by `pending` once they are stale,
+    # and `claim` takes them over then, whether Telegram redelivers them or
+    # they come from `pending`, so only one of the two processes them.
+    @abstractmethod
+    def claim(self, update_id: int, data: dict,
+              stale_after: float = UPDATE_STORE_STALE_AFTER) -> bool:
+        pass
+
+    @abstractmethod
+    def complete(self, update_id: int):
+        pass
+
+    @abstractmethod
+    def pending(self, stale_after: float = UPDATE_STORE_STALE_AFTER) -> Iterator[tuple[int, dict]]:
+        pass
+
+
+class MemoryUpdateStore(UpdateStore):
+    def __init__(self, retention: float = UPDATE_STORE_RETENTION):
+        self.retention = retention
+        self._updates: OrderedDict[int, tuple[float, dict]] = OrderedDict()
+        self._lock = Lock()
+
+    def prune(self, now: float):
+        while self._updates:
+            update_id, (claimed_at, data) = next(iter(self._updates.items()))
+            if data is not None or claimed_at > now - self.retention:
+                break
+            del self._updates[update_id]
+
+    def claim(self, update_id: int, data: dict,
+              stale_after: float = UPDATE_STORE_STALE_AFTER) -> bool:
+        now = time.time()
+        with self._lock:
+            self.prune(now)
+            if claimed := self._updates.get(update_id):
+                claimed_at, claimed_data = claimed
+                if claimed_data is None or claimed_at > now - stale_after:
+                    return False
+            self._updates[update_id] = (now, data)
+            return True
+
+    def complete(self, update_id: int):
+        with self._lock:
+            if update_id in self._updates:
+                claimed_at, _ = self._updates[update_id]
+                self._updates[update_id] = (claimed_at, None)
+
+    def pending(self, stale_after: float = UPDATE_STORE_STALE_AFTER):
+        stale_before = time.time() - stale_after
+        with self._lock:
+            updates = [
+                (update_id, data)
+                for update_id, (claimed_at, data) in self._updates.items()
+                if data is not None and claimed_at <= stale_before
+            ]
+        yield from updates
+
+
+class SQLiteUpdateStore(UpdateStore):
+    def __init__(self, path: str, retention: float = UPDATE_STORE_RETENTION):
+        import sqlite3
+        self.retention = retention
+        self._connection = sqlite3.connect(
+            path,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS updates ('
+            'update_id INTEGER PRIMARY KEY, '
+            'claimed_at REAL NOT NULL, '
+            'data TEXT)'
+        )
+        self._lock = Lock()
+
+    def claim(self, update_id: int, data: dict,
+              stale_after: float = UPDATE_STORE_STALE_AFTER) -> bool:
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                'DELETE FROM updates WHERE data IS NULL AND claimed_at < ?',
+                (now - self.retention,),
+            )
+            cursor = self._connection.execute(
+                'INSERT INTO updates VALUES (?, ?, ?) '
+                'ON CONFLICT (update_id) DO UPDATE SET claimed_at = excluded.claimed_at '
+                'WHERE data IS NOT NULL AND claimed_at <= ?',
+                (update_id, now, json.dumps(data), now - stale_after),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, update_id: int):
+        with self._lock:
+            self._connection.execute(
+                'UPDATE updates SET data = NULL WHERE update_id = ?',
+                (update_id,),
+            )
+
+    def pending(self, stale_after: float = UPDATE_STORE_STALE_AFTER):
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT update_id, data FROM updates '
+                'WHERE data IS NOT NULL AND claimed_at <= ? '
+                'ORDER BY update_id',
+                (time.time() - stale_after,),
+            ).fetchall()
+        for update_id, data in rows:
+            yield update_id, json.loads(data)
+
+
+UPDATE_STORES: dict[str, Callable[[str], UpdateStore]] = {
+    'memory': lambda path: MemoryUpdateStore(),
+    'sqlite': lambda path: SQLiteUpdateStore(path),
+}
+
+
+def create_update_store(url: str = UPDATE_STORE):
+    scheme, _, path = url.partition('://')
+    return UPDATE_STORES[scheme](path)
+
+
+def get_update_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_update_store()
+    return _store
@@ -0,0 +1,83 @@
+import logging
+import os
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Condition, Lock
+from typing import Callable, Hashable, Optional
+
+POLLING_WORKERS = int(os.environ.get('POLLING_WORKERS', 8))
+POLLING_QUEUE_SIZE = int(os.environ.get('POLLING_QUEUE_SIZE', 256))
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedWorkerPool:
+    # Jobs with the same key run one at a time in submission order, jobs with
+    # different keys run in parallel on up to `workers` threads. A key has a
+    # queue only while it has jobs, so a job blocked on its own key (an album
+    # leader waiting for the rest of the album) never holds up other keys the
+    # way a fixed hash shard would. Keys that are ready to run wait in a
+    # queue per group (a channel) and free workers take turns between the
+    # groups, so a busy group cannot starve the others. `submit` blocks once
+    # `queue_size` jobs are waiting or running.
+    def __init__(self, workers: int = POLLING_WORKERS,
+                 queue_size: int = POLLING_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='worker',
+        )
+        self._queues: dict[Hashable, deque[tuple[Callable, tuple]]] = {}
+        self._ready: OrderedDict[Hashable, deque[Hashable]] = OrderedDict()
+        self._lock = Lock()
+        self._idle = Condition(self._lock)
+        self._slots = BoundedSemaphore(queue_size)
+
+    def submit(self, key: Hashable, func: Callable, *args,
+               group: Optional[Hashable] = None):
+        self._slots.acquire()
+        with self._lock:
+            if queue := self._queues.get(key):
+                queue.append((func, args))
+                return
+            self._queues[key] = deque([(func, args)])
+            self._ready.setdefault(group, deque()).append(key)
+        # One task per ready key; which key it runs is decided when it starts.
+        self.executor.submit(self._run_next)
+
+    def _run_next(self):
+        with self._lock:
+            group, keys = next(iter(self._ready.items()))
+            key = keys.popleft()
+            if keys:
+                self._ready.move_to_end(group)
+            else:
+                del self._ready[group]
+        self._run(key)
+
+    def _run(self, key: Hashable):
+        queue = self._queues[key]
+        while True:
+            func, args = queue[0]
+            try:
+                func(*args)
+            except Exception:
+                logger.exception('Job for %s failed', key)
+            finally:
+                self._slots.release()
+            with self._lock:
+                queue.popleft()
+                if not queue:
+                    del self._queues[key]
+                    if not self._queues:
+                        self._idle.notify_all()
+                    return
+
+    def drain(self, timeout: float = None) -> bool:
+        # Waits until no job is waiting or running; False on timeout.
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._queues, timeout)
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)